@@ -6,10 +6,10 @@ import time
 from collections import defaultdict
 
 from flask import (Flask, render_template, request, session, url_for, redirect,
-                    flash, abort, jsonify)
+                    flash, abort, jsonify, make_response, Response,
+                    stream_with_context, get_template_attribute)
+from flask.json import JSONEncoder
 from jinja2 import Markup
-import bleach
-import markdown2 as markdown
 import dateutil.parser
 from raven.contrib.flask import Sentry
 
@@ -18,8 +18,16 @@ import logic as l
 
 from bp.admin import bp as bp_admin
 
+class RowEncoder(JSONEncoder):
+    """tojson and jsonify write logic's rows as objects."""
+    def default(self, o):
+        if isinstance(o, l.Row):
+            return o._asdict()
+        return JSONEncoder.default(self, o)
+
 app = Flask(__name__)
 app.secret_key = os.environ['FLASK_SECRET_KEY']
+app.json_encoder = RowEncoder
 
 app.register_blueprint(bp_admin, url_prefix='/admin')
 
@@ -56,18 +64,27 @@ def date_filter(d):
 def time_to_minutes(d):
     return d.hour*60+d.minute
 
-def set_nofollow(attrs, new=False):
-    attrs['target'] = '_blank'
-    return attrs
-
-
-__ALLOWED_TAGS =['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'pre']
 @app.template_filter('markdown')
 def markdown_filter(s):
-    raw = bleach.clean(markdown.markdown('' if not s else s), 
-                    tags=bleach.ALLOWED_TAGS+__ALLOWED_TAGS)
-    raw = bleach.linkify(raw, callbacks=[set_nofollow])
-    return Markup(raw)
+    return Markup(l.render_markdown(s))
+
+"""
+Request Timing
+"""
+@app.before_request
+def start_timing():
+    request.started = time.time()
+    l.start_query_stats()
+
+@app.after_request
+def log_timing(response):
+    stats = l.query_stats()
+    if stats and hasattr(request, 'started'):
+        l.l('request_timing', path=request.path, endpoint=request.endpoint,
+                status=response.status_code, queries=stats['queries'],
+                db_ms=int(stats['db_ms']),
+                total_ms=int((time.time() - request.started)*1000))
+    return response
 
 """
 Account Silliness
@@ -198,13 +215,13 @@ Batch Actions
 """
 @app.route('/batch/')
 def batch_splash_page():
-    groups = [x._asdict() for x in l.list_groups(request.user.id)]
+    groups = l.list_groups(request.user.id)
     unread = l.get_unread_batches(request.user.id)
     stats = l.get_batch_stats()
     for group in groups:
-        group['unread'] = group['id'] in unread
-        group.update(stats[group['id']])
-    percent = int( 100.0*sum(1.0 for x in groups if x['voted']) / len(groups))
+        group.unread = group.id in unread
+        group.update(stats[group.id])
+    percent = int( 100.0*sum(1.0 for x in groups if x.voted) / len(groups))
     return render_template('batch/batch.html', groups=groups, percent=percent)
 
 @app.route('/batch/full/<int:id>/')
@@ -230,10 +247,12 @@ def batch_view(id):
         abort(404)
     raw_proposals = l.get_group_proposals(id)
     votes  = l.get_group_votes(id)
+    voters_by_proposal = l.voters_by_proposal(votes)
+    discussions = l.get_discussions([rp.id for rp in raw_proposals])
     proposals = []
     for rp in raw_proposals:
-        clean_prop = {'proposal': rp, 'discussion': l.get_discussion(rp.id)}
-        voters = [v.display_name for v in votes if rp.id in v.accept]
+        clean_prop = {'proposal': rp, 'discussion': discussions[rp.id]}
+        voters = voters_by_proposal.get(rp.id, [])
         clean_prop['voters'] = ', '.join(voters)
         clean_prop['voters_count'] = len(voters)
         proposals.append(clean_prop)
@@ -268,11 +287,26 @@ def batch_discussion(id):
     group = l.get_group(id)
     if request.user.email in group.author_emails or group.locked:
         abort(404)
+    since = since_cursor()
     txt = request.values.get('comment','').strip()
     if txt:
         l.add_batch_message(request.user.id, id, txt)
-    return render_template('batch/batch_discussion_snippet.html',
-                            msgs=l.get_batch_messages(id))
+    return batch_messages_response(id, since)
+
+@app.route('/batch/<int:id>/messages/')
+def batch_messages(id):
+    group = l.get_group(id)
+    if not group or request.user.email in group.author_emails:
+        abort(404)
+    return batch_messages_response(id, since_cursor(0))
+
+@app.route('/batch/<int:id>/stream/')
+def batch_stream(id):
+    group = l.get_group(id)
+    if not group or request.user.email in group.author_emails:
+        abort(404)
+    render = get_template_attribute('batch/batch_render.html', 'batch_message')
+    return live_stream('batchmessages', id, l.get_batch_messages, render)
 
 @app.route('/batch/nominations/')
 def my_nominations():
@@ -289,49 +323,34 @@ def activity_buttons():
 
 @app.route('/screening/stats/')
 def screening_stats():
-    users = [x for x in l.list_users() if x.votes]
-    users.sort(key=lambda x:-x.votes)
-    progress = l.screening_progress()
-    votes_when = l.get_votes_by_day()
-    coverage_by_age = l.coverage_by_age()
-    active_discussions = l.active_discussions()
-    nomination_density = l.nomination_density()
-    return render_template('screening_stats.html',
-                            users=users, progress=progress,
-                            nomination_density=nomination_density,
-                            coverage_by_age=coverage_by_age,
-                            total_votes=sum(u.votes for u in users),
-                            total_proposals=sum(p.quantity for p in progress),
-                            active_discussions=active_discussions,
-                            votes_when=votes_when)
+    snapshot = l.stats_snapshot()
+    #The page around the stats depends on who's looking
+    etag = '{}-{}'.format(snapshot['etag'], request.user.id)
+    #so does any flashed message waiting to be shown, which a 304 would skip
+    flashes = session.get('_flashes')
+    if not flashes and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('screening_stats.html',
+                                    snapshot_built=snapshot['built'],
+                                    **snapshot['doc']))
+    if not flashes:
+        response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/screening/<int:id>/')
 def screening(id):
     l.l('screening_view', uid=request.user.id, id=id)
-    proposal = l.get_proposal(id)
-    if not proposal or proposal.withdrawn:
+    page = l.screening_page_bundle(request.user.id, id)
+    if not page or page.proposal.withdrawn:
         abort(404)
 
-    if request.user.email in (x.email.lower() for x in proposal.authors):
+    if request.user.email in (x.email.lower() for x in page.proposal.authors):
         abort(404)
 
-    unread = l.is_unread(request.user.id, id)
-    discussion = l.get_discussion(id)
-
-    standards = l.get_standards()
-
-    existing_vote = l.get_user_vote(request.user.id, id)
-    votes = l.get_votes(id)
-
-    my_votes = l.get_my_votes(request.user.id)
-    percent = l.get_vote_percentage(request.user.email, request.user.id)
-
-    return render_template('screening_proposal.html', proposal=proposal,
-                            votes=votes, discussion=discussion,
-                            standards=standards,
-                            existing_vote=existing_vote,
-                            unread=unread,
-                            percent=percent)
+    return render_template('screening_proposal.html', **page._asdict())
 
 @app.route('/screening/<int:id>/vote/', methods=['POST'])
 def vote(id):
@@ -348,30 +367,46 @@ def vote(id):
 
 @app.route('/screening/<int:id>/comment/', methods=['POST'])
 def comment(id):
+    since = since_cursor()
     comment = request.values.get('comment').strip()
     if comment:
         l.add_to_discussion(request.user.id, id, comment, feedback=False)
-    return render_template('discussion_snippet.html', 
-            unread = l.is_unread(request.user.id, id),
-            discussion = l.get_discussion(id))
+    return discussion_response(id, since)
 
 @app.route('/screening/<int:id>/feedback/', methods=['POST'])
 def feedback(id):
     if CUTOFF_FEEDBACK:
         abort(404)
+    since = since_cursor()
     comment = request.values.get('feedback').strip()
     if comment:
         l.add_to_discussion(request.user.id, id, comment, feedback=True)
-    return render_template('discussion_snippet.html', 
-            unread = l.is_unread(request.user.id, id),
-            discussion = l.get_discussion(id))
+    return discussion_response(id, since)
 
 @app.route('/screening/<int:id>/mark_read/', methods=['POST'])
 def mark_read(id):
+    since = since_cursor()
     l.mark_read(request.user.id, id)
-    return render_template('discussion_snippet.html', 
-            unread = l.is_unread(request.user.id, id),
-            discussion = l.get_discussion(id))
+    return discussion_response(id, since)
+
+def check_discussion_reader(id):
+    proposal = l.get_proposal(id, 'summary')
+    if not proposal or proposal.withdrawn:
+        abort(404)
+    if request.user.email in (x.email.lower() for x in proposal.authors):
+        abort(404)
+
+@app.route('/screening/<int:id>/discussion/')
+def discussion(id):
+    check_discussion_reader(id)
+    return discussion_response(id, since_cursor(0))
+
+@app.route('/screening/<int:id>/stream/')
+def discussion_stream(id):
+    check_discussion_reader(id)
+    render = get_template_attribute('proposal_render.html',
+                                    'discussion_message')
+    return live_stream('discussion', id, l.get_discussion, render)
 
 @app.route('/screening/<int:id>/mark_read/next/', methods=['POST'])
 def mark_read_read_next(id):
@@ -383,6 +418,75 @@ def mark_read_read_next(id):
     target = random.choice(unread)
     return redirect(url_for('screening', id=random.choice(unread).id))
 
+"""
+Live Discussion
+"""
+LIVE_KEEPALIVE = int(os.environ.get('LIVE_KEEPALIVE', 25))
+LIVE_SECONDS = int(os.environ.get('LIVE_SECONDS', 600))
+
+def message_json(render, m):
+    return {'id': m.id, 'html': unicode(render(m))}
+
+def since_cursor(default=None):
+    """The since parameter as a message id, default if it's missing."""
+    if 'since' not in request.values:
+        return default
+    since = request.values.get('since', type=int)
+    if since is None:
+        abort(400)
+    return since
+
+def discussion_response(id, since):
+    """Given a since cursor, the discussion's newer messages and whether
+    it's unread for this user, as JSON. Without one, the whole panel."""
+    unread = l.is_unread(request.user.id, id)
+    if since is None:
+        return render_template('discussion_snippet.html', unread=unread,
+                                discussion=l.get_discussion(id))
+    render = get_template_attribute('proposal_render.html',
+                                    'discussion_message')
+    return jsonify(unread=unread, messages=[message_json(render, m)
+                            for m in l.get_discussion(id, since)])
+
+def batch_messages_response(id, since):
+    """The same, for a batch's messages."""
+    if since is None:
+        return render_template('batch/batch_discussion_snippet.html',
+                                msgs=l.get_batch_messages(id))
+    render = get_template_attribute('batch/batch_render.html', 'batch_message')
+    return jsonify(unread=l.is_batch_unread(request.user.id, id),
+                    messages=[message_json(render, m)
+                            for m in l.get_batch_messages(id, since)])
+
+def live_stream(channel, key, fetch, render):
+    """Server-sent events for every message in the thread after the
+    client's cursor, as they're posted. Each stream holds a greenlet, not a
+    database connection, while it waits; it ends after LIVE_SECONDS and the
+    browser reconnects with the highest id it got. fetch can return messages
+    from just before the cursor that committed late, so the stream skips
+    the ones it's already sent, and the page skips ids it already has."""
+    since_id = (request.headers.get('Last-Event-ID', type=int)
+                    or request.values.get('since', 0, type=int))
+    def events(since_id):
+        ends = time.time() + LIVE_SECONDS
+        sent = set()
+        yield 'retry: 3000\n\n'
+        while time.time() < ends:
+            messages = [m for m in fetch(key, since_id) if m.id not in sent]
+            for m in messages:
+                sent.add(m.id)
+                since_id = max(since_id, m.id)
+                data = json.dumps(message_json(render, m))
+                yield 'id: {}\ndata: {}\n\n'.format(since_id, data)
+            if (not messages and not
+                    l.wait_for_message(channel, key, since_id, LIVE_KEEPALIVE)):
+                yield ': keepalive\n\n'
+    response = Response(stream_with_context(events(since_id)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 """
 Author Feedback
 """
@@ -392,7 +496,7 @@ def author_feedback(key):
     name, id = l.check_author_key(key)
     if not name:
         return render_template('bad_feedback_key.html')
-    proposal = l.get_proposal(id)
+    proposal = l.get_proposal(id, 'summary')
     return render_template('author_feedback.html', name=name, 
                             proposal=proposal, messages=l.get_discussion(id))
 
@@ -449,7 +553,7 @@ def pick():
             flash(msg)
             return redirect(url_for('screening', id=data[0].proposal))
 
-    id = l.needs_votes(request.user.email, request.user.id)
+    id = l.needs_votes(request.user.email, request.user.id, reserve=True)
     if not id:
         flash("You have voted on every proposal!")
         return redirect(url_for('screening_stats'))
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+import sys
+
+import logic as l
+
+def main(command):
+    if command == 'rebuild':
+        l.rebuild_batch_coverage()
+    elif command != 'verify':
+        print 'Usage: batch_coverage.py [verify|rebuild]'
+        sys.exit(2)
+
+    mismatches = l.verify_batch_coverage()
+    for batchgroup, proposal, expected, stored in mismatches:
+        print 'Group {} proposal {}: expected {}, stored {}'.format(
+                batchgroup, proposal, expected, stored)
+    print '{} mismatches'.format(len(mismatches))
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'verify')
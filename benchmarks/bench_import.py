@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+How long a fresh interpreter takes to `import logic`, which is most of what a
+gunicorn worker or a CLI does at boot, which heavy libraries that drags in,
+and what each lazily built service costs the first time it's used.
+
+    envdir dev-config python benchmarks/bench_import.py [runs]
+
+Nothing here touches the database; the engine connects lazily. The import is
+also timed with an empty environment, since none of the settings should be
+read until something needs them.
+"""
+import os
+import sys
+import subprocess
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY = ('pandas', 'gensim', 'scipy', 'numpy', 'sendgrid', 'jinja2',
+            'itsdangerous')
+
+SERVICES = ('_engine', '_sendgrid', '_jinja', '_user_fb_itsd',
+            '_login_email_itsd', '_confirmation_itsd', '_admin_emails',
+            '_rooms')
+
+PROBE = '''
+import sys, time
+started = time.time()
+import logic
+elapsed = time.time() - started
+heavy = [m for m in %r if m in sys.modules]
+built = []
+for name in %r if len(sys.argv) > 1 else ():
+    started = time.time()
+    getattr(logic, name)()
+    built.append('%%s=%%f' %% (name, time.time() - started))
+print elapsed, ' '.join(heavy), '|', ' '.join(built)
+''' % (HEAVY, SERVICES)
+
+def run_once(env=None, services=False):
+    args = [sys.executable, '-c', PROBE] + (['services'] if services else [])
+    out = subprocess.check_output(args, cwd=ROOT, env=env,
+                                    stderr=open(os.devnull, 'w'))
+    head, _, built = out.strip().partition('|')
+    elapsed, _, heavy = head.strip().partition(' ')
+    built = [x.split('=') for x in built.split()]
+    return float(elapsed), heavy, [(k, float(v)) for k, v in built]
+
+def report(title, results):
+    times = sorted(x[0] for x in results)
+    print title
+    print '  best   {:>8.1f} ms'.format(times[0]*1000)
+    print '  median {:>8.1f} ms'.format(times[len(times)//2]*1000)
+    print '  loaded {}'.format(results[-1][1] or 'none of the heavy modules')
+
+def main(runs=5):
+    report('import logic, {} runs'.format(runs),
+            [run_once() for _ in range(runs)])
+    bare = {'PATH': os.environ.get('PATH', '')}
+    report('import logic with an empty environment, {} runs'.format(runs),
+            [run_once(bare) for _ in range(runs)])
+
+    print 'first use of each service, median of {} runs'.format(runs)
+    built = defaultdict(list)
+    for _ in range(runs):
+        for name, elapsed in run_once(services=True)[2]:
+            built[name].append(elapsed)
+    for name in SERVICES:
+        times = sorted(built[name])
+        print '  {:<20} {:>8.1f} ms'.format(name, times[len(times)//2]*1000)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
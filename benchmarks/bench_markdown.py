@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+What the markdown filter costs for a corpus shaped like the one
+fill_db_with_fakes.py builds (200 proposals, a quarter of them revised, with
+a description and notes in every version): rendering everything from
+scratch, as every page view used to, against hits in the in-process LRU and,
+with --db, in the markdown_cache table.
+
+    envdir dev-config python benchmarks/bench_markdown.py [--db] [proposals]
+
+Only --db touches the database, and it only adds rows to markdown_cache.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logic as l
+from fill_db_with_fakes import ipsum
+
+def corpus(proposals):
+    random.seed(0)
+    texts = []
+    for n in range(proposals):
+        description = ipsum(4)
+        texts.extend([description, ipsum(2)])
+        if random.randint(0, 3) == 0:
+            texts.append('UPDATED ' + description)
+    return texts
+
+def timed(label, fn, texts, repeat=3):
+    best = None
+    for n in range(repeat):
+        started = time.time()
+        fn(texts)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print '{:<32} {:>9.1f} ms {:>8.1f} us/field'.format(label, best*1000,
+                                                    best*1e6/len(texts))
+
+def main(proposals=200, db=False):
+    texts = corpus(proposals)
+    print '{} fields from {} proposals'.format(len(texts), proposals)
+    timed('render every time', lambda t: [l._render_markdown(x) for x in t],
+            texts)
+
+    l._MARKDOWN_DB = db
+    l._MARKDOWN_CACHE_SIZE = len(texts)
+    for x in texts:
+        l.render_markdown(x)
+    timed('LRU hits', lambda t: [l.render_markdown(x) for x in t], texts)
+    if db:
+        def table_hits(t):
+            l._MARKDOWN.clear()
+            for x in t:
+                l.render_markdown(x)
+        timed('markdown_cache table hits', table_hits, texts)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    db = '--db' in args
+    main(*[int(x) for x in args if x != '--db'], db=db)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+How much proposal data each page pulls from the database, with the old
+SELECT *-plus-every-revision loads and with the field sets get_proposal,
+get_group_proposals and screening_page_bundle use now. The corpus is shaped
+like the one fill_db_with_fakes.py builds, with a batch group of 8 and a
+quarter of the proposals revised 1 to 3 times.
+
+    envdir dev-config python benchmarks/bench_proposal_bytes.py [proposals]
+
+Bytes are the text size of every row the page's queries return, which is
+about what psycopg2 reads off the wire. Everything happens in a scratch
+schema, which is dropped at the end, so it's safe to point at a database
+with data in it.
+"""
+import os
+import sys
+import random
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logic as l
+from fill_db_with_fakes import ipsum, words
+
+SCHEMA = 'bench_proposal_bytes'
+
+#What every proposal load selected before field sets
+_EVERYTHING = 'proposals.*, ' + l._DATA_HISTORY + ' AS data_history'
+BEFORE = {'_PROPOSAL_FIELDS': {k: _EVERYTHING for k in l._PROPOSAL_FIELDS},
+            '_SCREENING_FIELDS': _EVERYTHING}
+
+def proposal(n):
+    return {'id': n, 'title': words(3, 8).title(), 'category': words(1, 2),
+            'authors': [{'email': 'author{}@example.com'.format(n),
+                            'name': 'Speaker Name Here'}],
+            'duration': '30 minutes', 'description': ipsum(4),
+            'audience': ipsum(1), 'audience_level': 'Novice',
+            'notes': ipsum(2), 'objective': ipsum(1),
+            'recording_release': True, 'abstract': ipsum(1),
+            'outline': ipsum(5), 'additional_notes': ipsum(1),
+            'additional_requirements': ipsum(1)}
+
+def setup(proposals):
+    random.seed(0)
+    l._db().execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; '
+                    'SET LOCAL search_path TO {0}'.format(SCHEMA))
+    l._db().execute(open(os.path.join(os.path.dirname(__file__), '..',
+                                        'tables.sql')).read())
+    uid = l.add_user('reviewer@example.com', 'Reviewer', 'abc123')
+    l.approve_user(uid)
+    standards = [l.add_standard(words(3, 10)[:50]) for n in range(6)]
+    corpus = [proposal(n) for n in range(1, proposals + 1)]
+    l.add_proposals(corpus)
+    for data in corpus[::4]:
+        for n in range(random.randint(1, 3)):
+            data['description'] = 'UPDATED ' + ipsum(4)
+            l.add_proposals([data])
+    #Voted on a day after they were submitted, before any revisions
+    for id in (1, 2):
+        l.vote(uid, id, {k: 1 for k in standards})
+    l._db().execute("UPDATE votes SET updated_on = now() - interval '1 day'")
+    l._db().execute('''UPDATE proposals SET updated = now() - interval '2 days'
+                        WHERE id NOT IN (SELECT proposal FROM proposal_revisions
+                                        GROUP BY proposal HAVING count(*) > 1)''')
+    gid = l.create_group('Group', range(1, 9))
+    return uid, gid
+
+def result_bytes(fn):
+    """Run fn, then the text size of everything its queries returned."""
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    engine = l._engine()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    total = 0
+    for statement, parameters in statements:
+        q = 'SELECT COALESCE(sum(octet_length(t::text)), 0) FROM ({}) AS t'
+        total += l._db().execute(q.format(statement), parameters).scalar()
+    return total
+
+def pages(uid, gid):
+    return [('screening, new to you', lambda: l.screening_page_bundle(uid, 5)),
+            ('screening, unchanged since vote',
+                lambda: l.screening_page_bundle(uid, 2)),
+            ('screening, updated since vote',
+                lambda: l.screening_page_bundle(uid, 1)),
+            ('batch group of 8', lambda: l.get_group_proposals(gid)),
+            ('single proposal', lambda: l.get_proposal(1)),
+            ('author feedback', lambda: l.get_proposal(1, 'summary'))]
+
+def main(proposals=200):
+    after = {k: getattr(l, k) for k in BEFORE}
+    with l.transaction():
+        try:
+            uid, gid = setup(proposals)
+            print '{:<34} {:>10} {:>10}'.format('page', 'before', 'after')
+            for label, fn in pages(uid, gid):
+                vars(l).update(BEFORE)
+                before = result_bytes(fn)
+                vars(l).update(after)
+                print '{:<34} {:>10,} {:>10,}'.format(label, before,
+                                                    result_bytes(fn))
+        finally:
+            vars(l).update(after)
+            l._db().execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+What it costs to turn query results into the rows the list pages use: the
+old path (a namedtuple per row, then _asdict() into a dict, then for
+proposals a second namedtuple class) against the slotted models fetchmodels
+builds in one pass.
+
+    envdir dev-config python benchmarks/bench_rows.py [rows]
+
+Cursor rows are made up in memory, so this doesn't touch the database.
+Python 2.7 has no allocation tracer, so "objects" counts the containers the
+garbage collector tracks that are still alive once the rows are built, and
+"bytes" adds up their sys.getsizeof.
+"""
+import os
+import sys
+import gc
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logic as l
+
+NOW = datetime.datetime(2017, 1, 1)
+
+PROPOSAL_KEYS = ('id', 'title', 'author_names', 'author_emails', 'added_on',
+                    'updated', 'vote_count', 'batchgroup', 'withdrawn',
+                    'accepted', 'voters', 'data', 'count')
+LISTING_KEYS = ('id', 'title', 'batch_id', 'accepted', 'author_names',
+                    'batchgroup', 'progcom_member')
+GROUP_KEYS = ('id', 'name', 'locked', 'voter_count', 'skip_count',
+                'talk_count')
+
+def proposal_row(n):
+    return (n, 'Title {}'.format(n), ['Speaker {}'.format(n)],
+            ['{}@example.com'.format(n)], NOW, NOW, 5, 1, False, None,
+            [1, 2, 3, 4, 5], {'title': 'Title {}'.format(n)}, 2)
+
+def listing_row(n):
+    return (n, 'Title {}'.format(n), n % 50, None, 'Speaker {}'.format(n),
+            'Group {}'.format(n % 50), False)
+
+def group_row(n):
+    return (n, 'Group {}'.format(n), False, 10, 2, 8)
+
+def old_clean_proposal(raw):
+    authorsT = l.build_tuple(('name', 'email'))
+    raw['authors'] = tuple(authorsT(name, email)
+                            for name, email in zip(raw['author_names'],
+                                                raw['author_emails']))
+    del raw['author_names']
+    del raw['author_emails']
+    if raw.get('data_history') is None and 'data' in raw:
+        raw['data_history'] = [dict(raw['data'], when=raw['updated'])]
+    keys, values = zip(*raw.items())
+    T = l.build_tuple(keys)
+    return T(*values)
+
+def old_fetchall(keys, rows):
+    T = l.build_tuple(keys)
+    return [T(*row) for row in rows]
+
+def old_proposals(rows):
+    return [old_clean_proposal(x._asdict())
+                for x in old_fetchall(PROPOSAL_KEYS, rows)]
+
+def old_listing(rows):
+    raw = [x._asdict() for x in old_fetchall(LISTING_KEYS, rows)]
+    for proposal in raw:
+        proposal['consensus'] = 50
+    return raw
+
+def old_groups(rows):
+    raw = [x._asdict() for x in old_fetchall(GROUP_KEYS, rows)]
+    for g in raw:
+        g['skip_consensus'] = 0
+        g['talk_consensus'] = []
+    return raw
+
+def new_fetchmodels(model, keys, rows):
+    T = l.row_class(model, keys)
+    return [T._make(row) for row in rows]
+
+def new_proposals(rows):
+    return new_fetchmodels(l.Proposal, PROPOSAL_KEYS, rows)
+
+def new_listing(rows):
+    raw = new_fetchmodels(l.ProposalListing, LISTING_KEYS, rows)
+    for proposal in raw:
+        proposal.consensus = 50
+    return raw
+
+def new_groups(rows):
+    raw = new_fetchmodels(l.BatchGroup, GROUP_KEYS, rows)
+    for g in raw:
+        g.skip_consensus = 0
+        g.talk_consensus = []
+    return raw
+
+def measure(fn, rows):
+    fn(rows[:1])
+    gc.collect()
+    gc.disable()
+    try:
+        before = set(id(x) for x in gc.get_objects())
+        rv = fn(rows)
+        created = [x for x in gc.get_objects() if id(x) not in before]
+        objects = len(created) - 1
+        size = sum(sys.getsizeof(x) for x in created)
+    finally:
+        gc.enable()
+    del rv, created
+    best = None
+    for n in range(5):
+        started = time.time()
+        fn(rows)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return objects, size, best
+
+def main(count=500):
+    cases = [('proposals', proposal_row, old_proposals, new_proposals),
+            ('full_proposal_list', listing_row, old_listing, new_listing),
+            ('raw_list_groups', group_row, old_groups, new_groups)]
+    print '{} rows'.format(count)
+    print '{:<20} {:>5} {:>12} {:>12} {:>12}'.format('rows', 'path',
+            'objects/row', 'bytes/row', 'us/row')
+    for label, make, old, new in cases:
+        rows = [make(n) for n in range(count)]
+        for path, fn in (('old', old), ('new', new)):
+            objects, size, elapsed = measure(fn, rows)
+            print '{:<20} {:>5} {:>12.1f} {:>12.0f} {:>12.2f}'.format(label,
+                    path, float(objects)/count, float(size)/count,
+                    elapsed*1e6/count)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
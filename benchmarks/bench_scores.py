@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compares the ways of producing the admin rough scores over synthetic votes:
+the old per-request pass over every vote row, the vectorized rebuild, and
+folding single new votes into the cached totals.
+
+    envdir dev-config python benchmarks/bench_scores.py [proposals] [reviewers]
+
+Nothing here touches the database.
+"""
+import os
+import sys
+import time
+import random
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logic as l
+
+VoteRow = namedtuple('VoteRow', ('scores', 'nominate', 'proposal', 'title',
+                                    'accepted', 'batchgroup', 'batch_id'))
+Proposal = namedtuple('Proposal', ('id', 'title', 'accepted', 'batchgroup',
+                                    'batch_id'))
+
+def timed(label, fn, repeat=3):
+    best = None
+    for n in range(repeat):
+        started = time.time()
+        rv = fn()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print '{:<40} {:>9.1f} ms'.format(label, best*1000)
+    return rv
+
+def main(proposal_count=10000, reviewers=30, standards=6):
+    random.seed(0)
+    rows = []
+    for pid in range(proposal_count):
+        for voter in range(reviewers):
+            scores = {k:random.randint(0, 2) for k in range(standards)}
+            rows.append((voter, pid, scores, random.random() > 0.8))
+    print '{:,} proposals x {} reviewers = {:,} votes\n'.format(
+            proposal_count, reviewers, len(rows))
+
+    legacy_rows = [VoteRow(scores, nominate, pid, 'Title', None, None, None)
+                    for voter, pid, scores, nominate in rows]
+    proposals = [Proposal(pid, 'Title', None, None, None)
+                    for pid in range(proposal_count)]
+    columns = zip(*((voter, pid, sum(scores.values()), len(scores),
+                        sum(1 for x in scores.values() if x == 2), nominate)
+                    for voter, pid, scores, nominate in rows))
+
+    legacy = timed('per-request recompute (old)', lambda: l._score_rows(legacy_rows))
+
+    def rebuild():
+        votes, totals = l._score_all(*columns)
+        l._SCORES.update(votes=votes, totals=totals, stamp=l._EPOCH)
+        return l._rank_scores(totals, proposals)
+    rebuilt = timed('vectorized rebuild + rank', rebuild)
+
+    updates = [(random.randrange(reviewers), random.randrange(proposal_count),
+                {k:random.randint(0, 2) for k in range(standards)},
+                random.random() > 0.8) for n in range(1000)]
+    def incremental():
+        for voter, pid, scores, nominate in updates:
+            values = scores.values()
+            l._score_vote(voter, pid, sum(values), len(values),
+                            sum(1 for x in values if x == 2), nominate)
+    timed('fold in 1,000 new votes', incremental, repeat=1)
+    timed('rank from cached totals', lambda: l._rank_scores(l._SCORES['totals'],
+                                                            proposals))
+
+    #The old code truncates float sums, so greenness can come out one lower
+    by_id = lambda rv: {x['id']:dict(x, rank=None, greenness=None) for x in rv}
+    assert by_id(legacy) == by_id(rebuilt)
+    greenness = {x['id']:x['greenness'] for x in rebuilt}
+    assert all(0 <= greenness[x['id']] - x['greenness'] <= 1 for x in legacy)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Times vote writes against one proposal that already has many votes, with the
+old whole-proposal triggers and with the incremental ones in tables.sql.
+
+    envdir dev-config python benchmarks/bench_vote_writes.py [votes...]
+
+Everything happens in a scratch schema on one connection, which is dropped
+at the end, so it's safe to point at a database with data in it.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logic as l
+
+SCHEMA = 'bench_vote_writes'
+
+OLD_TRIGGERS = '''
+DROP TRIGGER votes_insert_trigger ON votes;
+DROP TRIGGER votes_change_trigger ON votes;
+DROP TRIGGER batch_insert_trigger ON proposals;
+DROP TRIGGER batch_change_trigger ON proposals;
+
+CREATE OR REPLACE FUNCTION votes_change() RETURNS trigger AS
+$$
+BEGIN 
+    UPDATE proposals SET 
+        vote_count=(SELECT count(*) FROM votes WHERE proposal=NEW.proposal),
+        voters = ARRAY(SELECT voter FROM votes WHERE proposal=NEW.proposal)
+        WHERE id=NEW.proposal;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER votes_change_trigger AFTER INSERT OR UPDATE
+    ON votes FOR EACH ROW EXECUTE PROCEDURE votes_change();
+
+CREATE OR REPLACE FUNCTION batch_change() RETURNS trigger AS
+$$
+BEGIN 
+    UPDATE batchgroups SET
+    author_emails=(SELECT email_aggregate(author_emails)
+                    FROM proposals WHERE batchgroup = NEW.batchgroup)
+    WHERE id = NEW.batchgroup;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER batch_change_trigger AFTER INSERT OR UPDATE
+    ON proposals FOR EACH ROW EXECUTE PROCEDURE batch_change();
+'''
+
+def setup(conn, votes, old):
+    conn.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; '
+                    'SET search_path TO {0}'.format(SCHEMA))
+    conn.execute(open(os.path.join(os.path.dirname(__file__), '..',
+                                    'tables.sql')).read())
+    if old:
+        conn.execute(OLD_TRIGGERS)
+    conn.execute('''INSERT INTO users (email)
+                    SELECT 'user' || n || '@example.com'
+                    FROM generate_series(1, %s) AS n''', votes + 200)
+    conn.execute("INSERT INTO batchgroups (name) VALUES ('Group')")
+    #One big batch group, so the batch trigger has something to chew on too
+    conn.execute('''INSERT INTO proposals (id, author_emails, batchgroup)
+                    SELECT n, ARRAY['author' || n || '@example.com'], 1
+                    FROM generate_series(1, 500) AS n''')
+    conn.execute('''INSERT INTO votes (voter, proposal, scores)
+                    SELECT n, 1, '{}' FROM generate_series(1, %s) AS n''',
+                    votes)
+
+def timed(conn, q, args):
+    started = time.time()
+    for a in args:
+        conn.execute(q, a)
+    return 1000*(time.time() - started)/len(args)
+
+def run(conn, votes, old):
+    setup(conn, votes, old)
+    new_voters = range(votes + 1, votes + 201)
+    insert = timed(conn, '''INSERT INTO votes (voter, proposal, scores)
+                            VALUES (%s, 1, '{}')''', new_voters)
+    rescore = timed(conn, '''UPDATE votes SET scores='{"1": 2}',
+                            updated_on=now() WHERE voter=%s AND proposal=1''',
+                    new_voters)
+    accept = timed(conn, 'UPDATE proposals SET accepted=true WHERE id=%s',
+                    range(2, 202))
+    count = conn.scalar('SELECT vote_count FROM proposals WHERE id=1')
+    assert count == votes + 200, count
+    return insert, rescore, accept
+
+def main(counts):
+    conn = l._engine().connect()
+    try:
+        print '{:>7} {:>9} {:>22} {:>22} {:>22}'.format('votes', 'triggers',
+                'insert vote (ms)', 'rescore vote (ms)', 'accept proposal (ms)')
+        for votes in counts:
+            for old in (True, False):
+                with conn.begin():
+                    row = run(conn, votes, old)
+                print '{:>7} {:>9} {:>22.3f} {:>22.3f} {:>22.3f}'.format(
+                        votes, 'old' if old else 'new', *row)
+    finally:
+        conn.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(SCHEMA))
+        conn.close()
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [100, 1000, 10000])
@@ -9,6 +9,10 @@ bp = Blueprint('admin', __name__)
 def admin_menu():
     return render_template('admin/admin_page.html')
 
+@bp.route('/pool/')
+def pool_stats():
+    return jsonify(**l.pool_stats())
+
 @bp.route('/batchgroups/<int:id>/lock/', methods=['POST'])
 def lock_batch_group(id):
     lock = request.values.get('lock', None) == 't'
@@ -1,24 +1,25 @@
-from collections import namedtuple, defaultdict, Counter
+from collections import namedtuple, defaultdict, Counter, OrderedDict
+from contextlib import contextmanager
 import os 
-import random
 import json
 import logging
 import datetime
 import time
 import re
-
-import pandas as pd
-import itsdangerous
-import sendgrid
+import select
+import threading
+import cPickle as pickle
+from hashlib import sha1
+from itertools import izip
 
 import bcrypt
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+import psycopg2
+from psycopg2 import extensions
 from psycopg2.extras import Json
-from jinja2 import Environment, FileSystemLoader
-
-from gensim import corpora, models, similarities
-from gensim.similarities.docsim import MatrixSimilarity
+from psycopg2.tz import FixedOffsetTimezone
 
 """
 Log It
@@ -33,10 +34,146 @@ def l(key, **data):
     logger.info(json.dumps(data))
     
 
+"""
+Services
+"""
+_SERVICES = {}
+_SERVICES_LOCK = threading.Lock()
+
+def _service(factory):
+    """Build what factory returns the first time it's asked for, and keep it.
+    Importing logic then costs nothing for the clients a script never uses,
+    and doesn't need their settings. Tests swap one out via _SERVICES."""
+    name = factory.__name__
+    def get():
+        if name not in _SERVICES:
+            with _SERVICES_LOCK:
+                if name not in _SERVICES:
+                    _SERVICES[name] = factory()
+        return _SERVICES[name]
+    get.__name__ = name
+    get.__doc__ = factory.__doc__
+    return get
+
+
 """
 Some DB wrapper stuff
 """
-_e = create_engine(os.environ['PSQL_CONNECTION_STRING'])
+_POOL_STATS = {'checkouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+class _TimedQueuePool(QueuePool):
+    """A QueuePool that keeps track of how long callers wait for a
+    connection, so the pool can be sized from real numbers."""
+    def _do_get(self):
+        started = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            waited = time.time() - started
+            _POOL_STATS['checkouts'] += 1
+            _POOL_STATS['wait_total'] += waited
+            _POOL_STATS['wait_max'] = max(_POOL_STATS['wait_max'], waited)
+
+def _gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('Bad result from poll: %r' % state)
+
+def _make_psycopg2_green():
+    """Under gunicorn's gevent worker, let other greenlets run while
+    psycopg2 waits on the server instead of blocking the whole hub."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if not monkey.is_module_patched('socket'):
+        return False
+    extensions.set_wait_callback(_gevent_wait_callback)
+    return True
+
+def _build_engine():
+    env = os.environ
+    options = {'poolclass': _TimedQueuePool,
+                'pool_size': int(env.get('PSQL_POOL_SIZE', 5)),
+                'max_overflow': int(env.get('PSQL_MAX_OVERFLOW', 10)),
+                'pool_timeout': int(env.get('PSQL_POOL_TIMEOUT', 30)),
+                'pool_recycle': int(env.get('PSQL_POOL_RECYCLE', 1800))}
+    if env.get('PSQL_POOL_PRE_PING'):
+        options['pool_pre_ping'] = True
+    statement_timeout = int(env.get('PSQL_STATEMENT_TIMEOUT', 0))
+    if statement_timeout:
+        options['connect_args'] = {
+                'options': '-c statement_timeout={}'.format(statement_timeout)}
+    green = _make_psycopg2_green()
+    l('build_engine', green=green,
+        **{k:v for k,v in options.items() if k != 'poolclass'})
+    return create_engine(env['PSQL_CONNECTION_STRING'], **options)
+
+@_service
+def _engine():
+    e = _build_engine()
+    event.listen(e, 'before_cursor_execute', _query_started)
+    event.listen(e, 'after_cursor_execute', _query_finished)
+    return e
+
+def pool_stats():
+    pool = _engine().pool
+    checkouts = _POOL_STATS['checkouts']
+    return {'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'checkouts': checkouts,
+            'wait_total_ms': int(_POOL_STATS['wait_total']*1000),
+            'wait_avg_ms': (_POOL_STATS['wait_total']*1000/checkouts
+                                if checkouts else 0.0),
+            'wait_max_ms': int(_POOL_STATS['wait_max']*1000)}
+
+_TX = threading.local()
+
+_QUERY_STATS = threading.local()
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    stats = getattr(_QUERY_STATS, 'current', None)
+    if stats is not None:
+        stats['queries'] += 1
+        stats['db_ms'] += elapsed*1000
+
+def start_query_stats():
+    _QUERY_STATS.current = {'queries': 0, 'db_ms': 0.0}
+
+def query_stats():
+    return getattr(_QUERY_STATS, 'current', None)
+
+def _db():
+    return getattr(_TX, 'conn', None) or _engine()
+
+@contextmanager
+def transaction():
+    """Everything run through the wrappers below inside this block shares one
+    connection and commits (or rolls back) together. Nesting joins the outer
+    transaction."""
+    if getattr(_TX, 'conn', None) is not None:
+        yield _TX.conn
+        return
+    with _engine().begin() as conn:
+        _TX.conn = conn
+        try:
+            yield conn
+        finally:
+            _TX.conn = None
 
 __TUPLE_CACHE = {}
 def build_tuple(keys):
@@ -46,11 +183,73 @@ def build_tuple(keys):
         __TUPLE_CACHE[keys] = namedtuple(name, keys)
     return __TUPLE_CACHE[keys]
 
+class Row(object):
+    """A row with attribute and item access over __slots__. Models subclass
+    it, naming the fields callers fill in after the query in their own
+    __slots__, so rows are decorated in place instead of being copied into
+    dicts; row_class adds a subclass per set of columns. Fields nobody has
+    filled in are None."""
+    __slots__ = ()
+    _columns = ()
+    _fields = ()
+    _setters = ()
+
+    @classmethod
+    def _make(cls, values):
+        self = cls.__new__(cls)
+        for setter, value in izip(cls._setters, values):
+            setter(self, value)
+        return self
+
+    @classmethod
+    def _from_dict(cls, d):
+        return row_class(cls, d.keys())._make(d.values())
+
+    def __getattr__(self, name):
+        if name in self._fields:
+            return None
+        raise AttributeError(name)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def update(self, other):
+        for k in other._fields:
+            setattr(self, k, getattr(other, k))
+
+    def _asdict(self):
+        return OrderedDict((k, getattr(self, k)) for k in self._fields)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+                        '{}={!r}'.format(k, v) for k, v in self._asdict().items()))
+
+__ROW_CACHE = {}
+def row_class(model, keys):
+    keys = tuple(keys)
+    if (model, keys) not in __ROW_CACHE:
+        slots = []
+        for cls in model.__mro__:
+            slots.extend(getattr(cls, '__slots__', ()))
+        T = type(model.__name__, (model,),
+                    {'__slots__': tuple(k for k in keys if k not in slots),
+                    '_columns': keys,
+                    '_fields': keys + tuple(k for k in slots if k not in keys)})
+        T._setters = tuple(getattr(T, k).__set__ for k in keys)
+        __ROW_CACHE[model, keys] = T
+    return __ROW_CACHE[model, keys]
+
 def execute(*args, **kwargs):
-    _e.execute(*args, **kwargs)
+    _db().execute(*args, **kwargs)
 
 def fetchone(*args, **kwargs):
-    result = _e.execute(*args, **kwargs)
+    result = _db().execute(*args, **kwargs)
     T = build_tuple(result.keys())
     result = result.fetchone()
     if not result:
@@ -58,15 +257,21 @@ def fetchone(*args, **kwargs):
     return T(*result)
 
 def fetchall(*args, **kwargs):
-    result = _e.execute(*args, **kwargs)
+    result = _db().execute(*args, **kwargs)
     T = build_tuple(result.keys())
     rv = []
     for row in result.fetchall():
         rv.append(T(*row))
     return rv
 
+def fetchmodels(model, *args, **kwargs):
+    """fetchall, building model rows straight off the cursor."""
+    result = _db().execute(*args, **kwargs)
+    T = row_class(model, result.keys())
+    return [T._make(row) for row in result]
+
 def scalar(*args, **kwargs):
-    return _e.scalar(*args, **kwargs)
+    return _db().scalar(*args, **kwargs)
 
 """
 User management
@@ -88,12 +293,16 @@ def add_user(email, display_name, pw):
     except IntegrityError:
         l('add_user_dupe', email=email, display_name=display_name)
         return -1
+    forget_reviewer_activity()
     return id 
 
 def approve_user(id):
     q = 'UPDATE users SET approved_on=now() WHERE id=%s'
     l('approve_user', uid=id)
-    return execute(q, id)
+    rv = execute(q, id)
+    forget_users([id])
+    forget_reviewer_activity()
+    return rv
 
 def check_pw(email_address, pw):
     q = 'SELECT id, pw from users WHERE lower(email) = lower(%s)'
@@ -110,108 +319,327 @@ def check_pw(email_address, pw):
 def change_pw(id, pw):
     q = 'UPDATE users SET pw=%s WHERE id=%s RETURNING id'
     l('change_pw', uid=id)
-    return bool(scalar(q, _mangle_pw(pw), id))
+    rv = bool(scalar(q, _mangle_pw(pw), id))
+    forget_users([id])
+    return rv
+
+_USER_CACHE_TTL = 10
+_USER_CACHE = {}
+
+class User(object):
+    """A users row as seen by get_user. The unread and revisit flags are only
+    queried the first time something (usually a template) asks for them, and
+    are then cached alongside the row."""
+    __slots__ = ('id', 'email', 'display_name', 'approved', '_flags')
+
+    def __init__(self, row, flags):
+        self.id = row.id
+        self.email = row.email
+        self.display_name = row.display_name
+        self.approved = row.approved
+        self._flags = flags
+
+    def _flag(self, name, q):
+        if name not in self._flags:
+            self._flags[name] = bool(scalar(q, self.id))
+        return self._flags[name]
+
+    @property
+    def unread(self):
+        q = 'SELECT discussions > 0 FROM unreadcounts WHERE voter=%s'
+        return self._flag('unread', q)
+
+    @property
+    def revisit(self):
+        q = '''SELECT EXISTS (SELECT 1 FROM votes
+                        INNER JOIN proposals ON (votes.proposal = proposals.id)
+                        WHERE votes.voter=%s
+                                AND proposals.updated > votes.updated_on)'''
+        return self._flag('revisit', q)
 
 def get_user(id):
     if not id:
         return None
-    q = '''SELECT id, email, display_name, approved_on IS NOT NULL AS approved,
-            EXISTS (SELECT 1 FROM unread WHERE voter=%s limit 1) 
-                AS unread,
-            EXISTS (SELECT 1 FROM votes 
-                        INNER JOIN proposals ON (votes.proposal = proposals.id)
-                        WHERE votes.voter=%s
-                                AND proposals.updated > votes.updated_on) 
-                AS revisit
+    cached = _USER_CACHE.get(id)
+    if cached and cached[0] > time.time():
+        return User(cached[1], cached[2])
+    q = '''SELECT id, email, display_name, approved_on IS NOT NULL AS approved
             FROM users WHERE id=%s'''
-    return fetchone(q, id, id, id)
+    row = fetchone(q, id)
+    if not row:
+        return None
+    flags = {}
+    _USER_CACHE[id] = (time.time() + _USER_CACHE_TTL, row, flags)
+    return User(row, flags)
+
+def forget_users(ids):
+    for id in ids:
+        _USER_CACHE.pop(id, None)
 
 def list_users():
-    q = '''SELECT id, email, display_name, created_on, approved_on,
-            (SELECT COUNT(*) FROM votes WHERE users.id=votes.voter)
-            AS votes,
-            (SELECT MAX(updated_on) FROM votes WHERE users.id=votes.voter)
-            AS last_voted,
-            (SELECT COUNT(*) FROM proposals
-                WHERE lower(users.email) = ANY(author_emails))
-            AS proposals_made
+    return reviewer_activity()
+
+"""
+Reviewer activity: one pass over votes and proposal_authors, grouped, then
+joined to users. The admin user list, the screening stats page and stats.py
+all read the same cached rows.
+"""
+_ACTIVITY_TTL = 60
+_ACTIVITY = {'rows': None, 'expires': 0}
+
+def forget_reviewer_activity():
+    _ACTIVITY['rows'] = None
+
+def reviewer_activity():
+    if _ACTIVITY['rows'] is not None and _ACTIVITY['expires'] > time.time():
+        return _ACTIVITY['rows']
+    q = '''SELECT users.id, users.email, users.display_name, users.created_on,
+            users.approved_on,
+            COALESCE(v.votes, 0) AS votes,
+            v.last_voted,
+            COALESCE(pa.proposals_made, 0) AS proposals_made
             FROM users
-            ORDER BY id'''
-    return fetchall(q)
+            LEFT JOIN (SELECT voter, COUNT(*) AS votes,
+                        MAX(updated_on) AS last_voted
+                        FROM votes GROUP BY voter) AS v
+                ON (v.voter = users.id)
+            LEFT JOIN (SELECT email, COUNT(*) AS proposals_made
+                        FROM proposal_authors GROUP BY email) AS pa
+                ON (pa.email = lower(users.email))
+            ORDER BY users.id'''
+    rows = fetchall(q)
+    _ACTIVITY.update(rows=rows, expires=time.time() + _ACTIVITY_TTL)
+    return rows
+
+def active_reviewers():
+    """Users who have voted, busiest first."""
+    return sorted((x for x in reviewer_activity() if x.votes),
+                    key=lambda x:-x.votes)
 
 
 """
 Proposal Management
 """
-def _clean_proposal(raw):
-    authorsT = build_tuple(('name', 'email'))
-    raw['authors'] = tuple(authorsT(name, email) 
-                            for name, email in zip(raw['author_names'],
-                                                raw['author_emails']))
-    del raw['author_names']
-    del raw['author_emails']
-    keys, values = zip(*raw.items())
-    T = build_tuple(keys)
-    return T(*values)
-
-
-def get_proposal(id):
-    q = 'SELECT * FROM proposals WHERE id=%s'
-    raw = fetchone(q, id)
-    if not raw:
-        return None
-    return _clean_proposal(raw._asdict())
+_AUTHOR = build_tuple(('name', 'email'))
+
+class Proposal(Row):
+    __slots__ = ('authors', 'data_history')
+
+    @classmethod
+    def _make(cls, values):
+        self = super(Proposal, cls)._make(values)
+        self.authors = tuple(_AUTHOR(name, email) for name, email
+                                in izip(self.author_names, self.author_emails))
+        #Loads without the earlier versions still get the current one
+        if self.data_history is None and 'data' in self._columns:
+            self.data_history = [dict(self.data, when=self.updated)]
+        return self
+
+
+#Newest first, each version carrying the time it was saved as 'when'
+_DATA_HISTORY = '''(SELECT COALESCE(json_agg(r.data
+                        || jsonb_build_object('when', r.created)
+                        ORDER BY r.id DESC), '[]')
+                FROM proposal_revisions AS r
+                WHERE r.proposal = proposals.id)'''
+
+_PROPOSAL_SUMMARY = '''proposals.id, proposals.data->>'title' AS title,
+        proposals.author_names, proposals.author_emails, proposals.added_on,
+        proposals.updated, proposals.vote_count, proposals.batchgroup,
+        proposals.withdrawn, proposals.accepted'''
+_PROPOSAL_FULL = _PROPOSAL_SUMMARY + ', proposals.voters, proposals.data'
+
+#What get_proposal and get_group_proposals select: enough to name a
+#proposal, everything about its current version, or every version.
+_PROPOSAL_FIELDS = {
+    'summary': _PROPOSAL_SUMMARY,
+    'full': _PROPOSAL_FULL,
+    'history': _PROPOSAL_FULL + ', ' + _DATA_HISTORY + ' AS data_history',
+}
+#Earlier versions are only worth comparing once it's changed since uid voted
+_SCREENING_FIELDS = _PROPOSAL_FULL + ''',
+        CASE WHEN EXISTS (SELECT 1 FROM votes
+                WHERE votes.voter=%(uid)s AND votes.proposal=proposals.id
+                AND votes.updated_on < proposals.updated)
+            THEN ''' + _DATA_HISTORY + ''' END AS data_history'''
+
+def get_proposal(id, fields='full'):
+    q = 'SELECT {} FROM proposals WHERE id=%s'.format(_PROPOSAL_FIELDS[fields])
+    rv = fetchmodels(Proposal, q, id)
+    return rv[0] if rv else None
+
+_PROPOSAL_KEYS = ('id', 'description', 'duration', 'audience',
+                'abstract', 'recording_release', 'notes', 'title', 'outline',)
 
-def add_proposal(data):
-    data = data.copy()
+def _proposal_fields(data):
     emails, names = zip(*((x['email'], x['name']) for x in data['authors']))
-    del data['authors']
+    return list(emails), list(names), {k:data[k] for k in _PROPOSAL_KEYS}
 
-    keys = ('id', 'description', 'duration', 'audience',
-                'abstract', 'recording_release', 'notes', 'title', 'outline',)
+def proposal_digest(data):
+    """A hash of what we'd store for a proposal, so a sync can tell it has
+    nothing new without asking the database."""
+    _, _, cleaned_data = _proposal_fields(data)
+    return sha1(json.dumps(cleaned_data, sort_keys=True)).hexdigest()
 
-    cleaned_data = {k:data[k] for k in keys}
+def get_proposal_sources():
+    q = 'SELECT id, source_etag, source_digest FROM proposals'
+    return {x.id:x for x in fetchall(q)}
 
+def add_proposal(data):
     """
     print 'Missing:', set(keys) - set(data.keys())
     print 'Extra:', set(data.keys()) - set(keys)
     """
+    return data['id'] if add_proposals([data]) else None
 
+_PROPOSAL_CHUNK = 500
 
-    q = 'SELECT * FROM proposals WHERE id=%s'
-    proposal = fetchone(q, data['id'])
-
-    if not proposal:
-        q = 'INSERT INTO proposals (id, author_emails, author_names, data, data_history) VALUES (%s, %s, %s, %s, %s)'
-        cloned_data = cleaned_data.copy()
-        cloned_data['when'] = datetime.datetime.now().isoformat()
-        execute(q, (data['id'], list(emails), list(names), Json(cleaned_data), Json([cloned_data])))
-        return data['id']
-
-    if proposal.data == cleaned_data:
-        return None
-
-    q = 'UPDATE proposals SET data=%s, data_history=%s, updated=now() WHERE id=%s'
-    new_data = cleaned_data.copy()
-    new_data['when'] = datetime.datetime.now().isoformat()
-    data_history = proposal.data_history
-    data_history.insert(0, new_data)
-    execute(q, (Json(cleaned_data), Json(data_history), data['id']))
+def add_proposals(proposals, etags=None):
+    """Upsert proposals, one statement per chunk. etags maps proposal id to
+    the ETag the API sent with it. Returns the ids that were new or changed;
+    each of those gets a row in proposal_revisions."""
+    etags = etags or {}
+    rv = []
+    rows = []
+    for data in proposals:
+        emails, names, cleaned_data = _proposal_fields(data)
+        rows.append({'id': data['id'], 'emails': emails, 'names': names,
+                        'data': cleaned_data, 'etag': etags.get(data['id']),
+                        'digest': proposal_digest(data)})
+        if len(rows) >= _PROPOSAL_CHUNK:
+            rv.extend(_upsert_proposals(rows))
+            rows = []
+    rv.extend(_upsert_proposals(rows))
+    return rv
 
-    return data['id']
+def _upsert_proposals(rows):
+    if not rows:
+        return []
+    #Rows whose data hasn't changed still pick up the digest and etag, but
+    #keep their updated time and don't get a revision. updated is only ever
+    #now() for the rows this statement inserted or changed.
+    q = """WITH written AS (
+            INSERT INTO proposals (id, author_emails, author_names, data,
+                                    source_etag, source_digest)
+                SELECT (x->>'id')::bigint,
+                    ARRAY(SELECT jsonb_array_elements_text(x->'emails')),
+                    ARRAY(SELECT jsonb_array_elements_text(x->'names')),
+                    x->'data', x->>'etag', x->>'digest'
+                FROM jsonb_array_elements(%s) AS x
+            ON CONFLICT (id) DO UPDATE SET
+                data = EXCLUDED.data,
+                updated = CASE WHEN proposals.data = EXCLUDED.data
+                    THEN proposals.updated ELSE now() END,
+                source_etag = EXCLUDED.source_etag,
+                source_digest = EXCLUDED.source_digest
+            WHERE proposals.data IS DISTINCT FROM EXCLUDED.data
+                OR proposals.source_digest IS DISTINCT FROM EXCLUDED.source_digest
+                OR proposals.source_etag IS DISTINCT FROM EXCLUDED.source_etag
+            RETURNING id, voters, data, updated = now() AS changed),
+        revisions AS (
+            INSERT INTO proposal_revisions (proposal, data)
+                SELECT id, data FROM written WHERE changed ORDER BY id)
+        SELECT id, voters, data FROM written WHERE changed"""
+    with transaction():
+        written = fetchall(q, Json(rows))
+    forget_users(set(v for x in written for v in x.voters or ()))
+    note_stats_write(len(written))
+    cache_markdown(x.data.get(k) for x in written for k in _MARKDOWN_FIELDS)
+    return [x.id for x in written]
+
+def _percentage(votes, total):
+    return "%0.2f" % (100.0*votes/total)
 
 def get_vote_percentage(email, id):
     q = '''SELECT COUNT(*) FROM proposals WHERE NOT withdrawn
-            AND NOT (lower(%s) = ANY(author_emails) )'''
+            AND NOT EXISTS (SELECT 1 FROM proposal_authors AS pa
+                            WHERE pa.proposal = proposals.id
+                            AND pa.email = lower(%s))'''
     total = scalar(q, email)
     q = 'SELECT COUNT(*) FROM votes WHERE voter=%s'
     votes = scalar(q, id)
-    return "%0.2f" % (100.0*votes/total)
+    return _percentage(votes, total)
 
 def get_all_proposal_ids():
     q = 'SELECT id FROM proposals'
     return [x.id for x in fetchall(q)]
 
+"""
+Rendered Markdown
+"""
+_MARKDOWN_FIELDS = ('description', 'notes')
+_MARKDOWN_TAGS = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'pre']
+#Part of every cache key; change it whenever _render_markdown's output would.
+_MARKDOWN_VERSION = '1'
+_MARKDOWN_CACHE_SIZE = int(os.environ.get('MARKDOWN_CACHE_SIZE', 4096))
+_MARKDOWN_DB = os.environ.get('MARKDOWN_DB_CACHE', '1') != '0'
+_MARKDOWN = OrderedDict()
+_MARKDOWN_LOCK = threading.Lock()
+
+def _set_target(attrs, new=False):
+    #bleach 2 and later key attributes by (namespace, name)
+    attrs[(None, u'target')] = u'_blank'
+    return attrs
+
+def _render_markdown(text):
+    import bleach
+    import markdown2
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    raw = bleach.clean(markdown2.markdown(text),
+                        tags=bleach.ALLOWED_TAGS+_MARKDOWN_TAGS)
+    return bleach.linkify(raw, callbacks=[_set_target])
+
+def _markdown_digest(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return sha1(_MARKDOWN_VERSION + text).hexdigest()
+
+def _remember_markdown(digest, html):
+    with _MARKDOWN_LOCK:
+        _MARKDOWN.pop(digest, None)
+        _MARKDOWN[digest] = html
+        while len(_MARKDOWN) > _MARKDOWN_CACHE_SIZE:
+            _MARKDOWN.popitem(last=False)
+
+def _store_markdown(rendered):
+    q = '''INSERT INTO markdown_cache (digest, html)
+            SELECT * FROM unnest(%(digests)s::varchar[], %(html)s::text[])
+            ON CONFLICT DO NOTHING'''
+    execute(q, digests=rendered.keys(), html=rendered.values())
+
+def render_markdown(text):
+    """Markdown as sanitized HTML. Each text is looked up by its hash in an
+    in-process LRU, then in the markdown_cache table, and only rendered if
+    neither has it."""
+    text = text or ''
+    digest = _markdown_digest(text)
+    with _MARKDOWN_LOCK:
+        html = _MARKDOWN.get(digest)
+    if html is None and _MARKDOWN_DB:
+        html = scalar('SELECT html FROM markdown_cache WHERE digest=%s', digest)
+    if html is None:
+        html = _render_markdown(text)
+        if _MARKDOWN_DB:
+            _store_markdown({digest: html})
+    _remember_markdown(digest, html)
+    return html
+
+def cache_markdown(texts):
+    """Render whichever of texts the markdown_cache table doesn't have yet,
+    so pages won't need to. Called as proposals are written; returns how
+    many were rendered."""
+    digests = {_markdown_digest(x):x for x in texts if x}
+    if not digests or not _MARKDOWN_DB:
+        return 0
+    q = 'SELECT digest FROM markdown_cache WHERE digest = ANY(%(digests)s)'
+    have = set(x.digest for x in fetchall(q, digests=digests.keys()))
+    rendered = {k:_render_markdown(v) for k, v in digests.items()
+                    if k not in have}
+    if rendered:
+        _store_markdown(rendered)
+    return len(rendered)
+
 """
 Screening Voting
 """
@@ -241,13 +669,20 @@ def vote(voter, proposal, scores, nominate=False):
     q = '''INSERT INTO votes (voter, proposal, scores, nominate)
             VALUES (%s, %s, %s, %s) RETURNING id'''
     try:
-        return scalar(q, voter, proposal, json.dumps(scores), nominate)
+        rv = scalar(q, voter, proposal, json.dumps(scores), nominate)
     except IntegrityError as e:
-        pass
-
-    q = '''UPDATE votes SET scores=%s, updated_on=now(), nominate=%s
-            WHERE voter=%s AND proposal=%s RETURNING id'''
-    return scalar(q, [[json.dumps(scores), nominate, voter, proposal]])
+        q = '''UPDATE votes SET scores=%s, updated_on=now(), nominate=%s
+                WHERE voter=%s AND proposal=%s RETURNING id'''
+        rv = scalar(q, [[json.dumps(scores), nominate, voter, proposal]])
+    q = 'DELETE FROM reviewleases WHERE voter=%s AND proposal=%s'
+    execute(q, voter, proposal)
+    forget_users([voter])
+    note_stats_write()
+    if rv and _SCORES['stamp'] is not None:
+        values = scores.values()
+        _score_vote(voter, proposal, sum(values), len(values),
+                        sum(1 for x in values if x == 2), nominate)
+    return rv
 
 def get_user_vote(userid, proposal):
     q = '''SELECT * FROM votes WHERE
@@ -264,21 +699,104 @@ def get_votes(proposal):
             WHERE proposal=%s'''
     return [_clean_vote(v) for v in fetchall(q, proposal)]
 
-def needs_votes(email, uid):
-    q = '''SELECT id, vote_count FROM proposals
-            WHERE NOT (lower(%s) = ANY(author_emails) )
-            AND NOT (%s = ANY(voters))
-            AND NOT withdrawn 
-            ORDER BY vote_count ASC'''
-    results = fetchall(q, email, uid)
-    if not results:
+_LEASE_MINUTES = 15
+
+def _pick_needs_votes(email, uid, skip_leased):
+    leased = '''AND NOT EXISTS (SELECT 1 FROM reviewleases AS rl
+                        WHERE rl.proposal = p.id AND rl.voter <> %(uid)s
+                        AND rl.expires > now())''' if skip_leased else ''
+    candidates = '''FROM proposals AS p
+            WHERE NOT withdrawn
+            AND NOT EXISTS (SELECT 1 FROM proposal_authors AS pa
+                            WHERE pa.proposal = p.id
+                            AND pa.email = lower(%(email)s))
+            AND NOT EXISTS (SELECT 1 FROM votes
+                            WHERE votes.voter = %(uid)s
+                            AND votes.proposal = p.id)
+            ''' + leased
+    q = '''SELECT id ''' + candidates + '''
+            AND vote_count = (SELECT min(vote_count) ''' + candidates + ''')
+            ORDER BY random() LIMIT 1'''
+    return scalar(q, email=email, uid=uid)
+
+def _lease(proposal, uid):
+    q = '''INSERT INTO reviewleases (proposal, voter, expires)
+            VALUES (%(proposal)s, %(uid)s,
+                    now() + %(minutes)s * interval '1 minute')
+            ON CONFLICT (proposal) DO UPDATE
+                SET voter = EXCLUDED.voter, expires = EXCLUDED.expires
+                WHERE reviewleases.voter = EXCLUDED.voter
+                    OR reviewleases.expires <= now()
+            RETURNING proposal'''
+    with transaction():
+        execute('DELETE FROM reviewleases WHERE voter=%s', uid)
+        return scalar(q, proposal=proposal, uid=uid, minutes=_LEASE_MINUTES)
+
+def needs_votes(email, uid, reserve=False):
+    """One of the least-reviewed proposals this user can still vote on.
+    With reserve, it's leased to them for a while so concurrent reviewers
+    are handed different proposals while there are any to hand out."""
+    rv = None
+    if reserve:
+        for attempt in range(3):
+            rv = _pick_needs_votes(email, uid, True)
+            if not rv or _lease(rv, uid):
+                break
+            rv = None
+    if not rv:
+        rv = _pick_needs_votes(email, uid, False)
+    if not rv:
         return None
-    min_vote = results[0].vote_count
-    results = [x for x in results if x.vote_count == min_vote]
-    rv = random.choice(results).id
-    l('needs_votes', uid=uid, id=rv)
+    l('needs_votes', uid=uid, id=rv, reserve=reserve)
     return rv
 
+def _from_json(d):
+    keys = sorted(d.keys())
+    return build_tuple(keys)(*(d[k] for k in keys))
+
+def screening_page_bundle(uid, proposal_id):
+    """Everything the screening page needs, in one round trip."""
+    q = '''WITH me AS (SELECT id, email FROM users WHERE id=%(uid)s)
+        SELECT row_to_json(p) AS proposal,
+            EXISTS (SELECT 1 FROM unread
+                    WHERE voter=%(uid)s AND proposal=p.id) AS unread,
+            (SELECT COALESCE(json_agg(d ORDER BY d.created, d.id), '[]')
+                FROM (SELECT discussion.*, users.display_name
+                        FROM discussion
+                        LEFT JOIN users ON (users.id=discussion.frm)
+                        WHERE discussion.proposal=p.id) AS d) AS discussion,
+            (SELECT COALESCE(json_agg(s ORDER BY s.id), '[]')
+                FROM standards AS s) AS standards,
+            (SELECT COALESCE(json_agg(v), '[]')
+                FROM (SELECT votes.*, users.display_name
+                        FROM votes LEFT JOIN users ON (votes.voter=users.id)
+                        WHERE votes.proposal=p.id) AS v) AS votes,
+            (SELECT COUNT(*) FROM votes, me WHERE votes.voter=me.id)
+                AS my_vote_count,
+            (SELECT COUNT(*) FROM proposals, me WHERE NOT withdrawn
+                AND NOT EXISTS (SELECT 1 FROM proposal_authors AS pa
+                                WHERE pa.proposal = proposals.id
+                                AND pa.email = lower(me.email))) AS eligible
+        FROM (SELECT ''' + _SCREENING_FIELDS + '''
+                FROM proposals WHERE id=%(proposal)s) AS p'''
+    raw = fetchone(q, uid=uid, proposal=proposal_id)
+    if not raw:
+        return None
+    votes = [_clean_vote(_from_json(v)) for v in raw.votes]
+    existing_vote = None
+    for v in votes:
+        if v.voter == uid:
+            existing_vote = v
+    T = build_tuple(('proposal', 'unread', 'discussion', 'standards',
+                        'existing_vote', 'votes', 'percent'))
+    return T(proposal=Proposal._from_dict(raw.proposal),
+                unread=raw.unread,
+                discussion=[_from_json(d) for d in raw.discussion],
+                standards=[_from_json(s) for s in raw.standards],
+                existing_vote=existing_vote,
+                votes=votes,
+                percent=_percentage(raw.my_vote_count, raw.eligible))
+
 def get_my_votes(uid):
     q = '''SELECT votes.*, proposals.updated > votes.updated_on AS updated,
             proposals.data->>'title' as title,
@@ -295,7 +813,137 @@ Screening stats
 def _score_weight_average(v):
     return int(100*sum(v)/(2.0*len(v)))
 
+"""
+scored_proposals keeps every vote's contribution to its proposal's scores in
+this process, so a page view only has to fold in votes written since the last
+one. Each vote contributes (score sum, score count, nominate-is-green sum,
+greenness, nominated); each proposal's totals are those summed, plus a vote
+count.
+"""
+_SCORES = {'votes': {}, 'totals': {}, 'stamp': None}
+
+#Votes are written in short autocommit transactions, so re-reading a few
+#seconds before the newest vote we've seen catches any that committed late.
+_SCORE_OVERLAP = datetime.timedelta(seconds=5)
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=FixedOffsetTimezone(offset=0))
+
+_VOTE_SCORE_COLUMNS = '''voter, proposal, nominate, updated_on,
+        (SELECT COALESCE(SUM(value::text::int), 0) FROM json_each(scores))
+            AS total,
+        (SELECT COUNT(*) FROM json_each(scores)) AS n,
+        (SELECT COUNT(*) FROM json_each(scores) WHERE value::text = '2')
+            AS twos'''
+
+def _vote_contribution(total, n, twos, nominate):
+    if nominate:
+        return (total, n, 2*n, 1.0, 1)
+    return (total, n, total, float(twos)/n if n else 0.0, 0)
+
+def _score_vote(voter, proposal, total, n, twos, nominate):
+    votes, totals = _SCORES['votes'], _SCORES['totals']
+    new = _vote_contribution(total, n, twos, nominate)
+    old = votes.get((voter, proposal))
+    if old == new:
+        return
+    current = totals.setdefault(proposal, [0, 0, 0, 0.0, 0, 0])
+    if old:
+        for i, x in enumerate(old):
+            current[i if i < 4 else 5] -= x
+        current[4] -= 1
+    for i, x in enumerate(new):
+        current[i if i < 4 else 5] += x
+    current[4] += 1
+    votes[(voter, proposal)] = new
+
+def _score_all(voters, proposals, total, n, twos, nominate):
+    """The vectorized full rebuild; each argument is a column of votes."""
+    import numpy as np
+    total = np.asarray(total, dtype=np.int64)
+    n = np.asarray(n, dtype=np.int64)
+    twos = np.asarray(twos, dtype=np.int64)
+    nominate = np.asarray(nominate, dtype=bool)
+
+    nom_green = np.where(nominate, 2*n, total)
+    greenness = np.where(nominate, 1.0,
+                            np.where(n > 0, twos/np.maximum(n, 1).astype(float),
+                                        0.0))
+    ids, inverse = np.unique(np.asarray(proposals, dtype=np.int64),
+                                return_inverse=True)
+    sums = [np.bincount(inverse, weights=column, minlength=len(ids))
+                for column in (total, n, nom_green, greenness,
+                                np.ones(len(inverse)), nominate)]
+    totals = {}
+    for k, pid in enumerate(ids.tolist()):
+        totals[pid] = [int(round(sums[0][k])), int(round(sums[1][k])),
+                        int(round(sums[2][k])), float(sums[3][k]),
+                        int(round(sums[4][k])), int(round(sums[5][k]))]
+    votes = dict(zip(zip(voters, proposals),
+                    zip(total.tolist(), n.tolist(), nom_green.tolist(),
+                        greenness.tolist(), nominate.astype(int).tolist())))
+    return votes, totals
+
+def rebuild_scores():
+    rows = fetchall('SELECT ' + _VOTE_SCORE_COLUMNS + ' FROM votes')
+    if rows:
+        columns = zip(*((r.voter, r.proposal, r.total, r.n, r.twos, r.nominate)
+                        for r in rows))
+        votes, totals = _score_all(*columns)
+        stamp = max(r.updated_on for r in rows)
+    else:
+        votes, totals, stamp = {}, {}, _EPOCH
+    _SCORES.update(votes=votes, totals=totals, stamp=stamp)
+    l('rebuild_scores', votes=len(votes))
+
+def _refresh_scores():
+    if _SCORES['stamp'] is None:
+        return rebuild_scores()
+    latest = scalar('SELECT MAX(updated_on) FROM votes')
+    if not latest or latest <= _SCORES['stamp']:
+        return
+    q = 'SELECT ' + _VOTE_SCORE_COLUMNS + ' FROM votes WHERE updated_on > %s'
+    for r in fetchall(q, _SCORES['stamp'] - _SCORE_OVERLAP):
+        _score_vote(r.voter, r.proposal, r.total, r.n, r.twos, r.nominate)
+    _SCORES['stamp'] = latest
+
+def _percent(total, count):
+    #The epsilon keeps float error from the running sums out of the truncation
+    return int(100*float(total)/count + 1e-9)
+
+def _rank_scores(totals, proposals):
+    rv = []
+    for p in proposals:
+        if p.id not in totals:
+            continue
+        score_sum, score_n, nom_green, greenness, votes, nominations = totals[p.id]
+        if not votes:
+            continue
+        rv.append({'id':p.id, 'score':_percent(score_sum, 2*score_n),
+            'nom_is_green':_percent(nom_green, 2*score_n),
+            'greenness':_percent(greenness, votes),
+        'nominations': nominations,
+        'title':p.title,
+        'batch_id': p.batch_id,
+        'batchgroup':p.batchgroup,
+        'accepted':p.accepted})
+    rv.sort(key=lambda x:-x['nom_is_green'])
+    for n, v in enumerate(rv):
+        v['delta'] = abs(v['score'] - v['nom_is_green'])
+        v['rank'] = n
+    return rv
+
 def scored_proposals():
+    _refresh_scores()
+    q = '''SELECT proposals.id, proposals.data->>'title' AS title,
+                    proposals.accepted,
+                    batchgroups.name as batchgroup,
+                    batchgroups.id as batch_id
+            FROM proposals
+            LEFT JOIN batchgroups ON (proposals.batchgroup = batchgroups.id)
+            WHERE proposals.vote_count > 0'''
+    return _rank_scores(_SCORES['totals'], fetchall(q))
+
+def _recompute_scored_proposals():
+    """The old from-scratch version, kept to check the cached totals."""
     q = '''SELECT scores, nominate, proposal, proposals.data->>'title' AS title,
                     proposals.accepted,
                     batchgroups.name as batchgroup,
@@ -303,17 +951,14 @@ def scored_proposals():
             FROM votes
             INNER JOIN proposals ON (votes.proposal = proposals.id)
             LEFT JOIN batchgroups ON (proposals.batchgroup = batchgroups.id)'''
-    votes = fetchall(q)
+    return _score_rows(fetchall(q))
+
+def _score_rows(votes):
     scores = defaultdict(list)
     nom_green = defaultdict(list)
     greenness = defaultdict(list)
     nominations = Counter()
     proposals_by_id = {v.proposal:v for v in votes}
-    """
-    titles = {v.proposal:v.title for v in votes}
-    batchgroups = {v.proposal:v.batchgroup for v in votes}
-    batch_ids = {v.proposal:v.batch_id for v in votes}
-    """
     for v in votes:
         scores[v.proposal].extend(v.scores.values())
         if v.nominate:
@@ -353,35 +998,32 @@ def _js_time(d):
     return int(time.mktime(d.timetuple()))*1000;
 
 def get_votes_by_day():
-    q = '''SELECT COUNT(*) as count, 
-            date_trunc('day', updated_on) AS day
-            FROM votes GROUP BY day'''
-    results = {x.day.date().isoformat():x.count for x in fetchall(q)}
-    full = pd.Series(results)
-    full.index = pd.DatetimeIndex(full.index)
-    full = full.reindex(pd.date_range(min(full.index),
-                                        max(full.index)), fill_value=0)
-    return [{'count':v, 'day':_js_time(k)} for k,v in full.iteritems()]
+    q = '''WITH counts AS (SELECT COUNT(*) as count,
+                        date_trunc('day', updated_on) AS day
+                        FROM votes GROUP BY day)
+            SELECT days.day::date AS day, COALESCE(counts.count, 0) AS count
+            FROM generate_series((SELECT MIN(day) FROM counts),
+                                    (SELECT MAX(day) FROM counts),
+                                    interval '1 day') AS days(day)
+            LEFT JOIN counts ON (counts.day = days.day)
+            ORDER BY days.day'''
+    return [{'count':x.count, 'day':_js_time(x.day)} for x in fetchall(q)]
 
 def coverage_by_age():
     q = '''SELECT COUNT(*) as total,
-            date_trunc('week', added_on) AS week,
-            vote_count FROM proposals GROUP BY week, vote_count
-            ORDER BY vote_count ASC'''
+            date_trunc('week', added_on)::date AS week,
+            vote_count FROM proposals GROUP BY week, vote_count'''
     result = defaultdict(dict)
+    weeks = set()
     for r in fetchall(q):
-        result[r.vote_count][r.week.date().isoformat()] = r.total
-    
-    df = pd.DataFrame(result).fillna(0)
-    df.index = pd.DatetimeIndex(df.index)
+        result[r.vote_count][r.week] = r.total
+        weeks.add(r.week)
 
-    result = {votes:series for votes, series in df.iteritems()}
-    rv = []
-    for key, series in result.iteritems():
-        rv.append({'key':key, 
-            'values': [{'week':_js_time(k), 'votes':v}
-                        for k,v in series.iteritems()]})
-    return rv
+    weeks = sorted(weeks)
+    return [{'key':key,
+            'values': [{'week':_js_time(week), 'votes':totals.get(week, 0)}
+                        for week in weeks]}
+            for key, totals in sorted(result.items())]
 
 def added_last_week():
     q = '''SELECT COUNT(*) AS total FROM proposals 
@@ -414,6 +1056,66 @@ def nomination_density():
     rv.sort(key=lambda x:-x[0])
     return rv
 
+"""
+Screening stats snapshot. Everything /screening/stats/ shows is computed
+together into one document, which is rebuilt in the background once it's
+older than STATS_MAX_AGE seconds or STATS_MAX_WRITES votes, discussion
+messages or proposal changes have happened since.
+"""
+_STATS_MAX_AGE = int(os.environ.get('STATS_MAX_AGE', 300))
+_STATS_MAX_WRITES = int(os.environ.get('STATS_MAX_WRITES', 50))
+_STATS = {'snapshot': None, 'writes': 0}
+_STATS_LOCK = threading.Lock()
+
+def note_stats_write(count=1):
+    _STATS['writes'] += count
+
+def build_stats_snapshot():
+    _STATS['writes'] = 0
+    forget_reviewer_activity()
+    users = [x._asdict() for x in active_reviewers()]
+    progress = [x._asdict() for x in screening_progress()]
+    doc = {'users': users,
+            'progress': progress,
+            'votes_when': get_votes_by_day(),
+            'coverage_by_age': coverage_by_age(),
+            'active_discussions': [x._asdict() for x in active_discussions()],
+            'nomination_density': nomination_density(),
+            'total_votes': sum(u['votes'] for u in users),
+            'total_proposals': sum(p['quantity'] for p in progress)}
+    etag = sha1(json.dumps(doc, sort_keys=True, default=str)).hexdigest()
+    snapshot = {'doc': doc, 'etag': etag,
+                'built': datetime.datetime.now(FixedOffsetTimezone(offset=0))}
+    _STATS['snapshot'] = snapshot
+    l('stats_snapshot', etag=etag)
+    return snapshot
+
+def _stats_stale(snapshot):
+    age = datetime.datetime.now(FixedOffsetTimezone(offset=0)) - snapshot['built']
+    return (age.total_seconds() > _STATS_MAX_AGE
+            or _STATS['writes'] >= _STATS_MAX_WRITES)
+
+def _refresh_stats():
+    try:
+        build_stats_snapshot()
+    except Exception:
+        logger.exception('stats_snapshot')
+    finally:
+        _STATS_LOCK.release()
+
+def stats_snapshot():
+    """The current snapshot, as a dict of doc, etag and built. A stale one is
+    still returned while a single background thread replaces it."""
+    snapshot = _STATS['snapshot']
+    if snapshot is None:
+        with _STATS_LOCK:
+            return _STATS['snapshot'] or build_stats_snapshot()
+    if _stats_stale(snapshot) and _STATS_LOCK.acquire(False):
+        refresh = threading.Thread(target=_refresh_stats)
+        refresh.daemon = True
+        refresh.start()
+    return snapshot
+
 """
 Batch
 """
@@ -421,31 +1123,52 @@ def toggle_lock_batch(id, lock):
     q = 'UPDATE batchgroups SET locked=%s WHERE id=%s'
     execute(q, lock, id)
 
+class ProposalListing(Row):
+    __slots__ = ('consensus',)
+
 def full_proposal_list(email):
     q = '''SELECT p.id, p.data->>'title' AS title, bg.id as batch_id, p.accepted,
             array_to_string(p.author_names, ', ') AS author_names,
             COALESCE(bg.name, '') AS batchgroup,
-            EXISTS (SELECT 1 FROM users
-                    WHERE users.email = ANY(p.author_emails)) as progcom_member
+            EXISTS (SELECT 1 FROM proposal_authors AS pa
+                    JOIN users ON (lower(users.email) = pa.email)
+                    WHERE pa.proposal = p.id) as progcom_member
             FROM proposals AS p 
             LEFT JOIN batchgroups AS bg ON (p.batchgroup = bg.id)
-            WHERE NOT (%s = ANY(p.author_emails))
+            WHERE NOT EXISTS (SELECT 1 FROM proposal_authors AS pa
+                                WHERE pa.proposal = p.id
+                                AND pa.email = lower(%s))
             ORDER BY p.id'''
-    raw = [x._asdict() for x in fetchall(q, email)]
+    raw = fetchmodels(ProposalListing, q, email)
     batch = get_batch_coverage()
     for proposal in raw:
-        if not proposal['batch_id']:
-            proposal['consensus'] = -1
+        if not proposal.batch_id:
+            proposal.consensus = -1
             continue
-        proposal['consensus'] = batch[proposal['batch_id']][proposal['id']]
+        #No batchnominations row yet, e.g. before batch_coverage.py rebuild
+        proposal.consensus = batch.get(proposal.batch_id, {}).get(proposal.id, 0)
     return raw
 
+def _place_in_batch(gid, pids):
+    """Keeps batchnominations in step with proposals.batchgroup; a proposal
+    nobody has nominated only has a row in the group it currently sits in."""
+    q = '''DELETE FROM batchnominations
+            WHERE proposal = ANY(%(pids)s::bigint[]) AND nominations = 0'''
+    execute(q, pids=list(pids))
+    if gid:
+        q = '''INSERT INTO batchnominations (batchgroup, proposal)
+                SELECT %(gid)s, unnest(%(pids)s::bigint[])
+                ON CONFLICT (batchgroup, proposal) DO NOTHING'''
+        execute(q, gid=gid, pids=list(pids))
+
 def create_group(name, proposals):
-    q = 'INSERT INTO batchgroups (name) VALUES (%s) RETURNING id'
-    id = scalar(q, name)
-    if proposals:
-        q = 'UPDATE proposals SET batchgroup=%s WHERE id = ANY(%s)'
-        execute(q, id, proposals)
+    with transaction():
+        q = 'INSERT INTO batchgroups (name) VALUES (%s) RETURNING id'
+        id = scalar(q, name)
+        if proposals:
+            q = 'UPDATE proposals SET batchgroup=%s WHERE id = ANY(%s)'
+            execute(q, id, proposals)
+            _place_in_batch(id, proposals)
     l('create_group', name=name, proposals=proposals, gid=id)
     return id
 
@@ -454,36 +1177,74 @@ def rename_batch_group(id, name):
     execute(q, name, id)
 
 def assign_proposal(gid, pid):
-    q = 'UPDATE proposals SET batchgroup=%s WHERE id = %s'
-    execute(q, gid, pid)
+    with transaction():
+        q = 'UPDATE proposals SET batchgroup=%s WHERE id = %s'
+        execute(q, gid, pid)
+        _place_in_batch(gid, [pid])
     l('assign_proposal', gid=gid, pid=pid)
 
 def vote_group(batchgroup, voter, accept):
     l('vote_group', gid=batchgroup, uid=voter, accept=accept)
-    try:
-        q = '''INSERT INTO batchvotes (batchgroup, voter, accept)
-                VALUES (%s, %s, %s)'''
-        execute(q, batchgroup, voter, accept)
+    with transaction():
+        #Every vote touches the group's counters, so take that lock up front.
+        q = 'SELECT id FROM batchgroups WHERE id=%s FOR UPDATE'
+        execute(q, batchgroup)
+        q = 'SELECT accept FROM batchvotes WHERE batchgroup=%s AND voter=%s'
+        previous = fetchone(q, batchgroup, voter)
+        if previous:
+            q = '''UPDATE batchvotes SET accept=%s, updated_on=now()
+                    WHERE batchgroup=%s AND voter=%s'''
+            execute(q, [[accept, batchgroup, voter]])
+        else:
+            q = '''INSERT INTO batchvotes (batchgroup, voter, accept)
+                    VALUES (%s, %s, %s)'''
+            execute(q, batchgroup, voter, accept)
+        _count_nominations(batchgroup, previous.accept if previous else None,
+                            accept)
+
+def _count_nominations(batchgroup, old, new):
+    q = '''UPDATE batchgroups SET voter_count = voter_count + %s,
+                                    skip_count = skip_count + %s
+            WHERE id=%s'''
+    new_voter = 1 if old is None else 0
+    skip = (0 if new else 1) - (1 if old is not None and not old else 0)
+    execute(q, new_voter, skip, batchgroup)
+
+    delta = Counter(new)
+    delta.subtract(old or [])
+    delta = {k:v for k,v in delta.items() if v}
+    if not delta:
         return
-    except IntegrityError as e:
-        pass
-    q = '''UPDATE batchvotes SET accept=%s, updated_on=now()
-            WHERE batchgroup=%s AND voter=%s'''
-    execute(q, [[accept, batchgroup, voter]])
+    proposals, changes = zip(*delta.items())
+    q = '''INSERT INTO batchnominations (batchgroup, proposal, nominations)
+            SELECT %s, d.proposal, d.change
+                FROM unnest(%s::bigint[], %s::int[]) AS d(proposal, change)
+            ON CONFLICT (batchgroup, proposal) DO UPDATE
+                SET nominations = batchnominations.nominations
+                                    + EXCLUDED.nominations'''
+    execute(q, batchgroup, list(proposals), list(changes))
+
+class BatchGroup(Row):
+    __slots__ = ('skip_consensus', 'talk_consensus', 'unread', 'proposals',
+                    'voters', 'msgs', 'nominated_talks', 'nominations',
+                    'consensus')
+
+class BatchStats(Row):
+    __slots__ = ('voters', 'msgs', 'nominated_talks', 'nominations',
+                    'consensus')
 
 def raw_list_groups():
-    rv = fetchall('''SELECT batchgroups.*, 
+    rv = fetchmodels(BatchGroup, '''SELECT batchgroups.*, 
         (SELECT COUNT(*) FROM proposals
             WHERE proposals.batchgroup = batchgroups.id) AS talk_count
             FROM batchgroups
             ORDER BY lower(name)''')
-    rv = [x._asdict() for x in rv]
     coverage = get_batch_coverage()
     for g in rv:
-        g['skip_consensus'] = coverage.get(g['id'], {}).get(None)
-        items = [v for k,v in coverage.get(g['id'], {}).items()
+        g.skip_consensus = coverage.get(g.id, {}).get(None)
+        items = [v for k,v in coverage.get(g.id, {}).items()
                                             if k != None and v != 0]
-        g['talk_consensus'] = sorted(items, reverse=True)
+        g.talk_consensus = sorted(items, reverse=True)
     return rv
 
 def get_batch_stats():
@@ -502,22 +1263,22 @@ def get_batch_stats():
 
     q = '''SELECT batchgroup as id, COUNT(id) as proposals FROM proposals
             WHERE batchgroup IS NOT NULL GROUP BY batchgroup'''
-    rv = [x._asdict() for x in fetchall(q)]
+    rv = fetchmodels(BatchStats, q)
     for group in rv:
-        id = group['id']
-        group['voters'] = batch_voters.get(id, 0)
-        group['msgs'] = message_count.get(id, 0)
+        id = group.id
+        group.voters = batch_voters.get(id, 0)
+        group.msgs = message_count.get(id, 0)
         nominated_talks = batchmap.get(id, defaultdict(int))
-        group['nominated_talks'] = len(nominated_talks)
-        group['nominations'] = sum(nominated_talks.values())
+        group.nominated_talks = len(nominated_talks)
+        group.nominations = sum(nominated_talks.values())
         max_nominations = max(nominated_talks.values()) if nominated_talks else 0
         max_nominations = max(max_nominations, no_forward.get(id, 0))
-        if group['voters']:
-            consensus = int((float(max_nominations)/group['voters'])*100)
+        if group.voters:
+            consensus = int((float(max_nominations)/group.voters)*100)
         else:
             consensus = 0
-        group['consensus'] = consensus
-    return {x['id']:x for x in rv}
+        group.consensus = consensus
+    return {x.id:x for x in rv}
 
 def list_groups(userid):
     user = get_user(userid)
@@ -527,25 +1288,31 @@ def list_groups(userid):
             FROM batchgroups as tg
             LEFT JOIN batchvotes as tv 
             ON (tg.id=tv.batchgroup AND tv.voter = %s)
-            WHERE NOT (%s = ANY(author_emails))
+            WHERE NOT EXISTS (SELECT 1 FROM proposal_authors AS pa
+                        JOIN proposals ON (proposals.id = pa.proposal)
+                        WHERE pa.email = lower(%s)
+                        AND proposals.batchgroup = tg.id)
             ORDER BY tg.locked, tg.name'''
-    return [x for x in fetchall(q, userid, user.email) if x.count]
+    return [x for x in fetchmodels(BatchGroup, q, userid, user.email)
+                if x.count]
 
 def get_group(batchgroup):
     return fetchone('''SELECT *,
             ARRAY(SELECT display_name FROM users
-                    WHERE users.email = ANY (batchgroups.author_emails))
+                    WHERE lower(users.email) IN (
+                        SELECT pa.email FROM proposal_authors AS pa
+                        JOIN proposals ON (proposals.id = pa.proposal)
+                        WHERE proposals.batchgroup = batchgroups.id))
                 AS progcom_members
             FROM batchgroups WHERE id=%s''', batchgroup)
 
-def get_group_proposals(batchgroup):
-    q = '''SELECT proposals.*, count(batchvotes.voter)
-            FROM proposals LEFT JOIN batchvotes 
-                ON (proposals.id = ANY(batchvotes.accept))
-            WHERE proposals.batchgroup=%s GROUP BY proposals.id'''
-    rv = fetchall(q, batchgroup)
-    rv = [_clean_proposal(x._asdict()) for x in rv]
-    return rv
+def get_group_proposals(batchgroup, fields='full'):
+    q = '''SELECT {}, count(batchvote_accepts.voter)
+            FROM proposals LEFT JOIN batchvote_accepts
+                ON (proposals.id = batchvote_accepts.proposal)
+            WHERE proposals.batchgroup=%s GROUP BY proposals.id
+            '''.format(_PROPOSAL_FIELDS[fields])
+    return fetchmodels(Proposal, q, batchgroup)
 
 def get_group_votes(batchgroup):
     q = '''SELECT batchvotes.accept, users.display_name
@@ -554,11 +1321,42 @@ def get_group_votes(batchgroup):
 
     return fetchall(q, batchgroup)
 
+def voters_by_proposal(votes):
+    """Display names of the voters who accepted each proposal, from the
+    output of get_group_votes."""
+    rv = defaultdict(list)
+    for v in votes:
+        for proposal in set(v.accept):
+            rv[proposal].append(v.display_name)
+    return rv
+
 def get_batch_vote(batchgroup, voter):
     q = 'SELECT * FROM batchvotes WHERE batchgroup=%s AND voter=%s'
     return fetchone(q, batchgroup, voter)
 
-def get_batch_coverage():
+def _consensus(count, total):
+    if not total:
+        return count
+    return int(100*float(count)/total)
+
+def get_batch_coverage(batchgroups=None):
+    q = '''SELECT bn.batchgroup, bn.proposal, bn.nominations,
+                    bg.voter_count, bg.skip_count
+            FROM batchnominations AS bn
+            INNER JOIN batchgroups AS bg ON (bn.batchgroup = bg.id)'''
+    if batchgroups is None:
+        rows = fetchall(q)
+    else:
+        q += ' WHERE bn.batchgroup = ANY(%(batchgroups)s)'
+        rows = fetchall(q, batchgroups=list(batchgroups))
+    groups = defaultdict(dict)
+    for row in rows:
+        group = groups[row.batchgroup]
+        group[None] = _consensus(row.skip_count, row.voter_count)
+        group[row.proposal] = _consensus(row.nominations, row.voter_count)
+    return groups
+
+def _recompute_batch_coverage():
     q = '''SELECT id, data->>'title' as title, author_names, batchgroup
             FROM proposals WHERE batchgroup IS NOT NULL'''
     groups = defaultdict(dict)
@@ -572,6 +1370,7 @@ def get_batch_coverage():
     for vote in votes:
         voter_count[vote.batchgroup] +=1
         if not vote.accept:
+            groups[vote.batchgroup].setdefault(None, 0)
             groups[vote.batchgroup][None] += 1
         for id in vote.accept:
             if id not in groups[vote.batchgroup]:
@@ -585,6 +1384,40 @@ def get_batch_coverage():
         batch.update({k:int(100*float(v)/total) for k,v in batch.iteritems()})
     return groups
 
+def rebuild_batch_coverage():
+    l('rebuild_batch_coverage')
+    with transaction():
+        execute('LOCK TABLE batchvotes IN SHARE MODE')
+        execute('DELETE FROM batchnominations')
+        q = '''INSERT INTO batchnominations (batchgroup, proposal, nominations)
+                SELECT batchgroup, proposal, SUM(n) FROM
+                    (SELECT batchgroup, id AS proposal, 0 AS n FROM proposals
+                        WHERE batchgroup IS NOT NULL
+                    UNION ALL
+                    SELECT batchgroup, unnest(accept), 1 FROM batchvotes) AS x
+                GROUP BY batchgroup, proposal'''
+        execute(q)
+        q = '''UPDATE batchgroups SET
+                voter_count = (SELECT COUNT(*) FROM batchvotes
+                                WHERE batchvotes.batchgroup = batchgroups.id),
+                skip_count = (SELECT COUNT(*) FROM batchvotes
+                                WHERE batchvotes.batchgroup = batchgroups.id
+                                AND cardinality(accept) = 0)'''
+        execute(q)
+
+def verify_batch_coverage():
+    """Every (batchgroup, proposal, expected, stored) where batchnominations
+    disagrees with a full recompute from batchvotes."""
+    expected = _recompute_batch_coverage()
+    stored = get_batch_coverage()
+    rv = []
+    for bg in set(expected.keys()) | set(stored.keys()):
+        want, have = expected.get(bg, {}), stored.get(bg, {})
+        for pid in set(want.keys()) | set(have.keys()):
+            if want.get(pid, 0) != have.get(pid, 0):
+                rv.append((bg, pid, want.get(pid), have.get(pid)))
+    return rv
+
 def get_my_pycon(user):
     q = 'SELECT batchgroup, accept FROM batchvotes WHERE voter=%s'
     votes = fetchall(q, user)
@@ -610,14 +1443,14 @@ def get_my_pycon(user):
                             'title': proposals[p].title,
                             'author_names':proposals[p].author_names,
                             'accepted': proposals[p].accepted,
-                            'consensus':coverage[v.batchgroup][p]})
+                            'consensus':coverage.get(v.batchgroup, {}).get(p, 0)})
         else:
             rv.append({'batch_id':v.batchgroup,
                         'batchgroup':bg_names[v.batchgroup],
                         'id':None,
                         'title':"Don't advance any from this group",
                         'author_names':'',
-                        'consensus': coverage[v.batchgroup][None]})
+                        'consensus': coverage.get(v.batchgroup, {}).get(None, 0)})
     return rv
 
 def change_acceptance(id, acceptance):
@@ -630,110 +1463,186 @@ Batch Discussion (this is just easier)
 
 def add_batch_message(frm, batch, body):
     l('add_batch_message', uid=frm, gid=batch, body=body)
-    q = '''INSERT INTO batchmessages (frm, batch, body)
-            VALUES (%s, %s, %s) RETURNING id'''
-    id = fetchone(q, frm, batch, body)
-    q = 'SELECT voter FROM batchvotes WHERE batchgroup=%s AND voter <> %s'
-    users = set(x.voter for x in fetchall(q, batch, frm))
-
-    q = 'INSERT INTO batchunread (batch, voter) VALUES (%s, %s)'
-    for user in users:
-        try:
-            execute(q, batch, user)
-        except IntegrityError:
-            pass #Already exists
+    with transaction():
+        q = '''INSERT INTO batchmessages (frm, batch, body)
+                VALUES (%s, %s, %s) RETURNING id'''
+        id = scalar(q, frm, batch, body)
+        q = '''WITH added AS (
+                    INSERT INTO batchunread (batch, voter)
+                    SELECT batchgroup, voter FROM batchvotes
+                        WHERE batchgroup=%(batch)s AND voter <> %(frm)s
+                    ON CONFLICT DO NOTHING
+                    RETURNING voter)
+                INSERT INTO unreadcounts (voter, batches)
+                    SELECT voter, 1 FROM added
+                ON CONFLICT (voter) DO UPDATE
+                    SET batches = unreadcounts.batches + 1'''
+        execute(q, batch=batch, frm=frm)
     return id
 
-def get_batch_messages(batch):
+#A message's id is handed out when it's inserted, but nobody sees it until
+#its transaction commits (for a batch message, after the unread fan-out), so
+#it can appear after one with a higher id. Reading after a since_id cursor
+#also returns the messages posted up to this many seconds before it, and
+#callers skip the ones they already have.
+_LATE_MESSAGE_SECONDS = 5
+
+def get_batch_messages(batch, since_id=0):
+    """The batch's messages, or only the ones after since_id; see
+    _LATE_MESSAGE_SECONDS for why that can include some from before it."""
     q = '''SELECT batchmessages.*, users.display_name 
             FROM batchmessages LEFT JOIN users ON (users.id=batchmessages.frm)
-            WHERE batchmessages.batch=%s ORDER BY batchmessages.created ASC'''
-    return fetchall(q, batch)
+            WHERE batchmessages.batch=%(batch)s
+                AND (batchmessages.id > %(since)s OR batchmessages.id < %(since)s AND batchmessages.created >
+                        (SELECT created FROM batchmessages WHERE id=%(since)s)
+                        - interval '1 second' * %(late)s)
+            ORDER BY batchmessages.created ASC, batchmessages.id ASC'''
+    return fetchall(q, batch=batch, since=since_id, late=_LATE_MESSAGE_SECONDS)
+
+def unread_counts(userid):
+    q = 'SELECT discussions, batches FROM unreadcounts WHERE voter=%s'
+    rv = fetchone(q, userid)
+    return (rv.discussions, rv.batches) if rv else (0, 0)
 
 def get_unread_batches(userid):
     q = 'SELECT batch from batchunread where voter=%s'
     return set(x.batch for x in fetchall(q, userid))
 
+def is_batch_unread(userid, batch):
+    q = 'SELECT 1 FROM batchunread WHERE voter=%s AND batch=%s'
+    return bool(scalar(q, userid, batch))
+
 def mark_batch_read(batch, user):
     l('mark_batch_read', gid=batch, uid=user)
-    q = 'DELETE FROM batchunread WHERE batch=%s AND voter=%s'
-    execute(q, batch, user)
+    q = '''WITH removed AS (
+                DELETE FROM batchunread WHERE batch=%(batch)s AND voter=%(user)s
+                RETURNING voter)
+            UPDATE unreadcounts
+                SET batches = batches - (SELECT COUNT(*) FROM removed)
+                WHERE voter=%(user)s'''
+    with transaction():
+        execute(q, batch=batch, user=user)
 
 """
 Discussion
 """
-_USER_FB_ITSD = itsdangerous.URLSafeSerializer(os.environ['ITSD_KEY'])
-_SENDGRID = sendgrid.SendGridAPIClient(apikey=os.environ['SENDGRID_API_KEY'])
-_EMAIL_FROM = os.environ['EMAIL_FROM']
-_WEB_HOST = os.environ['WEB_HOST']
+@_service
+def _user_fb_itsd():
+    import itsdangerous
+    return itsdangerous.URLSafeSerializer(os.environ['ITSD_KEY'])
+
+@_service
+def _sendgrid():
+    import sendgrid
+    return sendgrid.SendGridAPIClient(apikey=os.environ['SENDGRID_API_KEY'])
 
 _TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates')
-_JINJA = Environment(loader=FileSystemLoader(_TEMPLATE_PATH))
 
-def get_discussion(proposal):
+@_service
+def _jinja():
+    from jinja2 import Environment, FileSystemLoader
+    return Environment(loader=FileSystemLoader(_TEMPLATE_PATH))
+
+def get_discussion(proposal, since_id=0):
+    """The proposal's discussion, or only the messages after since_id; see
+    _LATE_MESSAGE_SECONDS."""
+    q = '''SELECT discussion.*, users.display_name
+           FROM discussion LEFT JOIN users ON (users.id=discussion.frm)
+            WHERE proposal=%(proposal)s
+                AND (discussion.id > %(since)s OR discussion.id < %(since)s AND discussion.created >
+                        (SELECT created FROM discussion WHERE id=%(since)s)
+                        - interval '1 second' * %(late)s)
+            ORDER BY created ASC, discussion.id ASC'''
+    return fetchall(q, proposal=proposal, since=since_id,
+                    late=_LATE_MESSAGE_SECONDS)
+
+def get_discussions(proposals):
     q = '''SELECT discussion.*, users.display_name
            FROM discussion LEFT JOIN users ON (users.id=discussion.frm)
-            WHERE proposal=%s ORDER BY created ASC'''
-    return fetchall(q, proposal)
+            WHERE proposal = ANY(%(proposals)s)
+            ORDER BY created ASC, discussion.id ASC'''
+    rv = {x:[] for x in proposals}
+    for row in fetchall(q, proposals=list(proposals)):
+        rv[row.proposal].append(row)
+    return rv
 
 def add_to_discussion(userid, proposal, body, feedback=False, name=None):
     l('add_to_discussion', uid=userid, id=proposal, body=body,
                             feedback=feedback, name=name)
-    q = 'SELECT voter FROM votes WHERE proposal=%s'
-    users = set(x.voter for x in fetchall(q, proposal))
-    q = 'SELECT frm FROM discussion WHERE proposal=%s AND frm IS NOT NULL'
-    users.update(x.frm for x in fetchall(q, proposal))
-
-    if userid in users:
-        users.remove(userid)
-
-    if userid:
-        q = '''INSERT INTO discussion(frm, proposal, body, feedback)
-                VALUES (%s, %s,%s,%s)'''
-        execute(q, userid, proposal, body, feedback)
-    else:
-        q = 'INSERT INTO discussion(proposal, body, name) VALUES (%s, %s, %s)'
-        execute(q, proposal, body, name)
-
-    if users:
-        q = '''INSERT INTO unread (proposal, voter) SELECT %s, %s
-                WHERE NOT EXISTS 
-                    (SELECT 1 FROM unread WHERE proposal=%s AND voter=%s)'''
-        execute(q, [(proposal, x, proposal, x) for x in users])
-
-    if feedback:
-        full_proposal = get_proposal(proposal)
-        email = _JINJA.get_template('email/feedback_notice.txt')
-        for to, key in generate_author_keys(proposal).items():
-            url = 'http://{}/feedback/{}'.format(_WEB_HOST, key)
-            edit_url = 'https://us.pycon.org/2017/proposals/{}/'.format(proposal)
-            rendered = email.render(proposal=full_proposal, body=body, 
-                                url=url, edit_url=edit_url) 
-            msg = {
-                "personalizations": [
-                    {
-                        "to": [{"email": to}],
-                        "subject": 'Feedback on Your PyCon Talk Proposal',
-                    }
-                ],
-                "from": {
-                    "email": _EMAIL_FROM,
-                    "name": "PyCon Program Committee"
-                },
-                "content": [
-                    {
-                        "type": "text/plain",
-                        "value": rendered,
-                    }
-                ]
-            }
-            l('filter_email_sent', api_result=_SENDGRID.client.mail.send.post(request_body=msg).body, to=to)
+    with transaction():
+        if userid:
+            q = '''INSERT INTO discussion(frm, proposal, body, feedback)
+                    VALUES (%s, %s,%s,%s) RETURNING id'''
+            id = scalar(q, userid, proposal, body, feedback)
+        else:
+            q = '''INSERT INTO discussion(proposal, body, name)
+                    VALUES (%s, %s, %s) RETURNING id'''
+            id = scalar(q, proposal, body, name)
+
+        q = '''WITH added AS (
+                    INSERT INTO unread (proposal, voter)
+                    SELECT %(proposal)s, voter FROM
+                        (SELECT voter FROM votes WHERE proposal=%(proposal)s
+                        UNION
+                        SELECT frm FROM discussion
+                            WHERE proposal=%(proposal)s AND frm IS NOT NULL)
+                        AS participants
+                    WHERE voter IS DISTINCT FROM %(frm)s
+                    ON CONFLICT DO NOTHING
+                    RETURNING voter)
+                INSERT INTO unreadcounts (voter, discussions)
+                    SELECT voter, 1 FROM added
+                ON CONFLICT (voter) DO UPDATE
+                    SET discussions = unreadcounts.discussions + 1
+                RETURNING voter'''
+        users = [x.voter for x in fetchall(q, proposal=proposal, frm=userid)]
+        if feedback:
+            _queue_feedback(id, proposal, body)
+    forget_users(users)
+    note_stats_write()
+    return id
+
+def _queue_feedback(id, proposal, body):
+    full_proposal = get_proposal(proposal, 'summary')
+    email = _jinja().get_template('email/feedback_notice.txt')
+    for to, key in generate_author_keys(proposal).items():
+        url = 'http://{}/feedback/{}'.format(os.environ['WEB_HOST'], key)
+        edit_url = 'https://us.pycon.org/2017/proposals/{}/'.format(proposal)
+        rendered = email.render(proposal=full_proposal, body=body, 
+                            url=url, edit_url=edit_url) 
+        msg = {
+            "personalizations": [
+                {
+                    "to": [{"email": to}],
+                    "subject": 'Feedback on Your PyCon Talk Proposal',
+                }
+            ],
+            "from": {
+                "email": os.environ['EMAIL_FROM'],
+                "name": "PyCon Program Committee"
+            },
+            "content": [
+                {
+                    "type": "text/plain",
+                    "value": rendered,
+                }
+            ]
+        }
+        if queue_email('feedback', id, msg):
+            l('filter_email_queued', id=id, to=to)
 
 
 def mark_read(userid, proposal):
     l('mark_read', uid=userid, id=proposal)
-    q = 'DELETE FROM unread WHERE voter=%s AND proposal=%s'
-    execute(q, userid, proposal)
+    q = '''WITH removed AS (
+                DELETE FROM unread WHERE voter=%(user)s AND proposal=%(proposal)s
+                RETURNING voter)
+            UPDATE unreadcounts
+                SET discussions = discussions - (SELECT COUNT(*) FROM removed)
+                WHERE voter=%(user)s'''
+    with transaction():
+        execute(q, user=userid, proposal=proposal)
+    forget_users([userid])
 
 def get_unread(userid):
     q = '''SELECT unread.proposal as id, proposals.data->>'title' as title
@@ -751,20 +1660,221 @@ def generate_author_keys(id):
     authors = fetchone(q, id)
     rv = {}
     for e, name in zip(authors.author_emails, authors.author_names):
-        rv[e] = _USER_FB_ITSD.dumps([name, id])
+        rv[e] = _user_fb_itsd().dumps([name, id])
     return rv
 
 def check_author_key(key):
     try:
-        return _USER_FB_ITSD.loads(key)
+        return _user_fb_itsd().loads(key)
     except Exception as e:
         return None, None
 
+"""
+Live discussion. One connection per process LISTENs for the notification
+every new batchmessages or discussion row sends (see message_notify in
+tables.sql), and wakes the streams waiting on that thread.
+"""
+_LISTEN_CHANNELS = ('batchmessages', 'discussion')
+
+class _Listener(object):
+    def __init__(self):
+        self.latest = {}
+        self.notified = Counter()
+        self.changed = threading.Condition()
+        self.listening = threading.Event()
+        thread = threading.Thread(target=self.run, name='listen_messages')
+        thread.daemon = True
+        thread.start()
+        self.listening.wait(10)
+
+    def connect(self):
+        #Its own connection, which would otherwise hold a pool slot forever
+        conn = _engine().raw_connection()
+        conn.detach()
+        conn = conn.connection
+        conn.autocommit = True
+        cursor = conn.cursor()
+        for channel in _LISTEN_CHANNELS:
+            cursor.execute('LISTEN {}'.format(channel))
+        return conn
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                self.listening.set()
+                while True:
+                    select.select([conn], [], [], 60)
+                    conn.poll()
+                    notifies = conn.notifies[:]
+                    del conn.notifies[:]
+                    self.heard(notifies)
+            except Exception as e:
+                #Including SQLAlchemy's errors from connect(), so a database
+                #restart doesn't end the thread
+                l('listen_messages_error', error=str(e))
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(1)
+
+    def heard(self, notifies):
+        with self.changed:
+            for n in notifies:
+                event = json.loads(n.payload)
+                key = (n.channel, event['key'])
+                self.latest[key] = max(self.latest.get(key, 0), event['id'])
+                self.notified[key] += 1
+            self.changed.notify_all()
+
+    def wait(self, channel, key, since_id, timeout):
+        deadline = time.time() + timeout
+        key = (channel, key)
+        with self.changed:
+            heard = self.notified[key]
+            while (self.latest.get(key, 0) <= since_id
+                    and self.notified[key] == heard):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+@_service
+def _listener():
+    return _Listener()
+
+def wait_for_message(channel, key, since_id, timeout):
+    """Block until the thread key (a batch for batchmessages, a proposal for
+    discussion) has a message after since_id, or any message is posted to it,
+    which could be a late one from before since_id; False if timeout seconds
+    pass first. A notification can be missed while the listener reconnects,
+    so callers should look for themselves after a timeout too."""
+    return _listener().wait(channel, key, since_id, timeout)
+
+"""
+Outbox
+"""
+_OUTBOX_BATCH = 100
+_OUTBOX_MAX_ATTEMPTS = 8
+_OUTBOX_MAX_BACKOFF = 3600
+_OUTBOX_LEASE = 600
+_SENDGRID_MAX_PERSONALIZATIONS = 1000
+
+def queue_email(kind, ref, msg):
+    """Leave msg in the outbox for send_outbox. Each kind of email goes to the
+    same recipients about the same ref (a proposal, a message, a user) once,
+    so queueing it again is harmless. Returns whether it was new."""
+    return bool(queue_emails([(kind, ref, msg)]))
+
+def queue_emails(emails):
+    """queue_email for a list of (kind, ref, msg) in one statement. Returns
+    how many were new."""
+    if not emails:
+        return 0
+    rows = [(kind, unicode(ref), u', '.join(sorted(x['email']
+                for p in msg['personalizations'] for x in p['to'])), Json(msg))
+            for kind, ref, msg in emails]
+    kinds, refs, tos, msgs = [list(x) for x in zip(*rows)]
+    q = '''INSERT INTO outbox (kind, ref, email, message)
+            SELECT * FROM unnest(%(kinds)s::varchar[], %(refs)s::text[],
+                                    %(tos)s::text[], %(msgs)s::jsonb[])
+            ON CONFLICT (kind, ref, email) DO NOTHING
+            RETURNING id'''
+    return len(fetchall(q, kinds=kinds, refs=refs, tos=tos, msgs=msgs))
+
+def _merge_messages(rows):
+    """Messages that differ only in their personalizations go out as one
+    request. Yields each request and the outbox ids it covers."""
+    merged = {}
+    for row in rows:
+        msg = dict(row.message)
+        personalizations = msg.pop('personalizations')
+        key = json.dumps(msg, sort_keys=True)
+        if key not in merged:
+            merged[key] = (row.id, msg, [])
+        merged[key][2].append((row.id, personalizations))
+    for first, msg, parts in sorted(merged.values()):
+        chunk, ids = [], []
+        for id, personalizations in parts:
+            if (chunk and len(chunk) + len(personalizations)
+                            > _SENDGRID_MAX_PERSONALIZATIONS):
+                yield dict(msg, personalizations=chunk), ids
+                chunk, ids = [], []
+            chunk.extend(personalizations)
+            ids.append(id)
+        yield dict(msg, personalizations=chunk), ids
+
+def _post_email(msg):
+    """Hand msg to SendGrid; returns what went wrong, or None."""
+    try:
+        response = _sendgrid().client.mail.send.post(request_body=msg)
+    except Exception as e:
+        #python_http_client's HTTPError keeps the status and reply separately
+        return u'{}: {}'.format(getattr(e, 'code', type(e).__name__),
+                                getattr(e, 'body', e))
+    if response.status_code >= 300:
+        return u'{}: {}'.format(response.status_code, response.body)
+
+def send_outbox(limit=_OUTBOX_BATCH):
+    """Send up to limit emails that are due. Rows are claimed for
+    _OUTBOX_LEASE seconds and committed before anything is posted, so more
+    than one worker can share the outbox and no transaction is open while
+    SendGrid is called. Each request is recorded as soon as it's been made,
+    so a worker that dies partway only leaves the one it was making to be
+    sent again once its lease runs out. A failure is tried again after a
+    doubling delay, up to _OUTBOX_MAX_ATTEMPTS times. Returns the number
+    sent and the number that failed."""
+    q = '''UPDATE outbox SET attempts=attempts+1,
+                next_attempt = now() + interval '1 second' * %(lease)s
+            WHERE id IN (SELECT id FROM outbox
+                            WHERE sent IS NULL AND attempts < %(attempts)s
+                                AND next_attempt <= now()
+                            ORDER BY id LIMIT %(limit)s
+                            FOR UPDATE SKIP LOCKED)
+            RETURNING id, message'''
+    rows = fetchall(q, lease=_OUTBOX_LEASE, attempts=_OUTBOX_MAX_ATTEMPTS,
+                    limit=limit)
+    sent = failed = 0
+    for msg, ids in _merge_messages(rows):
+        error = _post_email(msg)
+        if error:
+            l('outbox_send_failed', ids=ids, error=error)
+            q = '''UPDATE outbox SET error=%(error)s,
+                        next_attempt = now() + interval '1 second'
+                                * LEAST(%(backoff)s, 30 * 2 ^ (attempts - 1))
+                    WHERE id = ANY(%(ids)s)'''
+            execute(q, error=error, backoff=_OUTBOX_MAX_BACKOFF, ids=ids)
+            failed += len(ids)
+        else:
+            q = '''UPDATE outbox SET sent=now(), error=NULL
+                    WHERE id = ANY(%(ids)s)'''
+            execute(q, ids=ids)
+            sent += len(ids)
+    if rows:
+        l('send_outbox', sent=sent, failed=failed)
+    return sent, failed
+
+def get_outbox_failures():
+    """Emails that have run out of retries."""
+    q = '''SELECT id, kind, ref, email, attempts, error, created FROM outbox
+            WHERE sent IS NULL AND attempts >= %s ORDER BY id'''
+    return fetchall(q, _OUTBOX_MAX_ATTEMPTS)
+
 """
 Emails
 """
-_ADMIN_EMAILS = set(json.loads(os.environ['ADMIN_EMAILS']))
-_LOGIN_EMAIL_ITSD = itsdangerous.URLSafeTimedSerializer(os.environ['ITSD_KEY'],
+@_service
+def _admin_emails():
+    return set(json.loads(os.environ['ADMIN_EMAILS']))
+
+@_service
+def _login_email_itsd():
+    import itsdangerous
+    return itsdangerous.URLSafeTimedSerializer(os.environ['ITSD_KEY'],
                                                 salt='loginemail')
 
 def send_login_email(email):
@@ -774,9 +1884,9 @@ def send_login_email(email):
         l('failed_pw_reset_request', email=email)
         return False
 
-    body = _JINJA.get_template('email/login_email.txt')
-    key = _LOGIN_EMAIL_ITSD.dumps(user.id)
-    url = 'http://{}/user/login/{}/'.format(_WEB_HOST, key)
+    body = _jinja().get_template('email/login_email.txt')
+    key = _login_email_itsd().dumps(user.id)
+    url = 'http://{}/user/login/{}/'.format(os.environ['WEB_HOST'], key)
     body = body.render(url=url)
 
     msg = {
@@ -798,13 +1908,13 @@ def send_login_email(email):
         ]
     }
 
-    _SENDGRID.client.mail.send.post(request_body=msg)
+    queue_email('login', key, msg)
     l('successful_pw_reset_request', email=email, id=user.id)
     return True
 
 def test_login_string(s):
     try:
-        id = _LOGIN_EMAIL_ITSD.loads(s, max_age=60*20)
+        id = _login_email_itsd().loads(s, max_age=60*20)
     except Exception as e:
         l('bad_pw_reset_key', e=str(e), s=s)
         return False
@@ -818,7 +1928,7 @@ def email_approved(id):
             {
                 "to": [{"email": user.email}],
                 "subject": 'Welcome to the Program Committee Web App!',
-                "cc": [{"email": x} for x in _ADMIN_EMAILS],
+                "cc": [{"email": x} for x in _admin_emails()],
             }
         ],
         "from": {
@@ -828,21 +1938,21 @@ def email_approved(id):
         "content": [
             {
                 "type": "text/plain",
-                "value": _JINJA.get_template('email/welcome_user.txt').render(),
+                "value": _jinja().get_template('email/welcome_user.txt').render(),
             }
         ]
     }
 
-    _SENDGRID.client.mail.send.post(request_body=msg)
+    queue_email('approved', id, msg)
 
 def email_new_user_pending(email, name):
-    body = _JINJA.get_template('email/new_user_pending.txt').render(name=name,
+    body = _jinja().get_template('email/new_user_pending.txt').render(name=name,
                                                             email=email)
 
     msg = {
         "personalizations": [
             {
-                "to": [{"email": x} for x in _ADMIN_EMAILS],
+                "to": [{"email": x} for x in _admin_emails()],
                 "subject": 'New Progcom User',
             }
         ],
@@ -858,10 +1968,10 @@ def email_new_user_pending(email, name):
         ]
     }
 
-    _SENDGRID.client.mail.send.post(request_body=msg)
+    queue_email('new_user_pending', email.lower(), msg)
  
 def send_weekly_update():
-    body = _JINJA.get_template('email/weekly_email.txt')
+    body = _jinja().get_template('email/weekly_email.txt')
     body = body.render(new_proposal_count=added_last_week(),
                         updated_proposal_count=updated_last_week(),
                         votes_last_week=votes_last_week(),
@@ -887,7 +1997,8 @@ def send_weekly_update():
         ]
     }
 
-    _SENDGRID.client.mail.send.post(request_body=msg)
+    week = '{}-{}'.format(*datetime.date.today().isocalendar()[:2])
+    queue_email('weekly_update', week, msg)
 
 
 """
@@ -919,59 +2030,263 @@ def _get_words(s):
     s = re.sub("[^a-z]", " ", s)
     return [x for x in s.lower().split() if x and x not in _NLTK_ENGLISH_STOPWORDS]
 
-def _get_raw_docs():
+def _doc_words(data):
     ignore_keys = {'id', 'recording_release', 'duration'}
+    return _get_words(' '.join(v for k,v in data.items()
+                                    if k not in ignore_keys))
+
+def _get_raw_docs():
     q = 'SELECT id, data FROM proposals'
     raw_documents = fetchall(q)
     rv = {}
     all_words = Counter()
     for row in raw_documents:
-        rv[row.id] = _get_words(' '.join(v for k,v in row.data.items() 
-                                                if k not in ignore_keys))
+        rv[row.id] = _doc_words(row.data)
         all_words.update(set(rv[row.id]))
 
     useful_words = set(k for k,v in all_words.items() if v > 1)
 
-    ids, words = zip(*{k:[x for x in v if x in useful_words]
-                                for k,v in rv.iteritems()}.items())
+    ids, words = zip(*sorted({k:[x for x in v if x in useful_words]
+                                for k,v in rv.iteritems()}.items()))
     return ids, words
 
-def get_proposals_auto_grouped(topics_count=100, threshold=.5):
+_TOPIC_NEIGHBORS = 10
+_TOPIC_CHUNK = 256
+
+def _nearest_neighbors(vectors, threshold, k=_TOPIC_NEIGHBORS, chunk=_TOPIC_CHUNK):
+    """For each row of the unit-length vectors, the indexes of up to k other
+    rows with a cosine similarity over threshold, best first. Only a chunk
+    of rows is ever compared against the rest at once."""
+    import numpy as np
+    rv = [[] for _ in range(len(vectors))]
+    for start in range(0, len(vectors), chunk):
+        sims = np.dot(vectors[start:start+chunk], vectors.T)
+        hits = sims > threshold
+        diagonal = np.arange(len(sims))
+        hits[diagonal, diagonal + start] = False
+        rows, cols = np.nonzero(hits)
+        #Best first within each row, ties going to the lower index
+        order = np.lexsort((cols, -sims[rows, cols], rows))
+        rows, cols = rows[order], cols[order]
+        keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < k
+        for row, col in zip(rows[keep], cols[keep]):
+            rv[start + row].append(col)
+    return rv
+
+def _find(parents, x):
+    while parents[x] != x:
+        parents[x] = parents[parents[x]]
+        x = parents[x]
+    return x
+
+def _group_neighbors(ids, vectors, threshold):
+    """Union-find over the neighbor pairs, so grouping is transitive and
+    doesn't depend on the order we visit proposals in. Groups are numbered
+    by their lowest proposal id."""
+    parents = range(len(ids))
+    for frm, neighbors in enumerate(_nearest_neighbors(vectors, threshold)):
+        for to in neighbors:
+            a, b = _find(parents, frm), _find(parents, to)
+            if a != b:
+                parents[max(a, b)] = min(a, b)
+
+    roots = [_find(parents, n) for n in range(len(ids))]
+    lowest = {}
+    for n in sorted(range(len(ids)), key=lambda n: ids[n]):
+        lowest.setdefault(roots[n], len(lowest))
+    return {x:lowest[roots[n]] for n, x in enumerate(ids)}
+
+"""
+The dictionary, models and similarity index live on disk under
+TOPIC_MODEL_DIR, named after a hash of every proposal's data. manifest.json
+points at the current set, and carries the per-proposal digests, so
+pull_updates.py can fold in just the proposals that changed. Web requests
+only ever read what it last saved.
+"""
+_TOPIC_MODEL_DIR = os.environ.get('TOPIC_MODEL_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topic_model'))
+#Folding in can't take old versions of a proposal back out of the LSI, so
+#start over once enough of the corpus has been folded in.
+_TOPIC_REBUILD_FRACTION = .25
+_TOPIC_THRESHOLD = .5
+_TOPIC_MODEL = {}
+_TOPIC_LOCK = threading.Lock()
+
+def _topic_path(name):
+    return os.path.join(_TOPIC_MODEL_DIR, name)
+
+def _topic_digests():
+    q = 'SELECT id, md5(data::text) AS digest FROM proposals'
+    digests = {x.id:x.digest for x in fetchall(q)}
+    corpus_hash = sha1(json.dumps(sorted(digests.items()))).hexdigest()
+    return corpus_hash, digests
+
+def _read_topic_manifest():
+    try:
+        with open(_topic_path('manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    manifest['digests'] = {int(k):v for k,v in manifest['digests'].items()}
+    manifest['groupings'] = {k:{int(p):g for p,g in v.items()}
+                                for k,v in manifest['groupings'].items()}
+    return manifest
+
+def _load_topic_model(corpus_hash):
+    from gensim import corpora, models
+    from gensim.similarities.docsim import MatrixSimilarity
+    path = lambda ext: _topic_path('{}.{}'.format(corpus_hash, ext))
+    with open(path('docs'), 'rb') as f:
+        ids, bows = pickle.load(f)
+    return (corpora.Dictionary.load(path('dictionary')),
+            models.TfidfModel.load(path('tfidf')),
+            models.LsiModel.load(path('lsi')),
+            MatrixSimilarity.load(path('index')),
+            ids, bows)
+
+def _load_topic_index(corpus_hash):
+    from gensim.similarities.docsim import MatrixSimilarity
+    with open(_topic_path('{}.docs'.format(corpus_hash)), 'rb') as f:
+        ids, _ = pickle.load(f)
+    return MatrixSimilarity.load(_topic_path('{}.index'.format(corpus_hash))), ids
+
+def _save_topic_model(manifest, dictionary, tfidf, lsi, ids, bows):
+    from gensim.similarities.docsim import MatrixSimilarity
+    if not os.path.isdir(_TOPIC_MODEL_DIR):
+        os.makedirs(_TOPIC_MODEL_DIR)
+    corpus_hash = manifest['hash']
+    path = lambda ext: _topic_path('{}.{}'.format(corpus_hash, ext))
+
+    vectors = list(lsi[tfidf[bows]])
+    index = MatrixSimilarity(vectors, num_features=lsi.num_topics)
+    dictionary.save(path('dictionary'))
+    tfidf.save(path('tfidf'))
+    lsi.save(path('lsi'))
+    index.save(path('index'))
+    with open(path('docs'), 'wb') as f:
+        pickle.dump((ids, bows), f, -1)
+
+    key = str(_TOPIC_THRESHOLD)
+    manifest['groupings'] = {key: _group_neighbors(ids, index.index,
+                                                    _TOPIC_THRESHOLD)}
+    try:
+        replaced = os.path.getmtime(_topic_path('manifest.json'))
+    except OSError:
+        replaced = None
+    tmp = _topic_path('manifest.json.{}'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp, _topic_path('manifest.json'))
+
+    #Files newer than the manifest we replaced may be another process's
+    #model, still being written
+    for name in os.listdir(_TOPIC_MODEL_DIR):
+        if (replaced is None or name.startswith('manifest.json')
+                or name.startswith(corpus_hash)):
+            continue
+        try:
+            if os.path.getmtime(_topic_path(name)) <= replaced:
+                os.remove(_topic_path(name))
+        except OSError:
+            pass
+
+    l('topic_model_saved', hash=corpus_hash, documents=len(ids),
+        folded=manifest['folded'])
+    return manifest
+
+def build_topic_model(topics_count=100):
+    from gensim import corpora, models
+    corpus_hash, digests = _topic_digests()
     ids, words = _get_raw_docs()
 
     dictionary = corpora.Dictionary(words)
-    corpus = [dictionary.doc2bow(x) for x in words]
-    tfidf = models.TfidfModel(corpus)
-    corpus_tfidf = tfidf[corpus]
-    lsi = models.LsiModel(corpus_tfidf, id2word=dictionary,
+    bows = [dictionary.doc2bow(x) for x in words]
+    tfidf = models.TfidfModel(bows)
+    lsi = models.LsiModel(tfidf[bows], id2word=dictionary,
                             num_topics=topics_count)
-    lsi_corpus = lsi[corpus_tfidf]
-
-    ms = MatrixSimilarity(lsi_corpus)
-
-    neighbors = {}
-    for frm, row in zip(ids, lsi_corpus):
-        neighbors[frm] = [ids[n] for n, match in enumerate(ms[row])
-                            if match > threshold and ids[n] != frm]
-
-    results = []
-    groups = {}
-    for root, children in neighbors.items():
-        target = groups.get(root, None)
-        if not target:
-            target = set()
-            results.append(target)
-        target.add(root)
-        target.update(children)
-        for c in children:
-            groups[c] = target
 
-    rv = {}
-    for n, row in enumerate(results):
-        for x in row:
-            rv[x] = n
+    manifest = {'hash': corpus_hash, 'topics': topics_count,
+                'digests': digests, 'folded': 0}
+    return _save_topic_model(manifest, dictionary, tfidf, lsi, list(ids), bows)
 
-    return rv
+def update_topic_model(topics_count=100):
+    """Bring the stored model up to date with the proposals table, folding
+    changed proposals into the existing LSI where we can."""
+    corpus_hash, digests = _topic_digests()
+    if not digests:
+        return None
+    manifest = _read_topic_manifest()
+    if manifest and manifest['topics'] == topics_count:
+        if manifest['hash'] == corpus_hash:
+            return manifest
+        old = manifest['digests']
+        changed = [k for k,v in digests.items() if old.get(k) != v]
+        removed = set(old) - set(digests)
+        folded = manifest['folded'] + len(changed) + len(removed)
+        if folded <= _TOPIC_REBUILD_FRACTION*len(digests):
+            return _fold_topic_model(manifest, corpus_hash, digests,
+                                        changed, removed, folded)
+    return build_topic_model(topics_count)
+
+def _fold_topic_model(manifest, corpus_hash, digests, changed, removed, folded):
+    dictionary, tfidf, lsi, _, ids, bows = _load_topic_model(manifest['hash'])
+    docs = dict(zip(ids, bows))
+    for x in removed:
+        docs.pop(x, None)
+
+    if changed:
+        #New words aren't in the dictionary, so doc2bow drops them; they'll
+        #show up at the next full rebuild.
+        q = 'SELECT id, data FROM proposals WHERE id = ANY(%(ids)s)'
+        new = {x.id:dictionary.doc2bow(_doc_words(x.data))
+                    for x in fetchall(q, ids=list(changed))}
+        lsi.add_documents(tfidf[new.values()])
+        docs.update(new)
+
+    ids = sorted(docs)
+    manifest = {'hash': corpus_hash, 'topics': manifest['topics'],
+                'digests': digests, 'folded': folded}
+    return _save_topic_model(manifest, dictionary, tfidf, lsi, ids,
+                                [docs[x] for x in ids])
+
+def _saved_topic_manifest():
+    """The last manifest saved, re-read only when manifest.json changes."""
+    try:
+        mtime = os.path.getmtime(_topic_path('manifest.json'))
+    except OSError:
+        return None
+    if _TOPIC_MODEL.get('mtime') != mtime:
+        _TOPIC_MODEL.update(manifest=_read_topic_manifest(), mtime=mtime)
+    return _TOPIC_MODEL['manifest']
+
+def _refresh_topic_model(topics_count):
+    try:
+        update_topic_model(topics_count)
+    except Exception:
+        logger.exception('update_topic_model')
+    finally:
+        _TOPIC_LOCK.release()
+
+def get_proposals_auto_grouped(topics_count=100, threshold=_TOPIC_THRESHOLD):
+    """Groups from the last saved topic model, even if proposals have changed
+    since; pull_updates.py folds those in. Until there's a model with
+    topics_count topics, one is built in the background and nothing is
+    grouped."""
+    manifest = _saved_topic_manifest()
+    if not manifest or manifest['topics'] != topics_count:
+        if _TOPIC_LOCK.acquire(False):
+            refresh = threading.Thread(target=_refresh_topic_model,
+                                        args=(topics_count,))
+            refresh.daemon = True
+            refresh.start()
+        return {}
+
+    key = str(threshold)
+    if key not in manifest['groupings']:
+        index, ids = _load_topic_index(manifest['hash'])
+        manifest['groupings'][key] = _group_neighbors(ids, index.index,
+                                                        threshold)
+    return manifest['groupings'][key]
 
 
 """
@@ -999,14 +2314,17 @@ def get_schedule():
         rv = fetchall(q)
     return rv
 
-_ROOMS = json.loads(os.environ['ROOMS'])
-_ROOM_SCHEDULES = json.loads(os.environ['ROOM_SCHEDULES'])
+@_service
+def _rooms():
+    """Each room, and the slots its type of room is open for on each day."""
+    schedules = json.loads(os.environ['ROOM_SCHEDULES'])
+    return {room: schedules[str(room_type)] for room, room_type
+                in json.loads(os.environ['ROOMS']).items()}
 
 def build_schedule():
     q = '''INSERT INTO schedules (day, room, time, duration)
             VALUES (%s, %s, %s, %s)'''
-    for room, room_type in _ROOMS.items():
-        schedule = _ROOM_SCHEDULES[str(room_type)]
+    for room, schedule in _rooms().items():
         for day, slots in enumerate(schedule):
             for when, length in slots.items():
                 execute(q, day, room, when, length)
@@ -1034,12 +2352,14 @@ def get_accepted():
 Confirmation
 """
 
-_CONFIRMATION_ITSD = itsdangerous.URLSafeSerializer(os.environ['ITSD_KEY'],
-                                                            salt='ack')
+@_service
+def _confirmation_itsd():
+    import itsdangerous
+    return itsdangerous.URLSafeSerializer(os.environ['ITSD_KEY'], salt='ack')
 
 def acknowledge_confirmation(s):
     try:
-        id = _CONFIRMATION_ITSD.loads(s)
+        id = _confirmation_itsd().loads(s)
     except:
         l('failed_acknowledge_confirm', s=s)
         return 0
@@ -1047,72 +2367,103 @@ def acknowledge_confirmation(s):
             WHERE id=%s RETURNING proposal'''
     return scalar(q, id)
 
-def send_emails():
-    accepted = _JINJA.get_template('email/accept.txt')
-    decline = _JINJA.get_template('email/decline.txt')
-    acceptance = 0
-    declined = 0
-    q = 'SELECT proposal, email FROM confirmations'
-    already_sent = {(x.proposal, x.email) 
-                        for x in fetchall(q)}
-    for p in fetchall('SELECT * FROM proposals'):
-        for name, email in zip(p.author_names, p.author_emails):
-            if not email or '@' not in email:
-                continue
-            if (p.id, email) in already_sent:
-                print 'ALREADY SENT PROPOSAL #{} TO {}'.format(p.id, email)
-                continue
-            if not p.accepted:
-                text = decline.render(name=name, title=p.data['title'])
-                msg = {
-                    "personalizations": [
-                        {
-                            "to": [{"email": email}],
-                            "subject": u'PyCon 2017: Proposal Decision -- '+p.data['title'],
-                        }
-                    ],
-                    "from": {
-                        "email": "njl@njl.us",
-                        "name": "Ned Jackson Lovely"
-                    },
-                    "content": [
-                        {
-                            "type": "text/plain",
-                            "value": text,
-                        }
-                    ]
-                }
-
-                print _SENDGRID.client.mail.send.post(request_body=msg).body
-                declined +=1
-                continue
-            q = '''INSERT INTO confirmations (proposal, email)
-                    VALUES (%s, %s) RETURNING id'''
-            id = scalar(q, p.id, email)
-            key = _CONFIRMATION_ITSD.dumps(id)
-            url = 'http://{}/confirmation/{}/'.format(_WEB_HOST, key)
-            text = accepted.render(name=name, title=p.data['title'], url=url)
-            msg = {
-                "personalizations": [
-                    {
-                        "to": [{"email": email}],
-                        "subject": u'PyCon 2017: Talk Acceptance -- '+p.data['title'],
-                    }
-                ],
-                "from": {
-                    "email": "njl@njl.us",
-                    "name": "Ned Jackson Lovely"
-                },
-                "content": [
-                    {
-                        "type": "text/plain",
-                        "value": text,
-                    }
-                ]
+_DECISION_BATCH = 500
+_DECISION_SUBJECTS = {'accept': u'PyCon 2017: Talk Acceptance -- ',
+                        'decline': u'PyCon 2017: Proposal Decision -- '}
+
+def _decision_message(kind):
+    """The accept or decline email, rendered once. Each recipient's name,
+    title and confirmation link are filled in by SendGrid from their
+    personalization's substitutions, so the whole run is one message body
+    and send_outbox can send it to a thousand people per request."""
+    template = _jinja().get_template('email/{}.txt'.format(kind))
+    return {
+        "from": {
+            "email": "njl@njl.us",
+            "name": "Ned Jackson Lovely"
+        },
+        "content": [
+            {
+                "type": "text/plain",
+                "value": template.render(name='-name-', title='-title-',
+                                            url='-url-'),
             }
+        ]
+    }
 
-            print _SENDGRID.client.mail.send.post(request_body=msg).body
+def _pending_decisions():
+    """Every author of every proposal, less those whose decision email is
+    already in the outbox."""
+    q = '''SELECT p.id, p.data->>'title' AS title,
+                CASE WHEN p.accepted THEN 'accept' ELSE 'decline' END AS kind,
+                a.name, a.email
+            FROM proposals AS p,
+                unnest(p.author_names, p.author_emails) AS a(name, email)
+            WHERE position('@' IN a.email) > 0
+                AND NOT EXISTS (SELECT 1 FROM outbox AS o
+                    WHERE o.kind IN ('accept', 'decline')
+                        AND o.ref = p.id::text AND o.email = a.email)
+            ORDER BY p.id, a.email'''
+    return fetchall(q)
 
-            acceptance +=1
-    print 'Declined: {}'.format(declined)
-    print 'Accepted: {}'.format(acceptance)
+def _confirmation_ids(recipients):
+    """A confirmations row for each accepted (proposal, email); existing
+    rows are reused, so a rerun links to the same confirmation."""
+    if not recipients:
+        return {}
+    proposals = [x.id for x in recipients]
+    emails = [x.email for x in recipients]
+    q = '''INSERT INTO confirmations (proposal, email)
+            SELECT * FROM unnest(%(proposals)s::bigint[], %(emails)s::varchar[])
+            ON CONFLICT (proposal, email) DO NOTHING'''
+    execute(q, proposals=proposals, emails=emails)
+    q = '''SELECT id, proposal, email FROM confirmations
+            WHERE (proposal, email) IN (SELECT * FROM
+                unnest(%(proposals)s::bigint[], %(emails)s::varchar[]))'''
+    rows = fetchall(q, proposals=proposals, emails=emails)
+    return {(x.proposal, x.email):x.id for x in rows}
+
+def send_emails(dry_run=False):
+    """Queue an acceptance or decline for every author who hasn't been sent
+    one, _DECISION_BATCH recipients per transaction; outbox_worker.py sends
+    them. The outbox is the ledger, so a run that dies partway can just be
+    run again. A dry run builds every message without saving anything, and
+    reports how fast that went and how many SendGrid requests it would
+    take."""
+    started = time.time()
+    messages = {k:_decision_message(k) for k in _DECISION_SUBJECTS}
+    pending = _pending_decisions()
+    stats = Counter()
+    for n in range(0, len(pending), _DECISION_BATCH):
+        batch = pending[n:n+_DECISION_BATCH]
+        with transaction():
+            if dry_run:
+                ids = {}
+            else:
+                ids = _confirmation_ids([x for x in batch
+                                            if x.kind == 'accept'])
+            emails = []
+            for x in batch:
+                url = ''
+                if (x.id, x.email) in ids:
+                    key = _confirmation_itsd().dumps(ids[(x.id, x.email)])
+                    url = 'http://{}/confirmation/{}/'.format(
+                                                os.environ['WEB_HOST'], key)
+                personalization = {
+                    "to": [{"email": x.email}],
+                    "subject": _DECISION_SUBJECTS[x.kind] + x.title,
+                    "substitutions": {"-name-": x.name, "-title-": x.title,
+                                        "-url-": url},
+                }
+                msg = dict(messages[x.kind], personalizations=[personalization])
+                emails.append((x.kind, x.id, msg))
+                stats[x.kind] += 1
+            if not dry_run:
+                stats['queued'] += queue_emails(emails)
+    per_request = min(_OUTBOX_BATCH, _SENDGRID_MAX_PERSONALIZATIONS)
+    stats['requests'] = sum(-(-stats[k] // per_request)
+                                for k in _DECISION_SUBJECTS)
+    stats['seconds'] = round(time.time() - started, 3)
+    stats['per_second'] = round(len(pending) / max(stats['seconds'], .001))
+    l('send_emails', dry_run=dry_run, **stats)
+    return stats
@@ -1,13 +1,14 @@
 import os.path
 import random
+import threading
 
 import pytest
 import mock
+from sqlalchemy.exc import OperationalError
 
 import logic as l
 
-l._S_OLD = l._SENDGRID
-l._SENDGRID = mock.Mock()
+l._SERVICES['_sendgrid'] = mock.Mock()
 
 
 @pytest.fixture(autouse=True)
@@ -15,7 +16,16 @@ def transact():
     """Since the whole point of bcrypt is to be slow, it helps to dial the knob
         down while testing."""
     l._SALT_ROUNDS=4
-    e = l._e
+    l._USER_CACHE.clear()
+    l.forget_reviewer_activity()
+    l._STATS.update(snapshot=None, writes=0)
+    l._SCORES.update(votes={}, totals={}, stamp=None)
+    l._TOPIC_MODEL.clear()
+    l._MARKDOWN.clear()
+    if '_listener' in l._SERVICES:
+        l._SERVICES['_listener'].latest.clear()
+        l._SERVICES['_listener'].notified.clear()
+    e = l._engine()
     q = "SELECT tablename FROM pg_tables WHERE schemaname='public'"
     for table in e.execute(q).fetchall():
         table = table[0]
@@ -203,6 +213,67 @@ def test_discussion():
     assert l.get_discussion(proposal)[-1].body == 'LOREM IPSUM'
     assert l.get_discussion(proposal)[0].body == 'Lorem ipsum'
 
+def test_wait_for_message():
+    l.add_proposal(data)
+    uid = l.add_user('bob@example.com', 'Bob', 'bob')
+    l.approve_user(uid)
+    gid = l.create_group('Group', [data['id']])
+
+    assert not l.wait_for_message('discussion', data['id'], 0, 0.1)
+    first = l.add_to_discussion(uid, data['id'], 'Lorem ipsum')
+    assert l.wait_for_message('discussion', data['id'], 0, 5)
+    assert not l.wait_for_message('discussion', data['id'], first, 0.1)
+    second = l.add_to_discussion(uid, data['id'], 'dolor sit')
+    assert [x.body for x in l.get_discussion(data['id'], first)] == ['dolor sit']
+    #Messages from just before the cursor come back too, in case they
+    #committed after it
+    assert [x.id for x in l.get_discussion(data['id'], second)] == [first]
+    l.execute('''UPDATE discussion SET created = created - interval '1 minute'
+                    WHERE id=%s''', first)
+    assert not l.get_discussion(data['id'], second)
+
+    #A message that commits after one with a higher id is still found, and
+    #wakes anyone waiting past it
+    with l.transaction():
+        late = l.add_to_discussion(uid, data['id'], 'late')
+        early = threading.Thread(target=l.add_to_discussion,
+                                    args=(uid, data['id'], 'early'))
+        early.start()
+        early.join(5)
+        assert not early.is_alive()
+    cursor = l.scalar("SELECT id FROM discussion WHERE body='early'")
+    assert cursor > late
+    assert [x.body for x in l.get_discussion(data['id'], cursor)] == [
+                                                        'dolor sit', 'late']
+    assert not l.wait_for_message('discussion', data['id'], cursor, 0.1)
+    later = threading.Timer(0.2, l.add_to_discussion, (uid, data['id'], 'x'))
+    later.start()
+    assert l.wait_for_message('discussion', data['id'], 10**9, 5)
+    later.join()
+
+    later = threading.Timer(0.2, l.add_batch_message, (uid, gid, 'amet'))
+    later.start()
+    assert l.wait_for_message('batchmessages', gid, 0, 5)
+    later.join()
+    assert [x.body for x in l.get_batch_messages(gid)] == ['amet']
+    assert not l.wait_for_message('batchmessages', gid + 1, 0, 0.1)
+
+def test_listener_reconnects(monkeypatch):
+    l.add_proposal(data)
+    uid = l.add_user('bob@example.com', 'Bob', 'bob')
+    l.approve_user(uid)
+    connect, failures = l._Listener.connect, [None]
+    def flaky(self):
+        if failures:
+            failures.pop()
+            raise OperationalError('LISTEN', {}, Exception('restarting'))
+        return connect(self)
+    monkeypatch.setattr(l._Listener, 'connect', flaky)
+    listener = l._Listener()
+    assert listener.listening.is_set() and not failures
+    l.add_to_discussion(uid, data['id'], 'Lorem ipsum')
+    assert listener.wait('discussion', data['id'], 0, 5)
+
 def test_batch():
 
     user = l.add_user('example@example.com', 'Voter', '123')
@@ -247,3 +318,644 @@ def test_batch():
     assert l.get_batch_vote(group_one, user).accept == votes2
 
     assert len(l.list_groups(submitter)) == 1
+
+    #The list pages decorate their rows in place
+    groups = {x.id:x for x in l.raw_list_groups()}
+    assert groups[group_one].talk_count == 6
+    assert groups[group_one].talk_consensus == [100]
+    assert groups[group_two]['skip_consensus'] == 0
+    group = l.list_groups(user)[0]
+    group.update(l.get_batch_stats()[group.id])
+    assert (group.voters, group.nominations) == (1, 1)
+    assert group._asdict()['consensus'] == 100
+    with pytest.raises(KeyError):
+        group['nope']
+    listing = {x.id:x for x in l.full_proposal_list('bob@example.com')}
+    assert 6 not in listing
+    assert listing[5].consensus == 100 and listing[1].consensus == -1
+
+    #Groups from before batchnominations was filled in
+    l.execute('DELETE FROM batchnominations')
+    listing = {x.id:x for x in l.full_proposal_list('bob@example.com')}
+    assert listing[5].consensus == 0
+    assert [x['consensus'] for x in l.get_my_pycon(user)] == [0]
+
+def test_batch_coverage():
+    voters = []
+    for n in range(4):
+        uid = l.add_user('{}@example.com'.format(n), 'Voter {}'.format(n), 'x')
+        l.approve_user(uid)
+        voters.append(uid)
+
+    proposals = []
+    for n in range(1, 11):
+        prop = data.copy()
+        prop['id'] = n
+        proposals.append(l.add_proposal(prop))
+
+    group_one = l.create_group('Group One', proposals[:5])
+    group_two = l.create_group('Group Two', proposals[5:8])
+
+    coverage = l.get_batch_coverage()
+    assert coverage[group_one] == {None:0, 1:0, 2:0, 3:0, 4:0, 5:0}
+
+    l.vote_group(group_one, voters[0], [1, 2])
+    l.vote_group(group_one, voters[1], [1])
+    l.vote_group(group_one, voters[2], [])
+    l.vote_group(group_one, voters[3], [2])
+    l.vote_group(group_one, voters[3], [1, 3])
+    l.vote_group(group_two, voters[0], [])
+    l.vote_group(group_two, voters[0], [6])
+
+    coverage = l.get_batch_coverage()
+    assert coverage[group_one][None] == 25
+    assert coverage[group_one][1] == 75
+    assert coverage[group_one][2] == 25
+    assert coverage[group_one][3] == 25
+    assert coverage[group_one][4] == 0
+    assert coverage[group_two] == {None:0, 6:100, 7:0, 8:0}
+    assert l.get_batch_coverage([group_two]).keys() == [group_two]
+
+    l.assign_proposal(group_two, 4)
+    l.assign_proposal(group_two, 1)
+    l.assign_proposal(None, 9)
+    assert 4 not in l.get_batch_coverage()[group_one]
+    assert l.get_batch_coverage()[group_one][1] == 75
+
+    assert not l.verify_batch_coverage()
+    l.execute('UPDATE batchnominations SET nominations = 3')
+    assert l.verify_batch_coverage()
+    l.rebuild_batch_coverage()
+    assert not l.verify_batch_coverage()
+
+def test_screening_page_bundle():
+    l.add_proposal(data)
+    standards = [l.add_standard("About Pythong"), l.add_standard("Awesome")]
+    other = data.copy()
+    other['id'] = 124
+    other['authors'] = [{'name':'Bob', 'email':'bob@example.com'}]
+    l.add_proposal(other)
+
+    uid = l.add_user('bob@example.com', 'Bob', 'bob')
+    l.approve_user(uid)
+    voter = l.add_user('alice@example.com', 'Alice', 'alice')
+    l.approve_user(voter)
+
+    assert not l.screening_page_bundle(uid, 999)
+
+    page = l.screening_page_bundle(uid, 123)
+    assert page.proposal.data['outline'] == data['outline']
+    assert page.proposal.authors[0].email == 'person@example.com'
+    assert not page.unread
+    assert page.discussion == []
+    assert [x.id for x in page.standards] == standards
+    assert not page.existing_vote
+    assert page.votes == []
+    assert page.percent == '0.00'
+
+    l.vote(voter, 123, {k:1 for k in standards})
+    l.add_to_discussion(voter, 123, 'Lorem ipsum')
+    l.vote(uid, 123, {k:2 for k in standards}, nominate=True)
+    l.add_to_discussion(voter, 123, 'dolor sit')
+
+    page = l.screening_page_bundle(uid, 123)
+    assert page.unread == l.is_unread(uid, 123)
+    assert [x.body for x in page.discussion] == ['Lorem ipsum', 'dolor sit']
+    assert page.discussion[0].display_name == 'Alice'
+    assert page.existing_vote.scores == {k:2 for k in standards}
+    assert page.existing_vote.nominate
+    assert (sorted(v.scores for v in page.votes)
+                == sorted(v.scores for v in l.get_votes(123)))
+    assert page.percent == l.get_vote_percentage('bob@example.com', uid)
+
+    #Earlier versions only come along once it changed since uid's vote
+    assert len(page.proposal.data_history) == 1
+    l.add_proposal(dict(data, title='Better'))
+    page = l.screening_page_bundle(uid, 123)
+    assert [x['title'] for x in page.proposal.data_history] == \
+            ['Better', data['title']]
+    assert len(l.screening_page_bundle(voter, 124).proposal.data_history) == 1
+    assert l.get_proposal(123, 'summary').title == 'Better'
+
+def test_group_discussions_and_voters():
+    users = []
+    for n in range(3):
+        uid = l.add_user('{}@example.com'.format(n), 'name {}'.format(n), 'x')
+        l.approve_user(uid)
+        users.append(uid)
+    for n in range(1, 5):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+    group = l.create_group('Group', [1, 2, 3])
+
+    l.add_to_discussion(users[0], 1, 'first')
+    l.add_to_discussion(users[1], 1, 'second')
+    l.add_to_discussion(users[1], 3, 'third')
+    l.add_to_discussion(users[1], 4, 'elsewhere')
+
+    discussions = l.get_discussions([1, 2, 3])
+    assert set(discussions.keys()) == set([1, 2, 3])
+    for pid, msgs in discussions.items():
+        assert msgs == l.get_discussion(pid)
+    assert [x.body for x in discussions[1]] == ['first', 'second']
+    assert discussions[2] == []
+
+    l.vote_group(group, users[0], [1, 2])
+    l.vote_group(group, users[1], [2])
+    l.vote_group(group, users[2], [])
+    voters = l.voters_by_proposal(l.get_group_votes(group))
+    assert sorted(voters[2]) == ['name 0', 'name 1']
+    assert voters[1] == ['name 0']
+    assert 3 not in voters
+
+def test_user_cache():
+    l.add_proposal(data)
+    standards = [l.add_standard('About Pythong')]
+    uid = l.add_user('bob@example.com', 'Bob', 'bob')
+    other = l.add_user('alice@example.com', 'Alice', 'alice')
+    l.approve_user(other)
+
+    assert not l.get_user(uid).approved
+    l.approve_user(uid)
+    assert l.get_user(uid).approved
+
+    user = l.get_user(uid)
+    assert not user.unread and not user.revisit
+
+    l.vote(uid, 123, {k:2 for k in standards})
+    l.add_to_discussion(other, 123, 'Lorem ipsum')
+    assert l.get_user(uid).unread
+
+    l.mark_read(uid, 123)
+    assert not l.get_user(uid).unread
+
+    changed = data.copy()
+    changed['abstract'] = 'Something new'
+    l.execute("UPDATE votes SET updated_on = now() - interval '1 day'")
+    l.add_proposal(changed)
+    assert l.get_user(uid).revisit
+    l.vote(uid, 123, {k:1 for k in standards})
+    assert not l.get_user(uid).revisit
+
+    l.execute("UPDATE users SET display_name='Robert' WHERE id=%s", uid)
+    assert l.get_user(uid).display_name == 'Bob'
+    l.forget_users([uid])
+    assert l.get_user(uid).display_name == 'Robert'
+
+def test_pool_stats():
+    before = l.pool_stats()['checkouts']
+    l.get_standards()
+    stats = l.pool_stats()
+    assert stats['checkouts'] > before
+    assert stats['wait_max_ms'] >= 0
+    assert stats['checked_out'] == 0
+
+def test_unread_counts():
+    for n in range(1, 3):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+    users = []
+    for n in range(3):
+        uid = l.add_user('{}@example.com'.format(n), 'name {}'.format(n), 'x')
+        l.approve_user(uid)
+        users.append(uid)
+
+    l.add_to_discussion(users[0], 1, 'one')
+    l.add_to_discussion(users[1], 1, 'two')
+    l.add_to_discussion(users[1], 1, 'three')
+    l.add_to_discussion(users[1], 2, 'four')
+    l.add_to_discussion(users[2], 2, 'five')
+    l.add_to_discussion(None, 1, 'from the author', name='Person')
+
+    assert l.unread_counts(users[0]) == (1, 0)
+    assert l.unread_counts(users[1]) == (2, 0)
+    assert l.unread_counts(users[2]) == (0, 0)
+    assert l.get_user(users[1]).unread
+
+    l.mark_read(users[1], 1)
+    l.mark_read(users[1], 1)
+    assert l.unread_counts(users[1]) == (1, 0)
+    l.mark_read(users[1], 2)
+    assert l.unread_counts(users[1]) == (0, 0)
+    assert not l.get_user(users[1]).unread
+
+    group = l.create_group('Group', [1, 2])
+    for uid in users:
+        l.vote_group(group, uid, [1])
+    hello = l.add_batch_message(users[0], group, 'hello')
+    l.add_batch_message(users[0], group, 'again')
+    assert l.unread_counts(users[0]) == (1, 0)
+    assert l.unread_counts(users[1]) == (0, 1)
+    assert l.get_unread_batches(users[2]) == set([group])
+    assert l.is_batch_unread(users[2], group)
+    assert not l.is_batch_unread(users[0], group)
+    assert [x.body for x in l.get_batch_messages(group, hello)] == ['again']
+    l.mark_batch_read(group, users[2])
+    assert l.unread_counts(users[2]) == (0, 0)
+    assert not l.get_unread_batches(users[2])
+    assert not l.is_batch_unread(users[2], group)
+
+def test_needs_votes_reserve():
+    standards = [l.add_standard('About Pythong')]
+    reviewers = []
+    for n in range(3):
+        email = 'reviewer{}@example.com'.format(n)
+        uid = l.add_user(email, email, email)
+        l.approve_user(uid)
+        reviewers.append((email, uid))
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+
+    handed_out = [l.needs_votes(email, uid, reserve=True)
+                    for email, uid in reviewers]
+    assert sorted(handed_out) == [1, 2, 3]
+
+    email, uid = reviewers[0]
+    assert l.needs_votes(email, uid, reserve=True) == handed_out[0]
+
+    l.vote(uid, handed_out[0], {k:2 for k in standards})
+    assert l.needs_votes(email, uid, reserve=True) in handed_out[1:]
+
+    l.execute("UPDATE reviewleases SET expires = now() - interval '1 minute'")
+    seen = set()
+    for n in range(50):
+        seen.add(l.needs_votes(email, uid))
+    assert seen == set(handed_out[1:])
+
+def test_scored_proposals():
+    standards = [l.add_standard('About Pythong'), l.add_standard('Awesome'),
+                    l.add_standard('Clear')]
+    users = []
+    for n in range(5):
+        uid = l.add_user('{}@example.com'.format(n), 'name {}'.format(n), 'x')
+        l.approve_user(uid)
+        users.append(uid)
+    for n in range(1, 7):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+    l.create_group('Group', [1, 2])
+
+    def check():
+        #The old code truncates float sums, so greenness can come out one lower
+        strip = lambda rows: sorted((dict(x, rank=None, greenness=None)
+                                        for x in rows), key=lambda x:x['id'])
+        cached = l.scored_proposals()
+        recomputed = l._recompute_scored_proposals()
+        assert strip(cached) == strip(recomputed)
+        greenness = {x['id']:x['greenness'] for x in cached}
+        assert all(0 <= greenness[x['id']] - x['greenness'] <= 1
+                    for x in recomputed)
+
+    assert l.scored_proposals() == []
+    random.seed(1)
+    for uid in users:
+        for pid in range(1, 6):
+            vote = {k:random.randint(0, 2) for k in standards}
+            l.vote(uid, pid, vote, nominate=random.random() > 0.7)
+    check()
+
+    l.vote(users[0], 1, {k:2 for k in standards}, nominate=True)
+    l.vote(users[1], 6, {k:0 for k in standards})
+    check()
+
+    #Votes written by another process only show up through the delta query
+    l.execute("""UPDATE votes SET nominate = NOT nominate, updated_on = now()
+                    WHERE proposal = 2""")
+    check()
+
+    l.rebuild_scores()
+    check()
+    rows = l.scored_proposals()
+    assert [x['rank'] for x in rows] == range(len(rows))
+    assert all(rows[n]['nom_is_green'] >= rows[n+1]['nom_is_green']
+                for n in range(len(rows)-1))
+
+def test_topic_model(tmpdir, monkeypatch):
+    monkeypatch.setattr(l, '_TOPIC_MODEL_DIR', str(tmpdir))
+    assert l.get_proposals_auto_grouped() == {}
+    with l._TOPIC_LOCK:
+        assert not os.listdir(str(tmpdir))
+
+    topics = ['snakes scales venom', 'databases queries indexes',
+                'gardens flowers weeds']
+    for n in range(1, 13):
+        prop = data.copy()
+        prop['id'] = n
+        prop['abstract'] = prop['title'] = topics[n % 3]
+        l.add_proposal(prop)
+
+    #Without a model, one is built in the background
+    assert l.get_proposals_auto_grouped(topics_count=3) == {}
+    with l._TOPIC_LOCK:
+        pass
+    grouped = l.get_proposals_auto_grouped(topics_count=3)
+    assert set(grouped) == set(range(1, 13))
+    assert grouped[3] == grouped[6] and grouped[3] != grouped[4]
+    first = l._read_topic_manifest()
+
+    #Served from the stored artifact without touching the model, even once
+    #it's out of date
+    prop = data.copy()
+    prop['id'] = 1
+    prop['abstract'] = prop['title'] = topics[1] + ' snakes'
+    l.add_proposal(prop)
+    l._TOPIC_MODEL.clear()
+    assert l.get_proposals_auto_grouped(topics_count=3) == grouped
+    assert l._read_topic_manifest()['hash'] == first['hash']
+    assert set(l.get_proposals_auto_grouped(topics_count=3, threshold=.9)) \
+            == set(range(1, 13))
+
+    #Files newer than the manifest being replaced are left alone
+    stray = tmpdir.join('another.index')
+    stray.write('')
+    later = os.path.getmtime(str(tmpdir.join('manifest.json'))) + 1
+    os.utime(str(stray), (later, later))
+    manifest = l.update_topic_model(topics_count=3)
+    assert manifest['hash'] != first['hash']
+    assert manifest['folded'] == 1
+    assert set(l.get_proposals_auto_grouped(topics_count=3)) == set(range(1, 13))
+    assert l._read_topic_manifest()['hash'] == manifest['hash']
+    assert not [x for x in os.listdir(str(tmpdir))
+                    if x.startswith(first['hash'])]
+    assert stray.check()
+
+    for n in range(2, 6):
+        prop['id'] = n
+        l.add_proposal(prop)
+    assert l.update_topic_model(topics_count=3)['folded'] == 0
+
+def test_group_neighbors():
+    import numpy as np
+    #a-b and b-c are close, a-c aren't; all three still end up together
+    vectors = np.array([[1, 0, 0], [.8, .6, 0], [.6, .8, 0],
+                        [0, 0, 1], [0, .1, .995]], dtype=np.float32)
+    ids = [50, 10, 30, 40, 20]
+    grouped = l._group_neighbors(ids, vectors, .7)
+    assert grouped == {10:0, 50:0, 30:0, 20:1, 40:1}
+    assert grouped == l._group_neighbors(ids[::-1], vectors[::-1], .7)
+
+    assert l._nearest_neighbors(vectors, .7, k=1, chunk=2) == \
+            [[1], [2], [1], [4], [3]]
+    assert len(set(l._group_neighbors(ids, vectors, .999).values())) == 5
+
+def test_add_proposals(monkeypatch):
+    monkeypatch.setattr(l, '_PROPOSAL_CHUNK', 3)
+    proposals = []
+    for n in range(1, 8):
+        prop = data.copy()
+        prop['id'] = n
+        proposals.append(prop)
+    assert sorted(l.add_proposals(iter(proposals))) == range(1, 8)
+    assert l.add_proposals(proposals) == []
+
+    changed = dict(proposals[2], title='New Title')
+    assert l.add_proposals([changed] + proposals[3:]) == [3]
+    history = l.get_proposal(3, 'history').data_history
+    assert [x['title'] for x in history] == ['New Title', data['title']]
+    assert all(x['when'] for x in history)
+    assert len(l.get_proposal(4, 'history').data_history) == 1
+
+    assert not l.add_proposal(changed)
+    assert l.add_proposal(dict(changed, title='Another')) == 3
+    assert len(l.get_proposal(3, 'history').data_history) == 3
+    assert l.scalar('SELECT COUNT(*) FROM proposal_revisions') == 9
+
+def test_incremental_triggers():
+    standards = [l.add_standard('About Pythong')]
+    users = [l.add_user('{}@example.com'.format(n), 'name', 'x')
+                for n in range(3)]
+    for uid in users:
+        l.approve_user(uid)
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        prop['authors'] = [{'name':'A', 'email':'a{}@example.com'.format(n)}]
+        l.add_proposal(prop)
+    for uid in users:
+        l.vote(uid, 1, {standards[0]:1})
+    l.vote(users[0], 2, {standards[0]:1})
+    l.vote(users[0], 1, {standards[0]:2})
+    assert l.get_proposal(1).vote_count == 3
+    assert sorted(l.get_proposal(1).voters) == sorted(users)
+    assert l.get_proposal(2).voters == [users[0]]
+
+    l.execute('UPDATE votes SET proposal=3 WHERE proposal=2')
+    assert l.get_proposal(2).vote_count == 0
+    assert l.get_proposal(3).voters == [users[0]]
+    l.execute('DELETE FROM votes WHERE proposal=3')
+    assert l.get_proposal(3).vote_count == 0
+
+    first = l.create_group('First', [1, 2])
+    second = l.create_group('Second', [3])
+    emails = lambda gid: sorted(l.get_group(gid).author_emails)
+    assert emails(first) == ['a1@example.com', 'a2@example.com']
+    l.assign_proposal(second, 2)
+    assert emails(first) == ['a1@example.com']
+    assert emails(second) == ['a2@example.com', 'a3@example.com']
+    l.execute("""UPDATE proposals SET author_emails='{b@example.com}'
+                    WHERE id=1""")
+    assert emails(first) == ['b@example.com']
+    l.change_acceptance(3, True)
+    assert emails(second) == ['a2@example.com', 'a3@example.com']
+
+def explain(fn, *args):
+    """Runs fn, then EXPLAINs every SELECT it sent, with sequential scans
+    priced out so any query that can't use an index stands out."""
+    from sqlalchemy import event
+    seen = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        seen.append((statement, parameters))
+    event.listen(l._engine(), 'before_cursor_execute', capture)
+    try:
+        fn(*args)
+    finally:
+        event.remove(l._engine(), 'before_cursor_execute', capture)
+    plans = []
+    with l.transaction() as conn:
+        conn.execute('SET LOCAL enable_seqscan = off')
+        cursor = conn.connection.cursor()
+        for statement, parameters in seen:
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plans.extend(x[0] for x in cursor.fetchall())
+    return '\n'.join(plans)
+
+def test_author_and_accept_indexes():
+    uid = l.add_user('Author@Example.com', 'Author', 'x')
+    other = l.add_user('other@example.com', 'Other', 'x')
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        prop['authors'] = [{'name':'A', 'email':'author@example.com'},
+                            {'name':'B', 'email':'b{}@example.com'.format(n)}]
+        l.add_proposal(prop)
+    gid = l.create_group('Group', [1, 2, 3])
+    l.vote_group(gid, other, [1, 2])
+    l.vote_group(gid, other, [2, 3])
+
+    q = 'SELECT proposal, email FROM proposal_authors ORDER BY proposal, email'
+    assert [tuple(x) for x in l.fetchall(q)][:2] == \
+            [(1, 'author@example.com'), (1, 'b1@example.com')]
+    l.execute("UPDATE proposals SET author_emails='{C@example.com}' WHERE id=3")
+    assert [x.email for x in l.fetchall(q) if x.proposal == 3] == \
+            ['c@example.com']
+    q = 'SELECT proposal FROM batchvote_accepts ORDER BY proposal'
+    assert [x.proposal for x in l.fetchall(q)] == [2, 3]
+
+    assert [x.proposals_made for x in l.list_users()] == [2, 0]
+    assert [x.count for x in sorted(l.get_group_proposals(gid),
+                                    key=lambda x:x.id)] == [0, 1, 1]
+    assert not l.list_groups(uid)
+    assert l.get_group(gid).progcom_members == ['Author']
+    assert l.needs_votes('author@example.com', uid) == 3
+
+    for table, fn, args in (
+            ('proposal_authors', l.list_users, ()),
+            ('proposal_authors', l.get_vote_percentage, ('x@example.com', uid)),
+            ('proposal_authors', l.needs_votes, ('x@example.com', uid)),
+            ('proposal_authors', l.full_proposal_list, ('x@example.com',)),
+            ('proposal_authors', l.list_groups, (other,)),
+            ('proposal_authors', l.get_group, (gid,)),
+            ('proposal_authors', l.screening_page_bundle, (uid, 1)),
+            ('batchvote_accepts', l.get_group_proposals, (gid,))):
+        l.forget_reviewer_activity()
+        plan = explain(fn, *args)
+        assert table in plan, fn.__name__
+        assert 'Seq Scan on ' + table not in plan, (fn.__name__, plan)
+
+def test_reviewer_activity():
+    standards = [l.add_standard('About Pythong')]
+    users = [l.add_user('{}@example.com'.format(n), 'name {}'.format(n), 'x')
+                for n in range(3)]
+    for uid in users:
+        l.approve_user(uid)
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        prop['authors'] = [{'name':'A', 'email':'0@Example.com'}]
+        l.add_proposal(prop)
+    l.vote(users[1], 1, {standards[0]:1})
+    l.vote(users[1], 2, {standards[0]:1})
+    l.vote(users[2], 1, {standards[0]:1})
+
+    l.forget_reviewer_activity()
+    rows = l.list_users()
+    assert [x.votes for x in rows] == [0, 2, 1]
+    assert [x.proposals_made for x in rows] == [3, 0, 0]
+    assert rows[0].last_voted is None and rows[1].last_voted
+    assert [x.id for x in l.active_reviewers()] == [users[1], users[2]]
+
+    #Cached until a user changes
+    l.vote(users[2], 2, {standards[0]:1})
+    assert l.reviewer_activity()[2].votes == 1
+    l.add_user('3@example.com', 'name 3', 'x')
+    assert l.reviewer_activity()[2].votes == 2
+    assert [bool(x.approved_on) for x in l.reviewer_activity()] == \
+            [True, True, True, False]
+
+def test_stats_snapshot(monkeypatch):
+    standards = [l.add_standard('About Pythong')]
+    uid = l.add_user('0@example.com', 'name', 'x')
+    l.approve_user(uid)
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+    l.vote(uid, 1, {standards[0]:2}, nominate=True)
+
+    snapshot = l.stats_snapshot()
+    assert snapshot['doc']['total_votes'] == 1
+    assert snapshot['doc']['total_proposals'] == 3
+    assert snapshot['doc']['nomination_density'] == [(1, 1)]
+    assert not l._STATS['writes']
+    assert l.stats_snapshot() is snapshot
+
+    #Writes are counted, and go stale at the limit
+    monkeypatch.setattr(l, '_STATS_MAX_WRITES', 2)
+    l.vote(uid, 2, {standards[0]:1})
+    assert l._STATS['writes'] == 1 and not l._stats_stale(snapshot)
+    l.vote(uid, 3, {standards[0]:1})
+    assert l._stats_stale(snapshot)
+
+    rebuilt = l.build_stats_snapshot()
+    assert rebuilt['doc']['total_votes'] == 3
+    assert rebuilt['etag'] != snapshot['etag']
+    assert l.build_stats_snapshot()['etag'] == rebuilt['etag']
+    monkeypatch.setattr(l, '_STATS_MAX_AGE', -1)
+    assert l._stats_stale(rebuilt)
+
+def test_votes_by_day_and_coverage():
+    assert l.get_votes_by_day() == []
+    standards = [l.add_standard('About Pythong')]
+    users = [l.add_user('{}@example.com'.format(n), 'name', 'x')
+                for n in range(2)]
+    for uid in users:
+        l.approve_user(uid)
+    for n in range(1, 4):
+        prop = data.copy()
+        prop['id'] = n
+        l.add_proposal(prop)
+    l.vote(users[0], 1, {standards[0]:1})
+    l.vote(users[1], 1, {standards[0]:1})
+    l.vote(users[1], 2, {standards[0]:1})
+    l.execute('''UPDATE votes SET updated_on = updated_on - interval '3 days'
+                    WHERE proposal=2''')
+    l.execute('''UPDATE proposals SET added_on = added_on - interval '14 days'
+                    WHERE id=3''')
+
+    days = l.get_votes_by_day()
+    assert [x['count'] for x in days] == [1, 0, 0, 2]
+    assert all(a['day'] < b['day'] for a, b in zip(days, days[1:]))
+
+    coverage = l.coverage_by_age()
+    assert [x['key'] for x in coverage] == [0, 1, 2]
+    assert [[v['votes'] for v in x['values']] for x in coverage] == \
+            [[1, 0], [0, 1], [0, 1]]
+
+def test_services(monkeypatch):
+    built = []
+    @l._service
+    def _thing():
+        built.append(1)
+        return object()
+    assert _thing() is _thing()
+    assert len(built) == 1
+
+    monkeypatch.setenv('ROOMS', '{"A": 1, "B": 2}')
+    monkeypatch.setenv('ROOM_SCHEDULES', '{"1": [{"9:00": 30}], "2": []}')
+    monkeypatch.delitem(l._SERVICES, '_rooms', raising=False)
+    assert l._rooms() == {'A': [{'9:00': 30}], 'B': []}
+    l._SERVICES.pop('_rooms')
+    l._SERVICES.pop('_thing')
+
+def test_markdown_cache(monkeypatch):
+    html = l.render_markdown('Some *emphasis* and http://example.com')
+    assert '<em>emphasis</em>' in html and 'target="_blank"' in html
+    assert l.render_markdown(None) == l.render_markdown('')
+
+    #Written proposals are rendered ahead of time
+    l.add_proposal(data)
+    digest = l._markdown_digest(data['description'])
+    assert l.scalar('SELECT html FROM markdown_cache WHERE digest=%s', digest)
+    assert not l.cache_markdown([data['description'], data['notes']])
+
+    #After that, the LRU is in front of the table and the renderer
+    rendered = []
+    monkeypatch.setattr(l, '_render_markdown',
+                        lambda text: rendered.append(text) or text)
+    assert '<p>' in l.render_markdown(data['description'])
+    l.execute('DELETE FROM markdown_cache')
+    assert '<p>' in l.render_markdown(data['description'])
+    assert not rendered
+
+    monkeypatch.setattr(l, '_MARKDOWN_CACHE_SIZE', 2)
+    for n in range(3):
+        l.render_markdown(str(n))
+    assert len(l._MARKDOWN) == 2
+    assert rendered == ['0', '1', '2']
+    assert l.render_markdown('2') == '2' and len(rendered) == 3
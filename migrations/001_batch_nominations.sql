@@ -0,0 +1,24 @@
+ALTER TABLE batchgroups ADD COLUMN voter_count INT DEFAULT 0;
+ALTER TABLE batchgroups ADD COLUMN skip_count INT DEFAULT 0;
+
+CREATE TABLE batchnominations (
+    batchgroup      BIGINT REFERENCES batchgroups,
+    proposal        BIGINT,
+    nominations     INT DEFAULT 0,
+    PRIMARY KEY (batchgroup, proposal)
+);
+
+--The same as `envdir dev-config ./batch_coverage.py rebuild`
+INSERT INTO batchnominations (batchgroup, proposal, nominations)
+    SELECT batchgroup, proposal, SUM(n) FROM
+        (SELECT batchgroup, id AS proposal, 0 AS n FROM proposals
+            WHERE batchgroup IS NOT NULL
+        UNION ALL
+        SELECT batchgroup, unnest(accept), 1 FROM batchvotes) AS x
+    GROUP BY batchgroup, proposal;
+UPDATE batchgroups SET
+    voter_count = (SELECT COUNT(*) FROM batchvotes
+                    WHERE batchvotes.batchgroup = batchgroups.id),
+    skip_count = (SELECT COUNT(*) FROM batchvotes
+                    WHERE batchvotes.batchgroup = batchgroups.id
+                    AND cardinality(accept) = 0);
@@ -0,0 +1,2 @@
+CREATE INDEX idx_discussion_proposal
+    ON discussion (proposal);
@@ -0,0 +1,11 @@
+CREATE TABLE unreadcounts (
+    voter           BIGINT PRIMARY KEY REFERENCES users,
+    discussions     INT DEFAULT 0,
+    batches         INT DEFAULT 0
+);
+
+INSERT INTO unreadcounts (voter, discussions, batches)
+    SELECT id,
+        (SELECT COUNT(*) FROM unread WHERE unread.voter = users.id),
+        (SELECT COUNT(*) FROM batchunread WHERE batchunread.voter = users.id)
+    FROM users;
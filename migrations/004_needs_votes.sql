@@ -0,0 +1,8 @@
+CREATE INDEX idx_proposals_needs_votes
+    ON proposals (vote_count) WHERE NOT withdrawn;
+
+CREATE TABLE reviewleases (
+    proposal    BIGINT PRIMARY KEY REFERENCES proposals,
+    voter       BIGINT REFERENCES users,
+    expires     TIMESTAMP WITH TIME ZONE
+);
@@ -0,0 +1,2 @@
+CREATE INDEX idx_votes_updated_on
+    ON votes (updated_on);
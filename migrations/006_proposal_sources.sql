@@ -0,0 +1,3 @@
+ALTER TABLE proposals
+    ADD COLUMN source_etag TEXT DEFAULT NULL,
+    ADD COLUMN source_digest VARCHAR(40) DEFAULT NULL;
@@ -0,0 +1,19 @@
+CREATE TABLE proposal_revisions (
+    id          BIGSERIAL PRIMARY KEY,
+    proposal    BIGINT REFERENCES proposals,
+    data        JSONB,
+    created     TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+CREATE INDEX idx_proposal_revisions_proposal
+    ON proposal_revisions (proposal, id);
+
+--data_history is newest first; oldest goes in first so ids follow time
+INSERT INTO proposal_revisions (proposal, data, created)
+    SELECT p.id, h.version - 'when',
+        COALESCE((h.version->>'when')::timestamptz, p.added_on)
+    FROM proposals AS p,
+        jsonb_array_elements(p.data_history) WITH ORDINALITY AS h(version, n)
+    ORDER BY p.id, h.n DESC;
+
+ALTER TABLE proposals DROP COLUMN data_history;
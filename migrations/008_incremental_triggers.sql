@@ -0,0 +1,77 @@
+--Incremental vote_count/voters and batchgroups.author_emails maintenance.
+--See tables.sql for the commented versions.
+CREATE OR REPLACE FUNCTION batch_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP = 'UPDATE' AND OLD.batchgroup IS NOT NULL THEN
+        UPDATE batchgroups SET
+        author_emails=(SELECT email_aggregate(author_emails)
+                        FROM proposals WHERE batchgroup = OLD.batchgroup)
+        WHERE id = OLD.batchgroup;
+        IF OLD.batchgroup IS NOT DISTINCT FROM NEW.batchgroup THEN
+            RETURN NEW;
+        END IF;
+    END IF;
+    IF NEW.batchgroup IS NOT NULL THEN
+        UPDATE batchgroups SET
+        author_emails=COALESCE(author_emails, '{}') || NEW.author_emails
+        WHERE id = NEW.batchgroup;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS batch_change_trigger ON proposals;
+
+CREATE TRIGGER batch_insert_trigger AFTER INSERT
+    ON proposals FOR EACH ROW WHEN (NEW.batchgroup IS NOT NULL)
+    EXECUTE PROCEDURE batch_change();
+
+CREATE TRIGGER batch_change_trigger AFTER UPDATE OF batchgroup, author_emails
+    ON proposals FOR EACH ROW
+    WHEN (OLD.batchgroup IS DISTINCT FROM NEW.batchgroup
+            OR OLD.author_emails IS DISTINCT FROM NEW.author_emails)
+    EXECUTE PROCEDURE batch_change();
+
+CREATE INDEX idx_proposals_batchgroup
+    ON proposals (batchgroup) WHERE batchgroup IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION votes_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE proposals SET
+            vote_count=vote_count - 1,
+            voters=array_remove(voters, OLD.voter)
+            WHERE id=OLD.proposal;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE proposals SET
+            vote_count=vote_count + 1,
+            voters=array_append(voters, NEW.voter)
+            WHERE id=NEW.proposal;
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS votes_change_trigger ON votes;
+
+CREATE TRIGGER votes_insert_trigger AFTER INSERT OR DELETE
+    ON votes FOR EACH ROW EXECUTE PROCEDURE votes_change();
+
+CREATE TRIGGER votes_change_trigger AFTER UPDATE OF voter, proposal
+    ON votes FOR EACH ROW
+    WHEN (OLD.voter IS DISTINCT FROM NEW.voter
+            OR OLD.proposal IS DISTINCT FROM NEW.proposal)
+    EXECUTE PROCEDURE votes_change();
+
+--Start from exact numbers; the triggers only apply differences from here on
+UPDATE proposals SET
+    vote_count=(SELECT count(*) FROM votes WHERE proposal=proposals.id),
+    voters=ARRAY(SELECT voter FROM votes WHERE proposal=proposals.id);
+
+UPDATE batchgroups SET
+    author_emails=(SELECT email_aggregate(author_emails)
+                    FROM proposals WHERE batchgroup = batchgroups.id);
@@ -0,0 +1,69 @@
+--Join tables behind the author and batch vote lookups; see tables.sql.
+--One row per (proposal, lowercased author email), so "proposals by this
+--person" and "proposals not by this person" can use an index instead of
+--ANY(author_emails). Kept in step with proposals.author_emails by trigger.
+CREATE TABLE proposal_authors (
+    proposal    BIGINT REFERENCES proposals,
+    email       VARCHAR(254),
+    PRIMARY KEY (proposal, email)
+);
+
+CREATE INDEX idx_proposal_authors_email
+    ON proposal_authors (email);
+
+CREATE OR REPLACE FUNCTION proposal_authors_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM proposal_authors WHERE proposal = NEW.id;
+    END IF;
+    INSERT INTO proposal_authors (proposal, email)
+        SELECT DISTINCT NEW.id, lower(e) FROM unnest(NEW.author_emails) AS e
+        WHERE e IS NOT NULL;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER proposal_authors_insert_trigger AFTER INSERT
+    ON proposals FOR EACH ROW EXECUTE PROCEDURE proposal_authors_change();
+
+CREATE TRIGGER proposal_authors_change_trigger AFTER UPDATE OF author_emails
+    ON proposals FOR EACH ROW
+    WHEN (OLD.author_emails IS DISTINCT FROM NEW.author_emails)
+    EXECUTE PROCEDURE proposal_authors_change();
+
+--batchvotes.accept, one row per proposal, kept in step by trigger
+CREATE TABLE batchvote_accepts (
+    batchgroup      BIGINT REFERENCES batchgroups,
+    voter           BIGINT REFERENCES users,
+    proposal        BIGINT,
+    PRIMARY KEY (batchgroup, voter, proposal)
+);
+
+CREATE INDEX idx_batchvote_accepts_proposal
+    ON batchvote_accepts (proposal);
+
+CREATE OR REPLACE FUNCTION batchvote_accepts_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM batchvote_accepts
+            WHERE batchgroup = OLD.batchgroup AND voter = OLD.voter;
+    END IF;
+    INSERT INTO batchvote_accepts (batchgroup, voter, proposal)
+        SELECT DISTINCT NEW.batchgroup, NEW.voter, a
+        FROM unnest(NEW.accept) AS a WHERE a IS NOT NULL;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER batchvote_accepts_trigger AFTER INSERT OR UPDATE OF accept
+    ON batchvotes FOR EACH ROW EXECUTE PROCEDURE batchvote_accepts_change();
+
+INSERT INTO proposal_authors (proposal, email)
+    SELECT DISTINCT id, lower(e) FROM proposals, unnest(author_emails) AS e
+    WHERE e IS NOT NULL;
+
+INSERT INTO batchvote_accepts (batchgroup, voter, proposal)
+    SELECT DISTINCT batchgroup, voter, a FROM batchvotes, unnest(accept) AS a
+    WHERE a IS NOT NULL;
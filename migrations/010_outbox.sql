@@ -0,0 +1,16 @@
+--Email queued by the web app and sent by outbox_worker.py; see tables.sql.
+CREATE TABLE outbox (
+    id              BIGSERIAL PRIMARY KEY,
+    kind            VARCHAR(32) NOT NULL,
+    ref             TEXT NOT NULL,
+    email           TEXT NOT NULL,
+    message         JSONB NOT NULL,
+    created         TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    attempts        INT DEFAULT 0,
+    next_attempt    TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    sent            TIMESTAMP WITH TIME ZONE,
+    error           TEXT,
+    UNIQUE (kind, ref, email)
+);
+CREATE INDEX idx_outbox_due
+    ON outbox (next_attempt) WHERE sent IS NULL;
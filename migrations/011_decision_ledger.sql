@@ -0,0 +1,16 @@
+--send_emails() now records acceptances and declines in the outbox, and
+--keeps one confirmation per (proposal, email); see tables.sql.
+UPDATE confirmations AS c SET acknowledged = TRUE
+    WHERE NOT c.acknowledged IS TRUE AND EXISTS (
+        SELECT 1 FROM confirmations AS d
+        WHERE d.proposal = c.proposal AND d.email = c.email
+            AND d.acknowledged);
+DELETE FROM confirmations AS c WHERE EXISTS (
+    SELECT 1 FROM confirmations AS d
+    WHERE d.proposal = c.proposal AND d.email = c.email AND d.id < c.id);
+ALTER TABLE confirmations ADD UNIQUE (proposal, email);
+
+--Acceptances sent before the outbox existed; declines were never recorded.
+INSERT INTO outbox (kind, ref, email, message, attempts, sent)
+    SELECT 'accept', proposal::text, email, '{}', 1, now() FROM confirmations
+    ON CONFLICT DO NOTHING;
@@ -0,0 +1,7 @@
+--Rendered proposal markdown; see tables.sql. It fills itself as proposals
+--are written and pages are viewed.
+CREATE TABLE markdown_cache (
+    digest          VARCHAR(40) PRIMARY KEY,
+    html            TEXT NOT NULL,
+    created         TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
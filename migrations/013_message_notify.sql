@@ -0,0 +1,18 @@
+--Notifications for the live discussion streams; see tables.sql.
+CREATE OR REPLACE FUNCTION message_notify() RETURNS trigger AS
+$$
+BEGIN 
+    PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+                'key', row_to_json(NEW)->TG_ARGV[0], 'id', NEW.id)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER discussion_notify_trigger AFTER INSERT
+    ON discussion FOR EACH ROW EXECUTE PROCEDURE message_notify('proposal');
+
+CREATE INDEX idx_batchmessages_batch
+    ON batchmessages (batch, id);
+
+CREATE TRIGGER batchmessages_notify_trigger AFTER INSERT
+    ON batchmessages FOR EACH ROW EXECUTE PROCEDURE message_notify('batch');
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+import logic as l
+
+POLL = float(os.environ.get('OUTBOX_POLL', 2))
+
+def main(once=False):
+    """Send queued email until stopped. A full batch means there's probably
+    more waiting, so only sleep once the outbox has been drained."""
+    while True:
+        sent, failed = l.send_outbox()
+        if once:
+            return
+        if sent + failed < l._OUTBOX_BATCH:
+            time.sleep(POLL)
+
+
+if __name__ == '__main__':
+    from raven import Client
+    raven_client = Client(os.environ.get('SENTRY_DSN'))
+    try:
+        main('once' in sys.argv[1:])
+    except KeyboardInterrupt:
+        pass
+    except:
+        raven_client.captureException()
+        sys.exit(1)
@@ -0,0 +1,166 @@
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import sendgrid
+
+import logic as l
+import outbox_worker as w
+#A clean database for every test
+from logic_test import transact, data
+
+
+class FakeSendGrid(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status = server.failures.pop(0) if server.failures else 202
+        if status == 202:
+            server.sent.append(body)
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), FakeSendGrid)
+    server.sent = []
+    server.failures = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = sendgrid.SendGridAPIClient(apikey='test',
+                    host='http://127.0.0.1:{}'.format(server.server_port))
+    monkeypatch.setitem(l._SERVICES, '_sendgrid', client)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def recipients(server):
+    return sorted(x['email'] for msg in server.sent
+                    for p in msg['personalizations'] for x in p['to'])
+
+
+def test_outbox(sent, monkeypatch):
+    monkeypatch.setenv('ADMIN_EMAILS', '["admin@example.com"]')
+    monkeypatch.delitem(l._SERVICES, '_admin_emails', raising=False)
+    authors = [{'name': 'One', 'email': 'one@example.com'},
+                {'name': 'Two', 'email': 'two@example.com'}]
+    l.add_proposal(dict(data, authors=authors))
+    uid = l.add_user('voter@example.com', 'Voter', 'abc123')
+    l.approve_user(uid)
+
+    l.add_to_discussion(uid, data['id'], 'Some feedback', feedback=True)
+    l.email_approved(uid)
+    l.email_approved(uid)
+    assert not sent.sent
+    assert w.main(once=True) is None
+    assert recipients(sent) == ['one@example.com', 'two@example.com',
+                                'voter@example.com']
+    assert not l.send_outbox()[0]
+
+    #Identical bodies go out together
+    del sent.sent[:]
+    for n in range(3):
+        to = [{'email': '{}@example.com'.format(n)}]
+        msg = {'personalizations': [{'to': to, 'subject': 'Hi'}],
+                'from': {'email': 'progcom@example.com'},
+                'content': [{'type': 'text/plain', 'value': 'Hello'}]}
+        assert l.queue_email('test', 1, msg)
+        assert not l.queue_email('test', 1, msg)
+    assert l.send_outbox() == (3, 0)
+    assert len(sent.sent) == 1
+    assert recipients(sent) == ['0@example.com', '1@example.com',
+                                '2@example.com']
+
+    #Failures are retried later, not straight away
+    del sent.sent[:]
+    sent.failures = [500]
+    l.email_new_user_pending('new@example.com', 'New')
+    assert l.send_outbox() == (0, 1)
+    assert l.send_outbox() == (0, 0)
+    l.execute('UPDATE outbox SET next_attempt = now() WHERE sent IS NULL')
+    assert l.send_outbox() == (1, 0)
+    assert recipients(sent) == ['admin@example.com']
+
+    l.execute('''UPDATE outbox SET sent = NULL, next_attempt = now(),
+                    attempts = %s''', l._OUTBOX_MAX_ATTEMPTS)
+    assert l.send_outbox() == (0, 0)
+    assert len(l.get_outbox_failures()) == 7
+    l._SERVICES.pop('_admin_emails')
+
+
+def test_outbox_claims(sent, monkeypatch):
+    def queue(n):
+        msg = {'personalizations': [{'to': [{'email': 'a@example.com'}]}],
+                'from': {'email': 'progcom@example.com'},
+                'content': [{'type': 'text/plain', 'value': str(n)}]}
+        l.queue_email('test', n, msg)
+    for n in range(3):
+        queue(n)
+
+    #Claims are committed before anything is posted, and each request is
+    #recorded once it's made, so a worker that dies partway through only
+    #leaves the request it was making
+    post = l._post_email
+    def crash(msg):
+        assert l.send_outbox() == (0, 0)
+        if msg['content'][0]['value'] == '1':
+            raise KeyboardInterrupt
+        return post(msg)
+    monkeypatch.setattr(l, '_post_email', crash)
+    with pytest.raises(KeyboardInterrupt):
+        l.send_outbox()
+    monkeypatch.setattr(l, '_post_email', post)
+    assert recipients(sent) == ['a@example.com']
+    assert l.scalar('SELECT count(*) FROM outbox WHERE sent IS NOT NULL') == 1
+
+    #The rest go once their lease runs out
+    assert l.send_outbox() == (0, 0)
+    l.execute('UPDATE outbox SET next_attempt = now() WHERE sent IS NULL')
+    assert l.send_outbox() == (2, 0)
+    assert l.fetchall('SELECT attempts FROM outbox ORDER BY id') == [(1,),
+                                                            (2,), (2,)]
+
+
+def test_send_emails(sent):
+    authors = [{'name': 'One', 'email': 'one@example.com'},
+                {'name': 'Two', 'email': 'two@example.com'}]
+    l.add_proposal(dict(data, id=1, title='Accepted', authors=authors))
+    l.add_proposal(dict(data, id=2, title='Declined', authors=authors[:1]))
+    l.add_proposal(dict(data, id=3, authors=[{'name': 'X', 'email': 'none'}]))
+    l.change_acceptance(1, True)
+
+    stats = l.send_emails(dry_run=True)
+    assert (stats['accept'], stats['decline'], stats['requests']) == (2, 1, 2)
+    assert not l.fetchall('SELECT * FROM outbox')
+    assert not l.fetchall('SELECT * FROM confirmations')
+
+    assert l.send_emails()['queued'] == 3
+    assert not l.send_emails()['queued']
+    assert l.send_outbox() == (3, 0)
+    assert len(sent.sent) == 2
+
+    accept = [x for x in sent.sent if 'Acceptance' in
+                x['personalizations'][0]['subject']][0]
+    assert '-url-' in accept['content'][0]['value']
+    subs = {p['to'][0]['email']:p['substitutions']
+                for p in accept['personalizations']}
+    assert sorted(subs) == ['one@example.com', 'two@example.com']
+    assert subs['two@example.com']['-name-'] == 'Two'
+    key = subs['two@example.com']['-url-'].strip('/').split('/')[-1]
+    assert l.acknowledge_confirmation(key) == 1
+
+    #A rerun only picks up what didn't make it into the outbox, and links
+    #to the same confirmation
+    l.execute("DELETE FROM outbox WHERE email='two@example.com'")
+    assert l.send_emails()['accept'] == 1
+    assert l.send_outbox() == (1, 0)
+    resent = sent.sent[-1]['personalizations']
+    assert [x['to'] for x in resent] == [[{'email': 'two@example.com'}]]
+    assert resent[0]['substitutions'] == subs['two@example.com']
@@ -3,11 +3,13 @@ import os
 from hashlib import sha1
 from calendar import timegm
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from collections import Counter
 import sys
 
 import pytz
 import requests
-from raven import Client
+from requests.adapters import HTTPAdapter
 from simplejson import JSONDecodeError
 from requests.exceptions import RequestException
 
@@ -17,7 +19,25 @@ API_KEY = os.environ['PYCON_API_KEY']
 API_SECRET = os.environ['PYCON_API_SECRET']
 API_HOST = os.environ['PYCON_API_HOST']
 
-def api_call(uri):
+WORKERS = int(os.environ.get('PULL_WORKERS', 8))
+WRITE_CHUNK = 100
+TIMEOUT = 30
+
+_SESSION = []
+
+def session():
+    """One keep-alive connection pool, shared by all the fetching threads."""
+    if not _SESSION:
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WORKERS)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        _SESSION.append(s)
+    return _SESSION[0]
+
+def api_get(uri, etag=None):
+    """Returns the decoded body and the response's ETag. If the API says
+    nothing changed since etag, the body is None."""
     method = 'GET'
     body = ''
 
@@ -35,10 +55,18 @@ def api_call(uri):
             'X-API-Signature': str(sha1(base_string.encode('utf-8')).hexdigest()),
             'X-API-Timestamp': str(timestamp),
             }
+    if etag:
+        headers['If-None-Match'] = etag
     url = 'http://{}{}'.format(API_HOST, uri)
+    response = session().get(url, headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304:
+        return None, etag
+    return response.json(), response.headers.get('ETag')
+
+def api_call(uri):
     try:
-        return requests.get(url, headers=headers).json()
-    except JSONDecodeError, RequestException:
+        return api_get(uri)[0]
+    except (JSONDecodeError, RequestException):
         sys.exit(1)
 
 """
@@ -55,30 +83,65 @@ def fetch_ids():
     rv = [x['id'] for x in raw['data']]
     return list(set(TALK_IDS_FORCE + rv + l.get_all_proposal_ids()))
 
-def fetch_talk(id):
-    rv = api_call('/2017/pycon_api/proposals/{}/'.format(id))
-    if not rv or 'data' not in rv:
-        return {}
+def fetch_talk(id, etag=None):
+    """Returns the proposal and its ETag; the proposal is None when it
+    hasn't changed since etag, and empty when the API doesn't have it."""
+    rv, etag = api_get('/2017/pycon_api/proposals/{}/'.format(id), etag)
+    if rv is None:
+        return None, etag
+    if 'data' not in rv:
+        return {}, etag
     rv = rv['data']
     rv['authors'] = rv['speakers']
     del rv['speakers']
     rv.update(rv['details'])
     del rv['details']
-    return rv
+    return rv, etag
+
+def sync(ids, workers=WORKERS):
+    """Fetch ids concurrently, skip anything the API or our stored digest
+    says is unchanged, and upsert the rest in chunks."""
+    known = l.get_proposal_sources()
+
+    def fetch(id):
+        source = known.get(id)
+        return (id,) + fetch_talk(id, source.source_etag if source else None)
+
+    stats = Counter()
+    pending, etags = [], {}
+    pool = ThreadPool(workers)
+    try:
+        for id, proposal, etag in pool.imap_unordered(fetch, ids):
+            source = known.get(id)
+            if proposal is None:
+                stats['not_modified'] += 1
+            elif not proposal:
+                stats['missing'] += 1
+            elif (source and source.source_etag == etag
+                    and source.source_digest == l.proposal_digest(proposal)):
+                stats['unchanged'] += 1
+            else:
+                pending.append(proposal)
+                etags[id] = etag
+            if len(pending) >= WRITE_CHUNK:
+                stats['written'] += len(l.add_proposals(pending, etags))
+                pending = []
+        stats['written'] += len(l.add_proposals(pending, etags))
+    finally:
+        pool.terminate()
+    l.l('pull_updates', fetched=len(ids), **stats)
+    return stats
 
 def main():
-    for id in fetch_ids():
-        #print 'FETCHING {}'.format(id)
-        proposal = fetch_talk(id)
-        if proposal:
-            l.add_proposal(proposal)
+    sync(fetch_ids())
+    l.update_topic_model()
 
 
-raven_client = Client(os.environ['SENTRY_DSN'])
 if __name__ == '__main__':
+    from raven import Client
+    raven_client = Client(os.environ['SENTRY_DSN'])
     try:
         main()
     except:
         raven_client.captureException()
         sys.exit(1)
-
@@ -0,0 +1,114 @@
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import logic as l
+import pull_updates as p
+#A clean database for every test
+from logic_test import transact
+
+
+def api_proposal(n, **changes):
+    details = {'description': 'Description {}'.format(n), 'duration': '30',
+                'audience': 'People', 'abstract': 'Abstract {}'.format(n),
+                'recording_release': True, 'notes': 'Notes',
+                'title': 'Title {}'.format(n), 'outline': 'Outline'}
+    details.update(changes)
+    return {'id': n, 'details': details,
+            'speakers': [{'name': 'Speaker {}'.format(n),
+                            'email': '{}@example.com'.format(n)}]}
+
+
+class StubAPI(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path.startswith('/2017/pycon_api/proposals/?'):
+            body = {'data': [{'id': x} for x in sorted(server.proposals)]}
+            etag = None
+        else:
+            id = int(self.path.strip('/').split('/')[-1])
+            if id not in server.proposals:
+                body, etag = {}, None
+            else:
+                body = {'data': server.proposals[id]}
+                etag = '"{}-{}"'.format(id, server.versions[id])
+        if server.etags and etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if server.etags and etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), StubAPI)
+    server.proposals = {n:api_proposal(n) for n in range(1, 11)}
+    server.versions = {n:0 for n in server.proposals}
+    server.requests = []
+    server.etags = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(p, 'API_HOST', '127.0.0.1:{}'.format(server.server_port))
+    monkeypatch.setattr(p, 'WRITE_CHUNK', 4)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def change(api, n, **changes):
+    api.proposals[n] = api_proposal(n, **changes)
+    api.versions[n] += 1
+
+
+def test_sync(api):
+    stats = p.sync(p.fetch_ids())
+    assert stats['written'] == 10
+    assert sorted(l.get_all_proposal_ids()) == range(1, 11)
+    assert l.get_proposal(3).data['title'] == 'Title 3'
+    assert l.get_proposal(3).authors[0].email == '3@example.com'
+
+    del api.requests[:]
+    stats = p.sync(p.fetch_ids())
+    assert stats['not_modified'] == 10
+    assert not stats['written']
+    assert all(etag for path, etag in api.requests if '?' not in path)
+
+    change(api, 3, title='A Better Title')
+    stats = p.sync(p.fetch_ids())
+    assert stats['written'] == 1 and stats['not_modified'] == 9
+    proposal = l.get_proposal(3, 'history')
+    assert proposal.data['title'] == 'A Better Title'
+    assert [x['title'] for x in proposal.data_history] == \
+            ['A Better Title', 'Title 3']
+
+    #A new ETag for the same content only refreshes the stored ETag
+    api.versions[4] += 1
+    p.sync(p.fetch_ids())
+    assert len(l.get_proposal(4, 'history').data_history) == 1
+    assert p.sync(p.fetch_ids())['not_modified'] == 10
+
+    del api.proposals[10]
+    assert p.sync(p.fetch_ids())['missing'] == 1
+
+
+def test_sync_without_etags(api):
+    api.etags = False
+    assert p.sync(p.fetch_ids())['written'] == 10
+    assert p.sync(p.fetch_ids())['unchanged'] == 10
+
+    change(api, 5, abstract='Something else')
+    stats = p.sync(p.fetch_ids())
+    assert stats['written'] == 1 and stats['unchanged'] == 9
+    assert l.get_proposal(5).data['abstract'] == 'Something else'
@@ -1,4 +1,17 @@
 #!/usr/bin/env python
+import sys
+
 import logic
 
-logic.send_emails()
+def main(dry_run):
+    stats = logic.send_emails(dry_run)
+    print 'Accepted: {}'.format(stats['accept'])
+    print 'Declined: {}'.format(stats['decline'])
+    if dry_run:
+        print 'Would send {requests} requests; built {per_second:.0f} emails/s'\
+                .format(**stats)
+    else:
+        print 'Queued: {}'.format(stats['queued'])
+
+if __name__ == '__main__':
+    main('--dry-run' in sys.argv[1:])
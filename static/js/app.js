@@ -73,34 +73,69 @@ function save_vote(ev){
     });
 }
 
+function add_messages(panel, list, data){
+    //data is what comment/, messages/ and the like return: the messages
+    //after the panel's since cursor, and whether the thread is unread.
+    var $panel = $(panel);
+    _.each(data.messages, function(msg){
+        if($panel.find('[data-id=' + msg.id + ']').length == 0){
+            $panel.find(list).append(msg.html);
+        }
+        $panel.data().since = Math.max($panel.data().since, msg.id);
+    });
+    $panel.find('#unread-controls').toggle(data.unread);
+}
+
+function post_message(url, form, panel, list){
+    var args = $(form).serialize() + '&since=' + $(panel).data().since;
+    return $.post(url, args, null, 'json').then(function(data){
+        add_messages(panel, list, data);
+        $(form).find('textarea').val('');
+    });
+}
+
 function mark_read(ev){
     ev.preventDefault();
-    $.post('mark_read/').then(function(text){
-        $('#discussion-panel').replaceWith(text)
-        update_activity_buttons();
-    });
+    post_message('mark_read/', null, '#discussion-panel', 'ul.list-group')
+        .then(update_activity_buttons);
 }
 
 function give_feedback(ev){
     ev.preventDefault();
-    $.post('feedback/', $('#feedback-form').serialize()).then(function(text){
-        $('#discussion-panel').replaceWith(text);
-        $('#feedback-form textarea').val('');
-    });
+    post_message('feedback/', '#feedback-form', '#discussion-panel',
+                    'ul.list-group');
 }
 
 function leave_comment(ev){
     ev.preventDefault();
-    $.post('comment/', $('#comment-form').serialize()).then(function(text){
-        $('#discussion-panel').replaceWith(text);
-    });
+    post_message('comment/', '#comment-form', '#discussion-panel',
+                    'ul.list-group');
 }
 
 function batch_add_comment(ev){
     ev.preventDefault();
-    $.post('comment/', $('#add-comment').serialize()).then(function(text){
-        $('#batch-messages').replaceWith(text);
-    });
+    post_message('comment/', '#add-comment', '#batch-messages', 'table');
+}
+
+function follow_messages(panel, list, poll_url){
+    //Appends messages from the page's stream/ as they're posted, or polls
+    //poll_url for them where there's no EventSource.
+    if($(panel).length == 0){
+        return;
+    }
+    if(!window.EventSource){
+        setInterval(function(){
+            $.getJSON(poll_url, {since: $(panel).data().since})
+                .then(function(data){ add_messages(panel, list, data); });
+        }, 30000);
+        return;
+    }
+    var source = new EventSource('stream/?since=' + $(panel).data().since);
+    source.onmessage = function(ev){
+        var msg = JSON.parse(ev.data);
+        add_messages(panel, list, {messages: [msg],
+                        unread: $(panel).find('#unread-controls').is(':visible')});
+    };
 }
 
 function table_sorter($table, data_src, row_template, extra_column_functions){
@@ -164,6 +199,7 @@ $(document).ready(function(){
     $('#accept').on('click', 'li', batch_rem);
     $('#proposal-tabs a').first().tab("show");
     $('#batch-right-column').on('submit', '#add-comment', batch_add_comment);
+    follow_messages('#batch-messages', 'table', 'messages/');
 
     //Screening
     $('#right-column').on('click', '.voting-stripe button', vote_click);
@@ -172,6 +208,7 @@ $(document).ready(function(){
     $('#right-column').on('click', '#mark-read', mark_read);
     $('#right-column').on('submit', '#feedback-form', give_feedback);
     $('#right-column').on('submit', '#comment-form', leave_comment);
+    follow_messages('#discussion-panel', 'ul.list-group', 'discussion/');
     
     $('.tab-button').on('click', function(ev){
         console.log('click', $(this));
@@ -46,7 +46,7 @@ def main():
     votes = l.fetchall(q)
     print 'Every proposal received at least {} reviews,'.format(votes[0].count)
 
-    full_coverage = sum(1 for x in l.list_users() 
+    full_coverage = sum(1 for x in l.reviewer_activity() 
                         if (x.votes + x.proposals_made) == proposal_count)
     print 'and {} voters performed the incredible task of reviewing all of the proposals.'.format(full_coverage)
 
@@ -13,7 +13,9 @@ CREATE TABLE batchgroups (
     id              BIGSERIAL PRIMARY KEY,
     name            VARCHAR(254),
     author_emails   VARCHAR(254)[],
-    locked          BOOLEAN DEFAULT FALSE
+    locked          BOOLEAN DEFAULT FALSE,
+    voter_count     INT DEFAULT 0,     --Maintained by vote_group
+    skip_count      INT DEFAULT 0      --Votes to advance nothing
 );
 
 
@@ -31,11 +33,62 @@ CREATE TABLE proposals (
     author_names            VARCHAR(254)[],
 
     data                    JSONB,
-    data_history            JSONB,
 
-    accepted                BOOLEAN DEFAULT NULL
+    accepted                BOOLEAN DEFAULT NULL,
+
+    --What pull_updates.py last saw from the PyCon API
+    source_etag             TEXT DEFAULT NULL,
+    source_digest           VARCHAR(40) DEFAULT NULL
+);
+
+--One row per (proposal, lowercased author email), so "proposals by this
+--person" and "proposals not by this person" can use an index instead of
+--ANY(author_emails). Kept in step with proposals.author_emails by trigger.
+CREATE TABLE proposal_authors (
+    proposal    BIGINT REFERENCES proposals,
+    email       VARCHAR(254),
+    PRIMARY KEY (proposal, email)
 );
 
+CREATE INDEX idx_proposal_authors_email
+    ON proposal_authors (email);
+
+CREATE OR REPLACE FUNCTION proposal_authors_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM proposal_authors WHERE proposal = NEW.id;
+    END IF;
+    INSERT INTO proposal_authors (proposal, email)
+        SELECT DISTINCT NEW.id, lower(e) FROM unnest(NEW.author_emails) AS e
+        WHERE e IS NOT NULL;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER proposal_authors_insert_trigger AFTER INSERT
+    ON proposals FOR EACH ROW EXECUTE PROCEDURE proposal_authors_change();
+
+CREATE TRIGGER proposal_authors_change_trigger AFTER UPDATE OF author_emails
+    ON proposals FOR EACH ROW
+    WHEN (OLD.author_emails IS DISTINCT FROM NEW.author_emails)
+    EXECUTE PROCEDURE proposal_authors_change();
+
+--Every version of every proposal, appended as add_proposals sees changes
+CREATE TABLE proposal_revisions (
+    id          BIGSERIAL PRIMARY KEY,
+    proposal    BIGINT REFERENCES proposals,
+    data        JSONB,
+    created     TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+CREATE INDEX idx_proposal_revisions_proposal
+    ON proposal_revisions (proposal, id);
+
+--Walked in vote_count order by needs_votes
+CREATE INDEX idx_proposals_needs_votes
+    ON proposals (vote_count) WHERE NOT withdrawn;
+
 CREATE TABLE schedules (
     id          BIGSERIAL PRIMARY KEY,
     proposal    BIGINT REFERENCES proposals UNIQUE DEFAULT NULL,
@@ -53,19 +106,41 @@ CREATE AGGREGATE email_aggregate (basetype = VARCHAR(254)[],
                                     sfunc = array_cat,
                                     stype = VARCHAR(254)[], initcond = '{}');
 
+--A group's author_emails only change when a proposal joins or leaves it, or
+--its authors change; vote counts and acceptance don't touch them.
 CREATE OR REPLACE FUNCTION batch_change() RETURNS trigger AS
 $$
 BEGIN 
-    UPDATE batchgroups SET
-    author_emails=(SELECT email_aggregate(author_emails)
-                    FROM proposals WHERE batchgroup = NEW.batchgroup)
-    WHERE id = NEW.batchgroup;
+    IF TG_OP = 'UPDATE' AND OLD.batchgroup IS NOT NULL THEN
+        UPDATE batchgroups SET
+        author_emails=(SELECT email_aggregate(author_emails)
+                        FROM proposals WHERE batchgroup = OLD.batchgroup)
+        WHERE id = OLD.batchgroup;
+        IF OLD.batchgroup IS NOT DISTINCT FROM NEW.batchgroup THEN
+            RETURN NEW;
+        END IF;
+    END IF;
+    IF NEW.batchgroup IS NOT NULL THEN
+        UPDATE batchgroups SET
+        author_emails=COALESCE(author_emails, '{}') || NEW.author_emails
+        WHERE id = NEW.batchgroup;
+    END IF;
     RETURN NEW;
 END;
 $$ LANGUAGE 'plpgsql';
 
-CREATE TRIGGER batch_change_trigger AFTER INSERT OR UPDATE
-    ON proposals FOR EACH ROW EXECUTE PROCEDURE batch_change();
+CREATE TRIGGER batch_insert_trigger AFTER INSERT
+    ON proposals FOR EACH ROW WHEN (NEW.batchgroup IS NOT NULL)
+    EXECUTE PROCEDURE batch_change();
+
+CREATE TRIGGER batch_change_trigger AFTER UPDATE OF batchgroup, author_emails
+    ON proposals FOR EACH ROW
+    WHEN (OLD.batchgroup IS DISTINCT FROM NEW.batchgroup
+            OR OLD.author_emails IS DISTINCT FROM NEW.author_emails)
+    EXECUTE PROCEDURE batch_change();
+
+CREATE INDEX idx_proposals_batchgroup
+    ON proposals (batchgroup) WHERE batchgroup IS NOT NULL;
 
 CREATE TABLE batchvotes (
     batchgroup      BIGINT REFERENCES batchgroups,
@@ -77,6 +152,43 @@ CREATE TABLE batchvotes (
 
 );
 
+--batchvotes.accept, one row per proposal, kept in step by trigger
+CREATE TABLE batchvote_accepts (
+    batchgroup      BIGINT REFERENCES batchgroups,
+    voter           BIGINT REFERENCES users,
+    proposal        BIGINT,
+    PRIMARY KEY (batchgroup, voter, proposal)
+);
+
+CREATE INDEX idx_batchvote_accepts_proposal
+    ON batchvote_accepts (proposal);
+
+CREATE OR REPLACE FUNCTION batchvote_accepts_change() RETURNS trigger AS
+$$
+BEGIN 
+    IF TG_OP = 'UPDATE' THEN
+        DELETE FROM batchvote_accepts
+            WHERE batchgroup = OLD.batchgroup AND voter = OLD.voter;
+    END IF;
+    INSERT INTO batchvote_accepts (batchgroup, voter, proposal)
+        SELECT DISTINCT NEW.batchgroup, NEW.voter, a
+        FROM unnest(NEW.accept) AS a WHERE a IS NOT NULL;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER batchvote_accepts_trigger AFTER INSERT OR UPDATE OF accept
+    ON batchvotes FOR EACH ROW EXECUTE PROCEDURE batchvote_accepts_change();
+
+--Nominations per (batchgroup, proposal), maintained by vote_group and
+--assign_proposal; rebuild with ./batch_coverage.py rebuild
+CREATE TABLE batchnominations (
+    batchgroup      BIGINT REFERENCES batchgroups,
+    proposal        BIGINT,
+    nominations     INT DEFAULT 0,
+    PRIMARY KEY (batchgroup, proposal)
+);
+
 CREATE TABLE standards (
     id          BIGSERIAL PRIMARY KEY,
     description VARCHAR(127)
@@ -96,21 +208,60 @@ CREATE TABLE votes (
     added_on    TIMESTAMP WITH TIME ZONE DEFAULT now(),
     UNIQUE (voter, proposal)
 );
+CREATE INDEX idx_votes_updated_on
+    ON votes (updated_on);
 
+--Keeps proposals.vote_count and voters in step with votes, one vote at a
+--time. Rescoring a vote doesn't fire it at all.
 CREATE OR REPLACE FUNCTION votes_change() RETURNS trigger AS
 $$
 BEGIN 
-    UPDATE proposals SET 
-        vote_count=(SELECT count(*) FROM votes WHERE proposal=NEW.proposal),
-        voters = ARRAY(SELECT voter FROM votes WHERE proposal=NEW.proposal)
-        WHERE id=NEW.proposal;
-    RETURN NEW;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE proposals SET
+            vote_count=vote_count - 1,
+            voters=array_remove(voters, OLD.voter)
+            WHERE id=OLD.proposal;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE proposals SET
+            vote_count=vote_count + 1,
+            voters=array_append(voters, NEW.voter)
+            WHERE id=NEW.proposal;
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
 END;
 $$ LANGUAGE 'plpgsql';
 
-CREATE TRIGGER votes_change_trigger AFTER INSERT OR UPDATE
+CREATE TRIGGER votes_insert_trigger AFTER INSERT OR DELETE
     ON votes FOR EACH ROW EXECUTE PROCEDURE votes_change();
 
+CREATE TRIGGER votes_change_trigger AFTER UPDATE OF voter, proposal
+    ON votes FOR EACH ROW
+    WHEN (OLD.voter IS DISTINCT FROM NEW.voter
+            OR OLD.proposal IS DISTINCT FROM NEW.proposal)
+    EXECUTE PROCEDURE votes_change();
+
+--A proposal handed to a reviewer by needs_votes(reserve=True) isn't handed to
+--anybody else until the lease expires or the reviewer votes.
+CREATE TABLE reviewleases (
+    proposal    BIGINT PRIMARY KEY REFERENCES proposals,
+    voter       BIGINT REFERENCES users,
+    expires     TIMESTAMP WITH TIME ZONE
+);
+
+--NOTIFY on the table's name for every new message, with the id of the
+--thread (the column named by the trigger's argument) and of the message.
+--logic.wait_for_message LISTENs for them.
+CREATE OR REPLACE FUNCTION message_notify() RETURNS trigger AS
+$$
+BEGIN 
+    PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+                'key', row_to_json(NEW)->TG_ARGV[0], 'id', NEW.id)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
 CREATE TABLE discussion (
     id          BIGSERIAL PRIMARY KEY,
 
@@ -121,6 +272,11 @@ CREATE TABLE discussion (
     body        TEXT,
     feedback    BOOLEAN DEFAULT FALSE
 );
+CREATE INDEX idx_discussion_proposal
+    ON discussion (proposal);
+
+CREATE TRIGGER discussion_notify_trigger AFTER INSERT
+    ON discussion FOR EACH ROW EXECUTE PROCEDURE message_notify('proposal');
 
 CREATE TABLE unread (
     proposal    BIGINT REFERENCES proposals,
@@ -136,6 +292,11 @@ CREATE TABLE batchmessages (
     body        TEXT,
     created     TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
+CREATE INDEX idx_batchmessages_batch
+    ON batchmessages (batch, id);
+
+CREATE TRIGGER batchmessages_notify_trigger AFTER INSERT
+    ON batchmessages FOR EACH ROW EXECUTE PROCEDURE message_notify('batch');
 
 CREATE TABLE batchunread (
     batch   BIGINT REFERENCES batchgroups,
@@ -143,9 +304,45 @@ CREATE TABLE batchunread (
     PRIMARY KEY (batch, voter)
 );
 
+--Row counts of unread and batchunread per user, kept by the code that
+--inserts into and deletes from them.
+CREATE TABLE unreadcounts (
+    voter           BIGINT PRIMARY KEY REFERENCES users,
+    discussions     INT DEFAULT 0,
+    batches         INT DEFAULT 0
+);
+
 CREATE TABLE confirmations (
     id              BIGSERIAL PRIMARY KEY,
     proposal        BIGINT REFERENCES proposals,
     email           VARCHAR(254),
-    acknowledged    BOOLEAN DEFAULT NULL
+    acknowledged    BOOLEAN DEFAULT NULL,
+    UNIQUE (proposal, email)
+);
+
+--Email waiting to be sent, by send_outbox() in outbox_worker.py, and the
+--record of what has been. Each kind of email goes to the same recipients
+--about the same ref (a proposal, a message, a user) at most once.
+CREATE TABLE outbox (
+    id              BIGSERIAL PRIMARY KEY,
+    kind            VARCHAR(32) NOT NULL,
+    ref             TEXT NOT NULL,
+    email           TEXT NOT NULL,
+    message         JSONB NOT NULL,
+    created         TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    attempts        INT DEFAULT 0,
+    next_attempt    TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    sent            TIMESTAMP WITH TIME ZONE,
+    error           TEXT,
+    UNIQUE (kind, ref, email)
+);
+CREATE INDEX idx_outbox_due
+    ON outbox (next_attempt) WHERE sent IS NULL;
+
+--Proposal markdown rendered to HTML, keyed by the sha1 of the renderer's
+--version and the text; see render_markdown().
+CREATE TABLE markdown_cache (
+    digest          VARCHAR(40) PRIMARY KEY,
+    html            TEXT NOT NULL,
+    created         TIMESTAMP WITH TIME ZONE DEFAULT now()
 );